@@ -0,0 +1,631 @@
+"""Local stand-ins for Azure OpenAI, Azure AI Search and the shared cache.
+
+Run standalone to point a manually started Functions host at them:
+
+    python -m benchmarks.fakes --ttft-ms 300 --tokens-per-second 50
+
+With `--cache-port` an embedded in-memory Redis-protocol server stands in
+for the shared cache (CACHE_REDIS_URL); without it the app caches per process.
+
+The printed environment variables go into local.settings.json (or the shell
+that runs `func start`).
+"""
+import re
+import ssl
+import json
+import time
+import random
+import hashlib
+import asyncio
+import datetime
+import argparse
+import ipaddress
+import tempfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator
+
+from aiohttp import web
+
+from core.resp import RespServer
+
+HOTELS_PATH = Path(__file__).parent / "data" / "hotels.jsonl"
+FAKE_API_KEY = "benchmark-fake-key"
+HOTEL_INDEX_NAME = "hotel-vector"
+
+
+@dataclass
+class FakeOpenAIConfig:
+    ttft_ms: float = 300.0
+    tokens_per_second: float = 50.0
+    completion_tokens: int = 120
+    # Probability of answering with a tool call when tools are offered and the
+    # conversation does not end with a tool result yet.
+    tool_call_rate: float = 1.0
+    embedding_dimensions: int = 1536
+    # Probability of answering a deployment call with a 429 and Retry-After.
+    throttle_rate: float = 0.0
+    throttle_retry_after_ms: int = 200
+
+
+def load_hotels(path: Path = HOTELS_PATH) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def fake_embedding(text: str, dimensions: int) -> list[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimensions)]
+    norm = sum(value * value for value in vector) ** 0.5
+    return [value / norm for value in vector]
+
+
+def _estimate_tokens(value: object) -> int:
+    return max(1, len(json.dumps(value)) // 4)
+
+
+def _last_user_text(messages: list[dict]) -> str:
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            texts = [part.get("text", "") for part in content if part.get("type") == "text"]
+            return " ".join(texts) or "hotels with great amenities"
+    return "hotels"
+
+
+class FakeOpenAI:
+    def __init__(self, config: FakeOpenAIConfig) -> None:
+        self.config = config
+        self.requests = 0
+        self.throttled = 0
+        self.app = web.Application(middlewares=[self._throttle])
+        self.app.router.add_post(
+            "/openai/deployments/{deployment}/chat/completions", self.chat_completions
+        )
+        self.app.router.add_post(
+            "/openai/deployments/{deployment}/embeddings", self.embeddings
+        )
+        self.app.router.add_get("/openai/models", self.models)
+
+    @web.middleware
+    async def _throttle(self, request: web.Request, handler) -> web.StreamResponse:
+        if "deployment" in request.match_info and random.random() < self.config.throttle_rate:
+            self.throttled += 1
+            return web.json_response(
+                {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                status=429,
+                headers={
+                    "retry-after-ms": str(self.config.throttle_retry_after_ms),
+                    "retry-after": str(max(1, self.config.throttle_retry_after_ms // 1000)),
+                },
+            )
+        return await handler(request)
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": []})
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or self.config.embedding_dimensions
+        await asyncio.sleep(0.005 * len(inputs))
+        return web.json_response(
+            {
+                "object": "list",
+                "model": request.match_info["deployment"],
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": fake_embedding(str(text), dimensions),
+                    }
+                    for index, text in enumerate(inputs)
+                ],
+                "usage": {
+                    "prompt_tokens": _estimate_tokens(inputs),
+                    "total_tokens": _estimate_tokens(inputs),
+                },
+            }
+        )
+
+    def _tool_call(self, body: dict) -> dict | None:
+        tools = body.get("tools") or []
+        messages = body.get("messages") or []
+        if not tools or (messages and messages[-1].get("role") == "tool"):
+            return None
+        if random.random() >= self.config.tool_call_rate:
+            return None
+        names = [tool["function"]["name"] for tool in tools]
+        name = next((name for name in names if "search" in name.lower()), names[0])
+        return {
+            "index": 0,
+            "id": f"call_{random.getrandbits(48):x}",
+            "type": "function",
+            "function": {
+                "name": name,
+                "arguments": json.dumps({"query": _last_user_text(messages)}),
+            },
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        deployment = request.match_info["deployment"]
+        body = await request.json()
+        tool_call = self._tool_call(body)
+        prompt_tokens = _estimate_tokens(body.get("messages"))
+        completion_tokens = 0 if tool_call else self.config.completion_tokens
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        completion_id = f"chatcmpl-{random.getrandbits(48):x}"
+
+        if not body.get("stream"):
+            await asyncio.sleep(
+                (self.config.ttft_ms / 1000)
+                + completion_tokens / self.config.tokens_per_second
+            )
+            message: dict = {"role": "assistant", "content": None}
+            if tool_call:
+                tool_call = {key: value for key, value in tool_call.items() if key != "index"}
+                message["tool_calls"] = [tool_call]
+            else:
+                message["content"] = " ".join(["hotel"] * completion_tokens)
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": deployment,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": message,
+                            "finish_reason": "tool_calls" if tool_call else "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(choices: list[dict], **extra: object) -> None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": choices,
+                **extra,
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        await asyncio.sleep(self.config.ttft_ms / 1000)
+        if tool_call:
+            await send(
+                [
+                    {
+                        "index": 0,
+                        "delta": {"role": "assistant", "tool_calls": [tool_call]},
+                        "finish_reason": None,
+                    }
+                ]
+            )
+            await send([{"index": 0, "delta": {}, "finish_reason": "tool_calls"}])
+        else:
+            interval = 1 / self.config.tokens_per_second
+            for index in range(completion_tokens):
+                delta = {"content": "hotel " if index else "Recommended hotel "}
+                if index == 0:
+                    delta["role"] = "assistant"
+                await send([{"index": 0, "delta": delta, "finish_reason": None}])
+                await asyncio.sleep(interval)
+            await send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send([], usage=usage)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+_INDEX_PATH = re.compile(r"^/indexes(?:\('(?P<index>[^']+)'\))?(?P<rest>/.*)?$")
+_DOC_PATH = re.compile(r"^/docs\('(?P<key>[^']+)'\)$")
+
+
+class FakeSearch:
+    def __init__(self, hotels: list[dict], search_latency_ms: float = 30.0) -> None:
+        self.search_latency_ms = search_latency_ms
+        self.requests = 0
+        self.indexes: dict[str, dict] = {
+            HOTEL_INDEX_NAME: {"name": HOTEL_INDEX_NAME, "fields": [{"name": "chunk_id", "type": "Edm.String", "key": True}]}
+        }
+        self.documents: dict[str, dict[str, dict]] = {
+            HOTEL_INDEX_NAME: {
+                f"{hotel['Id']}_0": {
+                    "chunk_id": f"{hotel['Id']}_0",
+                    "parent_id": hotel["Id"],
+                    "Id": hotel["Id"],
+                    "HotelName": hotel["HotelName"],
+                    "Category": hotel["Category"],
+                    "City": hotel["City"],
+                    "State": hotel["State"],
+                    "Tags": hotel["Tags"],
+                    "chunk": hotel["Description"],
+                }
+                for hotel in hotels
+            }
+        }
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{tail:.*}", self.dispatch)
+
+    def _key_field(self, index: str) -> str:
+        for search_field in self.indexes.get(index, {}).get("fields", []):
+            if search_field.get("key"):
+                return search_field["name"]
+        return "id"
+
+    async def dispatch(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        path = request.path
+        if path == "/servicestats":
+            return web.json_response({"counters": {}, "limits": {}})
+
+        match = _INDEX_PATH.match(path)
+        if not match:
+            return web.json_response({"error": {"message": f"Unknown path {path}"}}, status=404)
+
+        index = match.group("index")
+        rest = match.group("rest") or ""
+
+        if index is None:
+            if request.method == "POST":
+                definition = await request.json()
+                self.indexes[definition["name"]] = definition
+                self.documents.setdefault(definition["name"], {})
+                return web.json_response(definition, status=201)
+            return web.json_response({"value": list(self.indexes.values())})
+
+        if rest == "":
+            if request.method == "GET":
+                if index not in self.indexes:
+                    return web.json_response({"error": {"message": "Index not found"}}, status=404)
+                return web.json_response(self.indexes[index])
+            if request.method == "PUT":
+                definition = await request.json()
+                self.indexes[index] = definition
+                self.documents.setdefault(index, {})
+                return web.json_response(definition, status=201)
+            if request.method == "DELETE":
+                self.indexes.pop(index, None)
+                self.documents.pop(index, None)
+                return web.Response(status=204)
+
+        documents = self.documents.setdefault(index, {})
+
+        if rest in ("/docs/search.post.search", "/docs/search"):
+            body = await request.json() if request.method == "POST" else dict(request.query)
+            await asyncio.sleep(self.search_latency_ms / 1000)
+            return web.json_response(self._search(documents, body))
+
+        if rest == "/docs/search.index":
+            body = await request.json()
+            key_field = self._key_field(index)
+            results = []
+            for action in body.get("value", []):
+                kind = action.pop("@search.action", "upload")
+                key = str(action.get(key_field))
+                if kind == "delete":
+                    documents.pop(key, None)
+                elif kind in ("merge", "mergeOrUpload") and key in documents:
+                    documents[key].update(action)
+                else:
+                    documents[key] = action
+                results.append({"key": key, "status": True, "errorMessage": None, "statusCode": 200})
+            return web.json_response({"value": results})
+
+        if rest == "/docs/$count":
+            return web.Response(text=str(len(documents)))
+
+        doc_match = _DOC_PATH.match(rest)
+        if doc_match:
+            document = documents.get(doc_match.group("key"))
+            if document is None:
+                return web.json_response({"error": {"message": "Document not found"}}, status=404)
+            return web.json_response(document)
+
+        return web.json_response({"error": {"message": f"Unknown path {path}"}}, status=404)
+
+    def _search(self, documents: dict[str, dict], body: dict) -> dict:
+        query = str(body.get("search") or "")
+        terms = set(re.findall(r"\w+", query.lower()))
+        matching = [
+            document for document in documents.values() if _matches(document, body.get("filter"))
+        ]
+        scored = []
+        for document in matching:
+            score = _overlap(terms, document) if terms and query != "*" else 1.0
+            scored.append((score, document))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        vector_queries = body.get("vectorQueries") or []
+        if vector_queries:
+            # Hybrid ranking fuses the keyword ranking with a stand-in for the
+            # vector one (word overlap with the chunk text alone), each adding
+            # 1 / (60 + rank) like the service's reciprocal rank fusion.
+            vector_query = vector_queries[0]
+            vector_terms = set(re.findall(r"\w+", str(vector_query.get("text") or query).lower()))
+            neighbors = sorted(
+                matching,
+                key=lambda document: _overlap(vector_terms, {"chunk": document.get("chunk")}),
+                reverse=True,
+            )[: int(vector_query.get("k") or 50)]
+            fused: dict[int, tuple[float, dict]] = {}
+            keyword_ranked = [document for score, document in scored if score > 0] if query else []
+            for ranking in (keyword_ranked, neighbors):
+                for rank, document in enumerate(ranking, start=1):
+                    previous = fused.get(id(document), (0.0, document))[0]
+                    fused[id(document)] = (previous + 1 / (60 + rank), document)
+            scored = sorted(fused.values(), key=lambda item: item[0], reverse=True)
+
+        top = int(body.get("top") or 50)
+        semantic = body.get("queryType") == "semantic"
+        ranked = [
+            (score, _overlap(terms, document) * 4 if semantic else None, document)
+            for score, document in scored[:50 if semantic else top]
+        ]
+        if semantic:
+            ranked.sort(key=lambda item: item[1], reverse=True)
+        results = []
+        for score, reranker_score, document in ranked[:top]:
+            result = {key: value for key, value in document.items() if not key.endswith("vector")}
+            result["@search.score"] = score
+            if reranker_score is not None:
+                result["@search.rerankerScore"] = reranker_score
+            results.append(result)
+        response: dict = {"value": results}
+        facets = body.get("facets")
+        if facets:
+            response["@search.facets"] = _facets(matching, facets)
+        return response
+
+
+def _overlap(terms: set[str], document: dict) -> float:
+    text = " ".join(
+        str(value) for key, value in document.items() if not key.endswith("vector")
+    ).lower()
+    return len(terms & set(re.findall(r"\w+", text))) / (len(terms) or 1)
+
+
+_FILTER_CLAUSE = re.compile(
+    r"(?P<field>\w+) eq '(?P<value>(?:[^']|'')*)'"
+    r"|search\.in\((?P<in_field>\w+), '(?P<values>(?:[^']|'')*)', '(?P<separator>[^']+)'\)"
+    r"|(?P<any_field>\w+)/any\(\w+: \w+ eq '(?P<any_value>(?:[^']|'')*)'\)"
+)
+
+
+def _clause_matches(document: dict, clause: re.Match) -> bool:
+    if clause.group("field"):
+        return str(document.get(clause.group("field"))) == clause.group("value").replace("''", "'")
+    if clause.group("in_field"):
+        values = clause.group("values").replace("''", "'").split(clause.group("separator"))
+        return str(document.get(clause.group("in_field"))) in values
+    items = document.get(clause.group("any_field")) or []
+    return clause.group("any_value").replace("''", "'") in items
+
+
+def _matches(document: dict, search_filter: str | None) -> bool:
+    """Evaluates the filters the app sends: eq, search.in and any() clauses joined
+    by "and", with "or" only inside parentheses. Other clauses are ignored."""
+    if not search_filter:
+        return True
+    conjuncts = []
+    depth, start = 0, 0
+    for position, character in enumerate(search_filter):
+        depth += {"(": 1, ")": -1}.get(character, 0)
+        if depth == 0 and search_filter.startswith(" and ", position):
+            conjuncts.append(search_filter[start:position])
+            start = position + 5
+    conjuncts.append(search_filter[start:])
+    for conjunct in conjuncts:
+        conjunct = conjunct.strip()
+        if conjunct.startswith("(") and conjunct.endswith(")") and " or " in conjunct:
+            alternatives = conjunct[1:-1].split(" or ")
+        else:
+            alternatives = [conjunct]
+        if not any(
+            clause is None or _clause_matches(document, clause)
+            for clause in (_FILTER_CLAUSE.fullmatch(alternative.strip()) for alternative in alternatives)
+        ):
+            return False
+    return True
+
+
+def _facets(documents: list[dict], facets: list[str]) -> dict:
+    counted: dict = {}
+    for facet in facets:
+        field, _, options = facet.partition(",")
+        limit = int(re.search(r"count:(\d+)", options).group(1)) if "count:" in options else 10
+        counts: dict[str, int] = {}
+        for document in documents:
+            value = document.get(field)
+            for item in value if isinstance(value, list) else [value]:
+                if item is not None:
+                    counts[item] = counts.get(item, 0) + 1
+        ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+        counted[field] = [{"value": value, "count": count} for value, count in ranked]
+    return counted
+
+
+def create_self_signed_certificate(directory: Path) -> tuple[Path, Path]:
+    """The Azure SDKs refuse plain-HTTP endpoints, so the fakes are served over TLS."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [
+                    x509.DNSName("localhost"),
+                    x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+                ]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    certificate_path = directory / "fake-azure.pem"
+    key_path = directory / "fake-azure.key"
+    certificate_path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return certificate_path, key_path
+
+
+@dataclass
+class FakeEndpoints:
+    openai: FakeOpenAI
+    search: FakeSearch
+    openai_url: str
+    search_url: str
+    certificate_path: Path
+    runners: list[web.AppRunner] = field(default_factory=list)
+    cache: RespServer | None = None
+    cache_url: str | None = None
+
+    def environment(self) -> dict[str, str]:
+        return {
+            "AZURE_OPENAI_ENDPOINT": self.openai_url,
+            "AZURE_OPENAI_API_KEY": FAKE_API_KEY,
+            "OPENAI_API_VERSION": "2024-10-21",
+            "AZURE_AI_SEARCH_ENDPOINT": self.search_url,
+            "AZURE_AI_SEARCH_API_KEY": FAKE_API_KEY,
+            "AZURE_AI_SEARCH_INDEX_NAME": HOTEL_INDEX_NAME,
+            "INDEX_NAME": HOTEL_INDEX_NAME,
+            "SEMANTIC_CONFIGURATION_NAME": "default",
+            # Trust the fakes' certificate (ssl/aiohttp/httpx and requests).
+            "SSL_CERT_FILE": str(self.certificate_path),
+            "REQUESTS_CA_BUNDLE": str(self.certificate_path),
+            **({"CACHE_REDIS_URL": self.cache_url} if self.cache_url else {}),
+        }
+
+
+async def _serve(
+    app: web.Application, host: str, port: int, ssl_context: ssl.SSLContext | None = None
+) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, ssl_context=ssl_context)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+    scheme = "https" if ssl_context else "http"
+    return runner, f"{scheme}://{host}:{bound_port}"
+
+
+@asynccontextmanager
+async def running_fakes(
+    config: FakeOpenAIConfig,
+    host: str = "127.0.0.1",
+    openai_port: int = 0,
+    search_port: int = 0,
+    cache_port: int | None = None,
+) -> AsyncIterator[FakeEndpoints]:
+    with tempfile.TemporaryDirectory() as directory:
+        certificate_path, key_path = create_self_signed_certificate(Path(directory))
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(certificate_path, key_path)
+
+        openai = FakeOpenAI(config)
+        search = FakeSearch(load_hotels())
+        openai_runner, openai_url = await _serve(openai.app, host, openai_port, ssl_context)
+        search_runner, search_url = await _serve(search.app, host, search_port, ssl_context)
+        endpoints = FakeEndpoints(
+            openai=openai,
+            search=search,
+            openai_url=openai_url,
+            search_url=search_url,
+            certificate_path=certificate_path,
+            runners=[openai_runner, search_runner],
+        )
+        if cache_port is not None:
+            endpoints.cache = RespServer()
+            endpoints.cache_url = await endpoints.cache.start(host, cache_port)
+        try:
+            yield endpoints
+        finally:
+            for runner in endpoints.runners:
+                await runner.cleanup()
+            if endpoints.cache is not None:
+                await endpoints.cache.close()
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--tool-call-rate", type=float, default=1.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--cache-port", type=int, help="Serve an in-memory shared cache on this port (0 for any)"
+    )
+
+
+def fake_config(args: argparse.Namespace) -> FakeOpenAIConfig:
+    return FakeOpenAIConfig(
+        ttft_ms=args.ttft_ms,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        tool_call_rate=args.tool_call_rate,
+        throttle_rate=args.throttle_rate,
+    )
+
+
+async def _main(args: argparse.Namespace) -> None:
+    async with running_fakes(
+        fake_config(args),
+        openai_port=args.openai_port,
+        search_port=args.search_port,
+        cache_port=args.cache_port,
+    ) as endpoints:
+        for name, value in endpoints.environment().items():
+            print(f"{name}={value}")
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_fake_arguments(parser)
+    parser.add_argument("--openai-port", type=int, default=8701)
+    parser.add_argument("--search-port", type=int, default=8702)
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,48 @@
+"""Serves the Function App's HTTP routes with uvicorn, without the Functions host.
+
+    python -m benchmarks.local_host --port 7071
+
+Routes are mounted under /api like `func start` does. Only HTTP triggers are
+served; the warm-up hook runs once at startup.
+"""
+import argparse
+from contextlib import asynccontextmanager
+from azure.functions.decorators.http import HttpTrigger
+from starlette.applications import Starlette
+from starlette.routing import Route
+
+
+def build_app() -> Starlette:
+    import function_app
+    from core.startup import warm_up
+
+    routes = []
+    for function in function_app.app.get_functions():
+        trigger = function.get_trigger()
+        if not isinstance(trigger, HttpTrigger):
+            continue
+        methods = [getattr(method, "value", method) for method in trigger.methods or ["GET", "POST"]]
+        routes.append(
+            Route(
+                f"/api/{trigger.route or function.get_function_name()}",
+                function.get_user_function(),
+                methods=methods,
+            )
+        )
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        await warm_up()
+        yield
+
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7071)
+    args = parser.parse_args()
+    uvicorn.run(build_app(), host=args.host, port=args.port, log_level="warning")
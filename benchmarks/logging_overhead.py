@@ -0,0 +1,174 @@
+"""Measures what logging costs a request on the event loop.
+
+Each simulated request invokes a Semantic Kernel function the way a tool
+call does, with hotel search results as its output, so the kernel's own
+invocation records (arguments and results at DEBUG) are what gets logged
+when they are enabled. Four setups are timed over the same requests:
+
+    none            no handlers, the cost of the calls themselves
+    baseline        the former setup: basicConfig's formatted handler on the
+                    root logger and the "kernel" logger at DEBUG, which leaves
+                    Semantic Kernel's "semantic_kernel" loggers at WARNING
+    pipeline        core.logs with its defaults
+    pipeline-debug  core.logs with LOG_LEVELS='{"semantic_kernel": "DEBUG"}',
+                    the opt-in sampled debug trail
+
+    python -m benchmarks.logging_overhead --requests 2000
+    python -m benchmarks.logging_overhead --report bench.json --route semantic-kernel-chat
+
+Overhead is the extra time per request over "none", also given as a share
+of `--request-ms` or of the p50 latency of `--route` in a run_benchmark
+report. Records go to a temporary file, so the numbers include real writes.
+The report is JSON.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+from benchmarks.fakes import load_hotels
+from benchmarks.run_benchmark import percentiles
+
+SETUPS = ("none", "baseline", "pipeline", "pipeline-debug")
+PIPELINE_LEVELS = {"pipeline": None, "pipeline-debug": '{"semantic_kernel": "DEBUG"}'}
+
+
+def build_kernel(hotels: list[dict]):
+    from semantic_kernel import Kernel
+    from semantic_kernel.functions import kernel_function
+
+    class Hotels:
+        @kernel_function(name="search")
+        def search(self, query: str) -> list[dict]:
+            return hotels
+
+    kernel = Kernel()
+    kernel.add_plugin(Hotels(), plugin_name="HotelVectorSearch")
+    return kernel
+
+
+def configure(setup: str, path: str) -> None:
+    from core.logs import LOG_DATE_FORMAT, LOG_FORMAT, configure_logging, stop_logging
+
+    stop_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for name in ("kernel", "semantic_kernel"):
+        logging.getLogger(name).setLevel(logging.NOTSET)
+    handler = logging.FileHandler(path, encoding="utf-8")
+    if setup == "none":
+        return
+    if setup == "baseline":
+        # What initialize_semantic_kernel did before core.logs.
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+        root.addHandler(handler)
+        logging.getLogger("kernel").setLevel(logging.DEBUG)
+        return
+
+    levels = PIPELINE_LEVELS[setup]
+    if levels is None:
+        os.environ.pop("LOG_LEVELS", None)
+    else:
+        os.environ["LOG_LEVELS"] = levels
+    root.addHandler(handler)
+    configure_logging()
+
+
+async def run_setup(kernel, requests: int, calls: int, path: str) -> dict:
+    function = kernel.get_function("HotelVectorSearch", "search")
+    durations: list[float] = []
+
+    async def request(number: int) -> None:
+        start = time.perf_counter()
+        for call in range(calls):
+            await kernel.invoke(function, query=f"hotels with a pool, request {number} call {call}")
+        durations.append((time.perf_counter() - start) * 1000)
+
+    for number in range(requests):
+        # A task per request, as the host runs them, so sampling decides per request.
+        await asyncio.create_task(request(number))
+    return {
+        "mean_ms": sum(durations) / len(durations),
+        "request_ms": percentiles(durations),
+        "log_bytes": os.path.getsize(path),
+    }
+
+
+def reference_latency(args: argparse.Namespace) -> float:
+    if not args.report:
+        return args.request_ms
+    with open(args.report, encoding="utf-8") as f:
+        report = json.load(f)
+    return report["routes"][args.route]["latency_ms"]["p50"]
+
+
+async def measure(args: argparse.Namespace) -> dict:
+    from core.logs import logging_stats, stop_logging
+
+    hotels = load_hotels()[: args.hotels]
+    kernel = build_kernel(hotels)
+    # Warms imports and caches so the first setup is not charged for them.
+    with tempfile.TemporaryDirectory() as directory:
+        configure("none", os.path.join(directory, "warm-up.log"))
+        await run_setup(kernel, 20, args.calls, os.path.join(directory, "warm-up.log"))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for setup in SETUPS:
+            path = os.path.join(directory, f"{setup}.log")
+            configure(setup, path)
+            counts = logging_stats()
+            results[setup] = await run_setup(kernel, args.requests, args.calls, path)
+            if setup in PIPELINE_LEVELS:
+                # What the writer thread still had to do when the requests were done.
+                start = time.perf_counter()
+                stop_logging()
+                results[setup]["drain_ms"] = (time.perf_counter() - start) * 1000
+                results[setup]["log_bytes"] = os.path.getsize(path)
+                results[setup]["records"] = {
+                    name: value - counts[name]
+                    for name, value in logging_stats().items()
+                    if name in ("queued", "sampled_out", "truncated", "dropped")
+                }
+
+    reference_ms = reference_latency(args)
+    baseline = results["none"]["mean_ms"]
+    for setup in SETUPS[1:]:
+        overhead = results[setup]["mean_ms"] - baseline
+        results[setup]["overhead_ms"] = overhead
+        results[setup]["overhead_percent"] = 100 * overhead / reference_ms
+    return {
+        "requests": args.requests,
+        "calls_per_request": args.calls,
+        "tool_result_hotels": len(hotels),
+        "reference_request_ms": reference_ms,
+        "setups": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=2, help="Tool calls per request")
+    parser.add_argument("--hotels", type=int, default=5, help="Hotels in each tool result")
+    parser.add_argument("--request-ms", type=float, default=2000.0, help="Request latency the overhead is compared with")
+    parser.add_argument("--report", help="run_benchmark report to take the request latency from")
+    parser.add_argument("--route", default="semantic-kernel-chat", help="Route of --report to compare with")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(measure(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Replays traffic recorded with TRAFFIC_RECORD_PATH against a deployment.
+
+Each recorded session is re-issued turn by turn under a fresh session id,
+starting every request at its original offset from the first record divided
+by `--speedup`. A turn never starts before the previous turn of its session
+has finished, so multi-turn history builds up as it did in production:
+
+    python -m benchmarks.replay traffic.jsonl --base-url https://staging/api --speedup 4
+
+Without `--base-url` the app is started locally against the OpenAI and Search
+fakes, like `benchmarks.run_benchmark` does. Prompts that were recorded
+without text are replaced with filler of the same length, and image turns
+upload `--image` regardless of the recorded image size.
+
+The report is JSON: per-route replayed time to first byte and latency next
+to the recorded latency, error counts and how far requests started behind
+schedule.
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import aiohttp
+
+from benchmarks.fakes import add_fake_arguments, fake_config, running_fakes
+from benchmarks.run_benchmark import (
+    IMAGE_PATH,
+    PROMPTS,
+    percentiles,
+    start_app,
+    wait_until_ready,
+)
+
+SESSION_HEADER = "X-Chat-Session-Id"
+
+
+@dataclass
+class RouteReplay:
+    ttfb_ms: list[float] = field(default_factory=list)
+    latency_ms: list[float] = field(default_factory=list)
+    recorded_latency_ms: list[float] = field(default_factory=list)
+    lag_ms: list[float] = field(default_factory=list)
+    errors: dict[str, int] = field(default_factory=dict)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def load_sessions(path: str, limit: int | None) -> dict[str, list[dict]]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record["timestamp"])
+
+    sessions: dict[str, list[dict]] = {}
+    for record in records:
+        if record["session"] not in sessions and limit is not None and len(sessions) >= limit:
+            continue
+        sessions.setdefault(record["session"], []).append(record)
+    return sessions
+
+
+def prompt_of(record: dict) -> str:
+    if record.get("prompt"):
+        return record["prompt"]
+    length = max(record.get("prompt_chars", 0), 1)
+    filler = random.choice(PROMPTS)
+    return (filler + " ") * (length // (len(filler) + 1)) + filler[: length % (len(filler) + 1)]
+
+
+def history_of(turns: list[dict], length: int) -> list[dict]:
+    """The last `length` messages of the replayed session, padded if the recording started mid-session."""
+    history = turns[-length:] if length else []
+    while len(history) < length:
+        history.insert(0, {"role": "user", "content": random.choice(PROMPTS)})
+        if len(history) < length:
+            history.insert(1, {"role": "assistant", "content": "Here are some hotels."})
+    return history
+
+
+def build_request(record: dict, session_id: str, turns: list[dict], image: bytes) -> dict:
+    route = record["route"]
+    headers = {SESSION_HEADER: session_id}
+    prompt = prompt_of(record)
+
+    if route == "chat":
+        history = history_of(turns, record.get("history_length", 0))
+        return {"json": {"prompt": prompt, "chat_history": history}, "headers": headers}
+
+    form = aiohttp.FormData()
+    if record.get("image_bytes"):
+        form.add_field("file", image, filename="1.jpg", content_type="image/jpeg")
+        if route == "upload-image":
+            history = history_of(turns, record.get("history_length", 0))
+            form.add_field("chat_history", json.dumps(history))
+    else:
+        form.add_field("prompt", prompt)
+    return {"data": form, "headers": headers}
+
+
+async def replay_session(
+    client: aiohttp.ClientSession,
+    base_url: str,
+    records: list[dict],
+    origin: float,
+    started: float,
+    speedup: float,
+    image: bytes,
+    results: dict[str, RouteReplay],
+) -> None:
+    session_id = str(uuid.uuid4())
+    turns: list[dict] = []
+
+    for record in records:
+        result = results.setdefault(record["route"], RouteReplay())
+        scheduled = started + (record["timestamp"] - origin) / speedup
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        result.lag_ms.append(max(0.0, -delay) * 1000)
+
+        request = build_request(record, session_id, turns, image)
+        start = time.perf_counter()
+        try:
+            async with client.post(f"{base_url}/{record['route']}", **request) as response:
+                first_byte = None
+                body = bytearray()
+                async for chunk in response.content.iter_any():
+                    if chunk and first_byte is None:
+                        first_byte = time.perf_counter()
+                    body += chunk
+                end = time.perf_counter()
+                if response.status >= 400:
+                    result.error(str(response.status))
+                    continue
+                session_id = response.headers.get(SESSION_HEADER, session_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            result.error(type(e).__name__)
+            continue
+
+        result.ttfb_ms.append(((first_byte or end) - start) * 1000)
+        result.latency_ms.append((end - start) * 1000)
+        result.recorded_latency_ms.append(record.get("latency_ms", 0.0))
+        if "json" in request:
+            turns.append({"role": "user", "content": request["json"]["prompt"]})
+        turns.append({"role": "assistant", "content": body.decode("utf-8", "replace")})
+
+
+async def replay(args: argparse.Namespace) -> dict:
+    sessions = load_sessions(args.input, args.sessions)
+    if not sessions:
+        raise SystemExit(f"No records in {args.input}")
+    image = Path(args.image).read_bytes()
+    origin = min(records[0]["timestamp"] for records in sessions.values())
+    results: dict[str, RouteReplay] = {}
+
+    async def run(base_url: str) -> float:
+        timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+        connector = aiohttp.TCPConnector(limit=args.max_connections)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as client:
+            started = time.perf_counter()
+            await asyncio.gather(
+                *[
+                    replay_session(
+                        client, base_url, records, origin, started, args.speedup, image, results
+                    )
+                    for records in sessions.values()
+                ]
+            )
+            return time.perf_counter() - started
+
+    if args.base_url is not None:
+        elapsed = await run(args.base_url)
+    else:
+        async with running_fakes(
+            fake_config(args),
+            openai_port=args.openai_port,
+            search_port=args.search_port,
+            cache_port=args.cache_port,
+        ) as fakes:
+            process = start_app("local", args.port, fakes.environment())
+            try:
+                base_url = f"http://127.0.0.1:{args.port}/api"
+                await wait_until_ready(base_url, timeout=args.startup_timeout)
+                elapsed = await run(base_url)
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+
+    return {
+        "config": {
+            "input": args.input,
+            "sessions": len(sessions),
+            "requests": sum(len(records) for records in sessions.values()),
+            "speedup": args.speedup,
+        },
+        "elapsed_seconds": elapsed,
+        "routes": {
+            route: {
+                "completed": len(result.latency_ms),
+                "errors": result.errors,
+                "ttft_ms": percentiles(result.ttfb_ms),
+                "latency_ms": percentiles(result.latency_ms),
+                "recorded_latency_ms": percentiles(result.recorded_latency_ms),
+                "schedule_lag_ms": percentiles(result.lag_ms),
+            }
+            for route, result in results.items()
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    add_fake_arguments(parser)
+    parser.add_argument("input", help="JSONL file written by the traffic recorder")
+    parser.add_argument("--base-url", help="Replay against this deployment, e.g. https://host/api")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Divide inter-arrival times by this factor")
+    parser.add_argument("--sessions", type=int, help="Replay only the first N sessions")
+    parser.add_argument("--image", default=str(IMAGE_PATH), help="Image uploaded for image turns")
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--port", type=int, default=7071)
+    parser.add_argument("--openai-port", type=int, default=0)
+    parser.add_argument("--search-port", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""Offline end-to-end benchmark for the chat routes.
+
+Starts the Azure OpenAI and Azure AI Search fakes, starts the app against
+them (uvicorn by default, `--host func` for the Functions host, or
+`--base-url` for an already running instance) and drives the routes at the
+requested concurrency:
+
+    python -m benchmarks.run_benchmark --routes chat,sk-demo --concurrency 16 \\
+        --requests 200 --output bench.json
+
+The report is JSON: per-route p50/p95/p99 time to first byte and total
+latency, requests per second, error counts and the app's peak RSS.
+
+With `--diagnostics` the app runs with its diagnostics routes enabled and
+traces allocations from a baseline taken once it is ready; the report adds
+the app's memory and live clients before and after the run and the
+allocation sites that grew the most, to reproduce a leak locally:
+
+    python -m benchmarks.run_benchmark --routes sk-demo --requests 500 --diagnostics
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import statistics
+import subprocess
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import aiohttp
+import psutil
+
+from benchmarks.fakes import add_fake_arguments, fake_config, running_fakes
+
+ROOT = Path(__file__).resolve().parent.parent
+IMAGE_PATH = ROOT / "1.jpg"
+ROUTES = ("chat", "upload-image", "semantic-kernel-chat", "sk-demo")
+PROMPTS = [
+    "best hotel based on amenities",
+    "pet-friendly hotels in Seattle",
+    "luxury hotel with a spa",
+    "budget hotel near the airport with free parking",
+    "hotels with beach access and a pool",
+    "quiet boutique hotel with a restaurant",
+]
+
+
+@dataclass
+class RouteResult:
+    ttfb_ms: list[float] = field(default_factory=list)
+    latency_ms: list[float] = field(default_factory=list)
+    errors: dict[str, int] = field(default_factory=dict)
+    started: float = 0.0
+    finished: float = 0.0
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def build_request(route: str, session_id: str, image: bytes) -> dict:
+    prompt = random.choice(PROMPTS)
+    headers = {"X-Chat-Session-Id": session_id}
+    if route == "chat":
+        return {"json": {"prompt": prompt, "chat_history": []}, "headers": headers}
+
+    form = aiohttp.FormData()
+    if route == "upload-image":
+        form.add_field("file", image, filename="1.jpg", content_type="image/jpeg")
+        form.add_field("chat_history", "[]")
+    else:
+        form.add_field("prompt", prompt)
+    return {"data": form, "headers": headers}
+
+
+async def run_route(
+    session: aiohttp.ClientSession,
+    base_url: str,
+    route: str,
+    concurrency: int,
+    total: int,
+    image: bytes,
+) -> RouteResult:
+    result = RouteResult()
+    remaining = total
+
+    async def worker() -> None:
+        nonlocal remaining
+        session_id = str(uuid.uuid4())
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                async with session.post(
+                    f"{base_url}/{route}", **build_request(route, session_id, image)
+                ) as response:
+                    first_byte = None
+                    async for chunk in response.content.iter_any():
+                        if chunk and first_byte is None:
+                            first_byte = time.perf_counter()
+                    end = time.perf_counter()
+                    if response.status >= 400:
+                        result.error(str(response.status))
+                        continue
+                    result.ttfb_ms.append(((first_byte or end) - start) * 1000)
+                    result.latency_ms.append((end - start) * 1000)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result.error(type(e).__name__)
+
+    result.started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result.finished = time.perf_counter()
+    return result
+
+
+class RssSampler:
+    def __init__(self, pid: int | None, interval: float = 0.1) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.peak_bytes = 0
+        self._task: asyncio.Task | None = None
+
+    def _sample(self) -> int:
+        process = psutil.Process(self.pid)
+        processes = [process, *process.children(recursive=True)]
+        total = 0
+        for item in processes:
+            try:
+                total += item.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self.peak_bytes = max(self.peak_bytes, self._sample())
+            except psutil.Error:
+                return
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self.pid is not None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def wait_until_ready(base_url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f"{base_url}/sk-demo/metrics") as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"App at {base_url} did not become ready in {timeout}s")
+
+
+def start_app(kind: str, port: int, environment: dict[str, str]) -> subprocess.Popen:
+    env = {**os.environ, **environment}
+    if kind == "func":
+        command = ["func", "start", "--port", str(port)]
+    else:
+        command = [sys.executable, "-m", "benchmarks.local_host", "--port", str(port)]
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+
+async def diagnostics_call(base_url: str, method: str, path: str, **params) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.request(
+            method, f"{base_url}/diagnostics/{path}", params={k: str(v) for k, v in params.items()}
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+
+async def start_diagnostics(base_url: str, frames: int) -> dict:
+    await diagnostics_call(base_url, "POST", "tracemalloc", action="start", frames=frames)
+    await diagnostics_call(base_url, "POST", "tracemalloc", action="baseline")
+    return await diagnostics_call(base_url, "GET", "memory")
+
+
+async def finish_diagnostics(base_url: str, before: dict, top: int) -> dict:
+    report = {
+        "before": before,
+        "after": await diagnostics_call(base_url, "GET", "memory"),
+        "allocations": await diagnostics_call(
+            base_url, "GET", "tracemalloc/diff", top=top, group_by="traceback"
+        ),
+        "tasks": await diagnostics_call(base_url, "GET", "tasks"),
+    }
+    await diagnostics_call(base_url, "POST", "tracemalloc", action="stop")
+    return report
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    image = IMAGE_PATH.read_bytes()
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    report: dict = {
+        "config": {
+            "routes": routes,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "ttft_ms": args.ttft_ms,
+            "tokens_per_second": args.tokens_per_second,
+            "completion_tokens": args.completion_tokens,
+            "tool_call_rate": args.tool_call_rate,
+            "throttle_rate": args.throttle_rate,
+        },
+        "routes": {},
+    }
+
+    async with running_fakes(
+        fake_config(args),
+        openai_port=args.openai_port,
+        search_port=args.search_port,
+        cache_port=args.cache_port,
+    ) as fakes:
+        process = None
+        base_url = args.base_url
+        pid = args.pid
+        if base_url is None:
+            environment = fakes.environment()
+            if args.diagnostics:
+                environment["DIAGNOSTICS_ENABLED"] = "true"
+            process = start_app(args.host, args.port, environment)
+            base_url = f"http://127.0.0.1:{args.port}/api"
+            pid = process.pid
+        try:
+            await wait_until_ready(base_url, timeout=args.startup_timeout)
+            if args.diagnostics:
+                diagnostics_before = await start_diagnostics(base_url, args.tracemalloc_frames)
+            sampler = RssSampler(pid)
+            sampler.start()
+            timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+            connector = aiohttp.TCPConnector(limit=args.concurrency)
+            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+                for route in routes:
+                    upstream_before = fakes.openai.requests + fakes.search.requests
+                    throttled_before = fakes.openai.throttled
+                    result = await run_route(
+                        session, base_url, route, args.concurrency, args.requests, image
+                    )
+                    elapsed = result.finished - result.started
+                    report["routes"][route] = {
+                        "completed": len(result.latency_ms),
+                        "errors": result.errors,
+                        "rps": len(result.latency_ms) / elapsed if elapsed else 0.0,
+                        "ttft_ms": percentiles(result.ttfb_ms),
+                        "latency_ms": percentiles(result.latency_ms),
+                        "upstream_calls": fakes.openai.requests
+                        + fakes.search.requests
+                        - upstream_before,
+                        "upstream_throttled": fakes.openai.throttled - throttled_before,
+                    }
+            await sampler.stop()
+            report["peak_rss_mb"] = sampler.peak_bytes / (1024 * 1024) if pid else None
+            if args.diagnostics:
+                report["diagnostics"] = await finish_diagnostics(
+                    base_url, diagnostics_before, args.diagnostics_top
+                )
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    add_fake_arguments(parser)
+    parser.add_argument("--routes", default=",".join(ROUTES))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="Requests per route")
+    parser.add_argument("--host", choices=("local", "func"), default="local")
+    parser.add_argument("--port", type=int, default=7071)
+    parser.add_argument("--base-url", help="Benchmark an already running app instead")
+    parser.add_argument("--pid", type=int, help="PID to sample RSS from with --base-url")
+    parser.add_argument("--openai-port", type=int, default=0, help="Fixed port for the OpenAI fake")
+    parser.add_argument("--search-port", type=int, default=0, help="Fixed port for the Search fake")
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--diagnostics", action="store_true", help="Trace the app's allocations and clients")
+    parser.add_argument("--tracemalloc-frames", type=int, default=10)
+    parser.add_argument("--diagnostics-top", type=int, default=25, help="Allocation sites to report")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(benchmark(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
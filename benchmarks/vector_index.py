@@ -0,0 +1,301 @@
+"""Compares vector index profiles offline: recall@k, query latency and memory.
+
+Every profile in core/search_index.py (or those named with `--profiles`) is
+built over the same vectors with a local NumPy HNSW implementation that
+stands in for the search service, and queried against brute-force ground
+truth:
+
+    python -m benchmarks.vector_index --documents 5000 --dimensions 384
+    python -m benchmarks.vector_index --vectors embeddings.npy --profiles default scalar binary
+
+Quantized profiles build and traverse the graph over int8 codes, or sign
+bits for binary, and rescore `oversampling * k` candidates with the original
+vectors when the profile reranks, like the service does. Without
+`--vectors` the documents are a synthetic clustered set; real embeddings,
+e.g. exported from the index, give more faithful recall numbers.
+
+Memory is the vector storage searched at query time plus the graph links;
+`projected_mb` scales both to `--project-documents` vectors of
+`--project-dimensions`, the size of the production hotel index. The
+report is JSON.
+"""
+import json
+import math
+import time
+import heapq
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+
+from benchmarks.run_benchmark import percentiles
+from core.search_index import VectorIndexProfile, profiles
+
+LINK_BYTES = 4
+
+
+@dataclass
+class Quantizer:
+    """Maps full-precision vectors to the representation the graph is searched on."""
+
+    kind: str | None
+    low: np.ndarray | None = None
+    scale: np.ndarray | None = None
+
+    @classmethod
+    def fit(cls, kind: str | None, vectors: np.ndarray) -> "Quantizer":
+        if kind != "scalar":
+            return cls(kind)
+        low = vectors.min(axis=0)
+        scale = (vectors.max(axis=0) - low) / 255.0
+        scale[scale == 0] = 1.0
+        return cls(kind, low, scale)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Quantizes and decodes again, so searches see the quantization error."""
+        if self.kind == "scalar":
+            codes = np.clip(np.round((vectors - self.low) / self.scale), 0, 255)
+            return (codes * self.scale + self.low).astype(np.float32)
+        if self.kind == "binary":
+            return np.where(vectors > 0, 1.0, -1.0).astype(np.float32)
+        return vectors
+
+    def bytes_per_dimension(self) -> float:
+        return {"scalar": 1.0, "binary": 1 / 8}.get(self.kind or "", 4.0)
+
+
+class HNSW:
+    """Hierarchical navigable small world graph over inner-product similarity.
+
+    Upper layers keep `m` links per node and layer 0 keeps `2 * m`, chosen
+    with the neighbour-diversity heuristic from the HNSW paper.
+    """
+
+    def __init__(self, vectors: np.ndarray, m: int, ef_construction: int, seed: int = 0) -> None:
+        self.vectors = vectors
+        self.m = m
+        self.ef_construction = ef_construction
+        self.level_multiplier = 1 / math.log(max(m, 2))
+        self.links: list[dict[int, list[int]]] = []
+        self.entry = -1
+        self.random = np.random.default_rng(seed)
+        for node in range(len(vectors)):
+            self._insert(node)
+
+    def _max_links(self, level: int) -> int:
+        return self.m * 2 if level == 0 else self.m
+
+    def _search_layer(self, query: np.ndarray, entries: list[int], ef: int, level: int) -> list[tuple[float, int]]:
+        """The `ef` nodes closest to `query` on `level`, as (distance, node) sorted ascending."""
+        links = self.links[level]
+        visited = set(entries)
+        distances = 1.0 - self.vectors[entries] @ query
+        candidates = [(float(d), node) for d, node in zip(distances, entries)]
+        heapq.heapify(candidates)
+        results = [(-d, node) for d, node in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbours = [n for n in links.get(node, ()) if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for d, neighbour in zip((1.0 - self.vectors[neighbours] @ query).tolist(), neighbours):
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, neighbour))
+                    heapq.heappush(results, (-d, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, node) for d, node in results)
+
+    def _select(self, candidates: list[tuple[float, int]], count: int) -> list[int]:
+        """Keeps candidates closer to the new node than to any neighbour already kept."""
+        selected: list[int] = []
+        for distance, node in candidates:
+            if len(selected) >= count:
+                break
+            if selected:
+                closest_kept = float(np.max(self.vectors[selected] @ self.vectors[node]))
+                if 1.0 - closest_kept < distance:
+                    continue
+            selected.append(node)
+        return selected
+
+    def _insert(self, node: int) -> None:
+        level = int(-math.log(1.0 - self.random.random()) * self.level_multiplier)
+        top = len(self.links) - 1
+        while len(self.links) <= level:
+            self.links.append({})
+        for layer in range(level + 1):
+            self.links[layer][node] = []
+        if self.entry < 0:
+            self.entry = node
+            return
+
+        query = self.vectors[node]
+        entries = [self.entry]
+        for layer in range(top, level, -1):
+            entries = [self._search_layer(query, entries, 1, layer)[0][1]]
+
+        for layer in range(min(level, top), -1, -1):
+            candidates = self._search_layer(query, entries, self.ef_construction, layer)
+            neighbours = self._select(candidates, self.m)
+            self.links[layer][node] = neighbours
+            for neighbour in neighbours:
+                links = self.links[layer][neighbour]
+                links.append(node)
+                if len(links) > self._max_links(layer):
+                    distances = 1.0 - self.vectors[links] @ self.vectors[neighbour]
+                    ranked = sorted(zip(distances.tolist(), links))
+                    self.links[layer][neighbour] = self._select(ranked, self._max_links(layer))
+            entries = [node for _, node in candidates]
+
+        if level > top:
+            self.entry = node
+
+    def search(self, query: np.ndarray, k: int, ef: int) -> list[int]:
+        entries = [self.entry]
+        for layer in range(len(self.links) - 1, 0, -1):
+            entries = [self._search_layer(query, entries, 1, layer)[0][1]]
+        return [node for _, node in self._search_layer(query, entries, max(ef, k), 0)[:k]]
+
+    def link_count(self) -> int:
+        return sum(len(links) for layer in self.links for links in layer.values())
+
+
+def synthetic_vectors(count: int, dimensions: int, clusters: int, seed: int) -> np.ndarray:
+    """Unit vectors drawn around random centres, roughly like topic clusters of embeddings."""
+    random = np.random.default_rng(seed)
+    centres = random.standard_normal((clusters, dimensions))
+    vectors = centres[random.integers(0, clusters, count)] + 1.5 * random.standard_normal((count, dimensions))
+    return normalize(vectors)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark_profile(
+    profile: VectorIndexProfile,
+    documents: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+    k: int,
+    project_documents: int,
+    project_dimensions: int,
+) -> dict:
+    quantizer = Quantizer.fit(profile.compression, documents)
+    encoded = quantizer.encode(documents)
+    candidates = k
+    if profile.compression and profile.rerank:
+        candidates = math.ceil(k * (profile.oversampling or 1.0))
+
+    start = time.perf_counter()
+    graph = None
+    if profile.algorithm != "exhaustiveKnn":
+        graph = HNSW(encoded, m=profile.m, ef_construction=profile.ef_construction)
+    build_seconds = time.perf_counter() - start
+
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        search_query = quantizer.encode(query[None, :])[0]
+        if graph is None:
+            scores = encoded @ search_query
+            found = np.argpartition(-scores, candidates - 1)[:candidates].tolist()
+        else:
+            found = graph.search(search_query, candidates, profile.ef_search)
+        if candidates > k:
+            rescored = documents[found] @ query
+            found = [found[i] for i in np.argsort(-rescored)[:k]]
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(found[:k]) & set(expected.tolist()))
+
+    count, dimensions = documents.shape
+    vector_bytes = count * dimensions * quantizer.bytes_per_dimension()
+    links_per_vector = graph.link_count() / count if graph else 0.0
+    graph_bytes = count * links_per_vector * LINK_BYTES
+    projected_bytes = project_documents * (
+        project_dimensions * quantizer.bytes_per_dimension() + links_per_vector * LINK_BYTES
+    )
+    return {
+        "profile": profile.name,
+        "algorithm": profile.algorithm,
+        "m": profile.m if graph else None,
+        "ef_construction": profile.ef_construction if graph else None,
+        "ef_search": profile.ef_search if graph else None,
+        "compression": profile.compression,
+        "candidates": candidates,
+        f"recall@{k}": round(hits / (len(queries) * k), 4),
+        "latency_ms": {name: round(value, 3) for name, value in percentiles(latencies).items()},
+        "build_seconds": round(build_seconds, 2),
+        "memory_mb": round((vector_bytes + graph_bytes) / 2**20, 2),
+        "bytes_per_vector": round((vector_bytes + graph_bytes) / count, 1),
+        "links_per_vector": round(links_per_vector, 1),
+        "projected_mb": round(projected_bytes / 2**20, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--profiles", nargs="+", choices=sorted(profiles), help="Profiles to compare (default: all)")
+    parser.add_argument("--vectors", help="NumPy .npy file of document embeddings")
+    parser.add_argument("--documents", type=int, default=5000, help="Synthetic document count")
+    parser.add_argument("--dimensions", type=int, default=384, help="Synthetic vector dimensions")
+    parser.add_argument("--clusters", type=int, default=50, help="Synthetic topic clusters")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--project-documents", type=int, default=1_000_000)
+    parser.add_argument("--project-dimensions", type=int, default=1536)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.vectors:
+        vectors = normalize(np.load(args.vectors))
+        random = np.random.default_rng(args.seed)
+        held_out = random.choice(len(vectors), size=min(args.queries, len(vectors) // 10), replace=False)
+        queries = vectors[held_out]
+        documents = np.delete(vectors, held_out, axis=0)
+    else:
+        vectors = synthetic_vectors(args.documents + args.queries, args.dimensions, args.clusters, args.seed)
+        documents, queries = vectors[: args.documents], vectors[args.documents :]
+
+    truth = np.argsort(-(queries @ documents.T), axis=1)[:, : args.k]
+    results = [
+        benchmark_profile(
+            profiles[name],
+            documents,
+            queries,
+            truth,
+            args.k,
+            args.project_documents,
+            args.project_dimensions,
+        )
+        for name in (args.profiles or sorted(profiles))
+    ]
+    report = {
+        "documents": len(documents),
+        "dimensions": documents.shape[1],
+        "queries": len(queries),
+        "k": args.k,
+        "profiles": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
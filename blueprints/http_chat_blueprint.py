@@ -1,43 +1,93 @@
+import os
 import json
 import azure.functions as func
 from azurefunctions.extensions.http.fastapi import Request, StreamingResponse, Response, JSONResponse
-from services.chat_service import ChatService
-import base64
+from core.uploads import image_data_uri, UploadTooLargeError, UploadCapacityError
+from core.telemetry import server_timing
+from core.sse import SSEEvent, resumable, sse_response, token
+from core.openai_scheduler import scheduler_stats
+from utils import llm_error_response
+from core.traffic_recorder import recorded, annotate_traffic
+from core.admission import admitted, admission_stats
+from core.resilience import deadline
+from core.usage import metered
+from core.startup import register_warm_up
 
 chat_bp = func.Blueprint()
 
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "1000"))
+CHAT_BATCH_MAX_CONCURRENCY = int(os.getenv("CHAT_BATCH_MAX_CONCURRENCY", "16"))
+
+
+def _chat_service():
+    # Imported on first use: the service pulls in openai, azure.identity and
+    # azure.search, which would otherwise be loaded on every cold start.
+    from services.chat_service import ChatService
+
+    return ChatService()
+
+
+@register_warm_up
+async def warm_up_chat() -> None:
+    _chat_service()
+
 
 async def stream_processor(response):
+    usage = None
     async for chunk in response:
         if len(chunk.choices) > 0:
             delta = chunk.choices[0].delta
             if delta is not None and delta.content:
-                yield delta.content
+                yield token(delta.content)
+        usage = chunk.usage or usage
+    if usage is not None:
+        yield SSEEvent("usage", {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+        })
 
 
 @chat_bp.route(
     route="chat", methods=[func.HttpMethod.POST], auth_level=func.AuthLevel.ANONYMOUS
 )
+@server_timing
+@resumable
+@recorded("chat")
+@metered("chat")
+@admitted("chat")
+@deadline("chat")
 async def chat(req: Request):
     try:
         req_body = await req.json()
         prompt = req_body.get("prompt")
         chat_history = req_body.get("chat_history")
+        annotate_traffic(prompt=prompt, history_length=len(chat_history or []))
 
-        chat_service = ChatService()
+        chat_service = _chat_service()
         response = await chat_service.chat(prompt=prompt, chat_history=list(chat_history))
 
-        return StreamingResponse(stream_processor(response), media_type="text/event-stream")
+        return sse_response(stream_processor(response))
     except ValueError as e:
         return Response(
             str(e),
             status_code=500
         )
+    except Exception as e:
+        error_response = llm_error_response(e)
+        if error_response is None:
+            raise
+        return error_response
 
 
 @chat_bp.route(
     route="upload-image", methods=[func.HttpMethod.POST], auth_level=func.AuthLevel.ANONYMOUS
 )
+@server_timing
+@resumable
+@recorded("upload-image")
+@metered("upload-image")
+@admitted("upload-image")
+@deadline("upload-image")
 async def upload_image(req: Request):
     try:
         form_data = await req.form();
@@ -47,20 +97,86 @@ async def upload_image(req: Request):
         if not file:
             return JSONResponse({ "message": "No file uploaded" })
 
-        file_content = await file.read()
-        encoded_image = base64.b64encode(file_content).decode("ascii")
-
         if chat_history:
             chat_history = json.loads(chat_history)
         else:
             chat_history = []
+        annotate_traffic(history_length=len(chat_history), image_bytes=file.size or 0)
 
-        chat_service = ChatService()
-        response = await chat_service.analyza_image(encoded_image=encoded_image, chat_history=chat_history)
+        chat_service = _chat_service()
+        async with image_data_uri(file, mime_type="image/jpeg") as image_url:
+            response = await chat_service.analyza_image(image_url=image_url, chat_history=chat_history)
 
-        return StreamingResponse(stream_processor(response), media_type="text/event-stream")
+        return sse_response(stream_processor(response))
+    except UploadTooLargeError as e:
+        return JSONResponse({"message": str(e)}, status_code=413)
+    except UploadCapacityError as e:
+        return JSONResponse(
+            {"message": str(e)},
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except ValueError as e:
         return Response(
             str(e),
             status_code=500
         )
+    except Exception as e:
+        error_response = llm_error_response(e)
+        if error_response is None:
+            raise
+        return error_response
+
+
+async def ndjson_processor(results):
+    async for result in results:
+        yield json.dumps(result) + "\n"
+
+
+@chat_bp.route(
+    route="chat-batch", methods=[func.HttpMethod.POST], auth_level=func.AuthLevel.FUNCTION
+)
+@server_timing
+@admitted("chat-batch")
+async def chat_batch(req: Request):
+    try:
+        req_body = await req.json()
+    except ValueError:
+        return JSONResponse({"message": "The body must be JSON"}, status_code=400)
+
+    items = req_body.get("items")
+    if items is None and isinstance(req_body.get("prompts"), list):
+        items = [{"prompt": prompt} for prompt in req_body["prompts"]]
+    if not isinstance(items, list) or not items:
+        return JSONResponse({"message": "Expected a non-empty `items` or `prompts` list"}, status_code=400)
+    if len(items) > CHAT_BATCH_MAX_ITEMS:
+        return JSONResponse(
+            {"message": f"At most {CHAT_BATCH_MAX_ITEMS} items per batch"}, status_code=413
+        )
+    if not all(isinstance(item, dict) and isinstance(item.get("prompt"), str) for item in items):
+        return JSONResponse({"message": "Every item needs a `prompt` string"}, status_code=400)
+
+    try:
+        concurrency = min(max(int(req_body.get("concurrency") or 8), 1), CHAT_BATCH_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        return JSONResponse({"message": "`concurrency` must be an integer"}, status_code=400)
+
+    chat_service = _chat_service()
+    return StreamingResponse(
+        ndjson_processor(chat_service.chat_batch(items=items, concurrency=concurrency)),
+        media_type="application/x-ndjson"
+    )
+
+
+@chat_bp.route(
+    route="openai/metrics", methods=[func.HttpMethod.GET], auth_level=func.AuthLevel.FUNCTION
+)
+async def openai_metrics(req: Request):
+    return JSONResponse(scheduler_stats())
+
+
+@chat_bp.route(
+    route="admission/metrics", methods=[func.HttpMethod.GET], auth_level=func.AuthLevel.FUNCTION
+)
+async def admission_metrics(req: Request):
+    return JSONResponse(admission_stats())
@@ -0,0 +1,82 @@
+import azure.functions as func
+from azurefunctions.extensions.http.fastapi import Request, JSONResponse
+from core import diagnostics
+
+# Registered by function_app only when DIAGNOSTICS_ENABLED is "true"; the
+# routes need the host's master key. Allocation tracing runs from a "start"
+# until a "stop", and only costs anything in between.
+diagnostics_bp = func.Blueprint()
+
+DEFAULT_TRACEMALLOC_FRAMES = 10
+
+
+def _int_param(req: Request, name: str, default: int) -> int:
+    try:
+        return max(int(req.query_params.get(name, default)), 1)
+    except ValueError:
+        return default
+
+
+@diagnostics_bp.route(
+    route="diagnostics/memory", methods=[func.HttpMethod.GET], auth_level=func.AuthLevel.ADMIN
+)
+async def diagnostics_memory(req: Request) -> JSONResponse:
+    from blueprints.http_sk import sessions
+
+    return JSONResponse({
+        **diagnostics.memory(),
+        **diagnostics.clients(),
+        "sk_demo_sessions": sessions.stats(),
+    })
+
+
+@diagnostics_bp.route(
+    route="diagnostics/tracemalloc", methods=[func.HttpMethod.POST], auth_level=func.AuthLevel.ADMIN
+)
+async def diagnostics_tracemalloc(req: Request) -> JSONResponse:
+    """Runs `action` (start, baseline or stop) on the allocation tracer."""
+    action = req.query_params.get("action")
+    try:
+        if action == "start":
+            status = diagnostics.start_tracing(
+                _int_param(req, "frames", DEFAULT_TRACEMALLOC_FRAMES)
+            )
+        elif action == "baseline":
+            status = await diagnostics.take_baseline()
+        elif action == "stop":
+            status = diagnostics.stop_tracing()
+        else:
+            return JSONResponse(
+                {"message": "`action` must be start, baseline or stop"}, status_code=400
+            )
+    except RuntimeError as e:
+        return JSONResponse({"message": str(e)}, status_code=409)
+    return JSONResponse(status)
+
+
+@diagnostics_bp.route(
+    route="diagnostics/tracemalloc/diff", methods=[func.HttpMethod.GET], auth_level=func.AuthLevel.ADMIN
+)
+async def diagnostics_tracemalloc_diff(req: Request) -> JSONResponse:
+    try:
+        report = await diagnostics.diff(
+            top=_int_param(req, "top", 25),
+            group_by=req.query_params.get("group_by", "lineno"),
+        )
+    except ValueError as e:
+        return JSONResponse({"message": str(e)}, status_code=400)
+    except RuntimeError as e:
+        return JSONResponse({"message": str(e)}, status_code=409)
+    return JSONResponse(report)
+
+
+@diagnostics_bp.route(
+    route="diagnostics/tasks", methods=[func.HttpMethod.GET], auth_level=func.AuthLevel.ADMIN
+)
+async def diagnostics_tasks(req: Request) -> JSONResponse:
+    return JSONResponse(
+        diagnostics.tasks(
+            stacks=req.query_params.get("stacks", "false").lower() == "true",
+            limit=_int_param(req, "limit", 50),
+        )
+    )
@@ -6,16 +6,14 @@ from azure.search.documents import SearchClient
 from azure.search.documents._generated.models import VectorQuery, VectorizableTextQuery
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
-    HnswParameters,
     SearchIndex,
     SearchFieldDataType,
     SimpleField,
     SearchField,
-    VectorSearch,
-    HnswAlgorithmConfiguration,
-    VectorSearchProfile,
 )
 from azure.identity import DefaultAzureCredential
+from core.embeddings import embedding_settings
+from core.search_index import get_profile, vector_search
 from services.azure_openai_service import AzureOpenAIService
 
 simple_search_bp = func.Blueprint()
@@ -36,7 +34,9 @@ def emb(req: func.HttpRequest) -> func.HttpResponse:
 
     embedding = (
         openai_service.client.embeddings.create(
-            input="hello, world", model="text-embedding-3-small"
+            input="hello, world",
+            model=embedding_settings.model,
+            **embedding_settings.request_options(),
         )
         .data[0]
         .embedding
@@ -65,6 +65,7 @@ def create_index(req: func.HttpRequest):
     if req.params.get("name"):
         logging.info(f"Hi {req.params.get('name')}")
     try:
+        profile = get_profile(req.params.get("profile"))
         sample_index = SearchIndex(
             name="tiny_vectors",
             fields=[
@@ -77,22 +78,10 @@ def create_index(req: func.HttpRequest):
                     type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
                     searchable=True,
                     vector_search_dimensions=3,
-                    vector_search_profile_name="v_profile",
+                    vector_search_profile_name=profile.name,
                 ),
             ],
-            vector_search=VectorSearch(
-                algorithms=[
-                    HnswAlgorithmConfiguration(
-                        name="algo",
-                        parameters=HnswParameters(metric="cosine"),
-                    )
-                ],
-                profiles=[
-                    VectorSearchProfile(
-                        name="v_profile", algorithm_configuration_name="algo"
-                    )
-                ],
-            ),
+            vector_search=vector_search(profile),
         )
 
         result = search_index_client.create_index(index=sample_index)
@@ -143,7 +132,9 @@ def hotel_search_post(req: func.HttpRequest):
             top=10,
             vector_queries=[
                 VectorizableTextQuery(
-                    text=question, k_nearest_neighbors=5, fields="text_vector"
+                    text=question,
+                    k_nearest_neighbors=5,
+                    fields=embedding_settings.vector_field,
                 )
             ],
         )
@@ -187,7 +178,9 @@ def hotel_search(req: func.HttpRequest):
             top=10,
             vector_queries=[
                 VectorizableTextQuery(
-                    text=question, k_nearest_neighbors=5, fields="text_vector"
+                    text=question,
+                    k_nearest_neighbors=5,
+                    fields=embedding_settings.vector_field,
                 )
             ],
         )
@@ -1,39 +1,63 @@
 import os
-import base64
 import azure.functions as func
 from typing import cast
+from contextlib import AsyncExitStack
 from azurefunctions.extensions.http.fastapi import (
     Request,
-    StreamingResponse,
     JSONResponse,
 )
 
 from fastapi import UploadFile
-from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
-from semantic_kernel.contents import ChatMessageContent, TextContent, ImageContent
-from semantic_kernel.contents.utils.author_role import AuthorRole
-from semantic_kernel.connectors.ai.function_choice_behavior import (
-    FunctionChoiceBehavior,
-)
-from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_prompt_execution_settings import (
-    AzureChatPromptExecutionSettings,
-)
 
 from sk.utils import (
     initialize_semantic_kernel,
     initialize_search_index_client,
     initialize_store,
     initialize_chat_history,
+    ensure_chat_history_collection,
+    warm_up_connections,
 )
-from utils import collect_and_stream
+from utils import collect_and_stream, llm_error_response
+from core.uploads import image_data_uri, UploadTooLargeError, UploadCapacityError
+from core.startup import AsyncLazy, register_warm_up
+from core.telemetry import server_timing, stage
+from core.sse import resumable, sse_response
+from core.openai_pool import session_affinity
+from core.traffic_recorder import recorded, annotate_traffic
+from core.admission import admitted
+from core.resilience import deadline
+from core.usage import downgraded, metered
 
 
 bp = func.Blueprint()
 
 
-search_index_client = initialize_search_index_client()
-kernel = initialize_semantic_kernel(search_index_client=search_index_client)
-store = initialize_store(search_index_client=search_index_client)
+async def _initialize_kernel():
+    return initialize_semantic_kernel(
+        search_index_client=await lazy_search_index_client.get()
+    )
+
+
+async def _initialize_store():
+    return initialize_store(search_index_client=await lazy_search_index_client.get())
+
+
+lazy_search_index_client = AsyncLazy(
+    "semantic_kernel_chat.search_index_client", initialize_search_index_client
+)
+lazy_kernel = AsyncLazy("semantic_kernel_chat.kernel", _initialize_kernel)
+lazy_store = AsyncLazy("semantic_kernel_chat.store", _initialize_store)
+
+
+@register_warm_up
+async def warm_up_semantic_kernel_chat() -> None:
+    store = await lazy_store.get()
+    await warm_up_connections(
+        search_index_client=await lazy_search_index_client.get(),
+        kernel=await lazy_kernel.get(),
+    )
+    await ensure_chat_history_collection(store=store)
+
 
 GPT4OMINI_SERVICE_ID = "gp4omini_chat"
 GPT4O_SERVICE_ID = "gp4o_chat"
@@ -44,15 +68,44 @@ GPT4O_SERVICE_ID = "gp4o_chat"
     methods=[func.HttpMethod.POST],
     auth_level=func.AuthLevel.ANONYMOUS,
 )
+@server_timing
+@resumable
+@recorded("semantic-kernel-chat")
+@metered("semantic-kernel-chat")
+@admitted("semantic-kernel-chat")
+@deadline("semantic-kernel-chat")
 async def semantic_kernel_chat(req: Request):
+    from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
+    from semantic_kernel.contents import ChatMessageContent, TextContent, ImageContent
+    from semantic_kernel.contents.utils.author_role import AuthorRole
+    from semantic_kernel.connectors.ai.function_choice_behavior import (
+        FunctionChoiceBehavior,
+    )
+    from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_prompt_execution_settings import (
+        AzureChatPromptExecutionSettings,
+    )
+    from sk.filters.tool_result_cache_filter import (
+        max_auto_invoke_attempts,
+        tool_turn,
+    )
+
+    uploads = AsyncExitStack()
     try:
+        kernel = await lazy_kernel.get()
+        store = await lazy_store.get()
         form_data = await req.form()
         prompt = cast(str, form_data.get("prompt"))
         file = cast(UploadFile, form_data.get("file"))
         session_id = req.headers["X-Chat-Session-Id"]
 
-        history = await initialize_chat_history(store=store)
-        history.set_session_info(session_id=session_id, user_id="user")
+        history = await initialize_chat_history(
+            store=store, session_id=session_id, user_id="user", query=prompt
+        )
+        annotate_traffic(
+            prompt=prompt,
+            history_length=len(history.messages),
+            image_bytes=(file.size or 0) if file else 0,
+        )
 
         chat_completion: AzureChatCompletion
         execution_settings: AzureChatPromptExecutionSettings
@@ -75,19 +128,22 @@ async def semantic_kernel_chat(req: Request):
 
         else:
 
+            # Sessions over their downgrade budget are answered by the smaller model.
+            service_id = GPT4OMINI_SERVICE_ID if downgraded() else GPT4O_SERVICE_ID
             chat_completion = cast(
-                AzureChatCompletion, kernel.get_service(GPT4O_SERVICE_ID)
+                AzureChatCompletion, kernel.get_service(service_id)
             )
             execution_settings = cast(
                 AzureChatPromptExecutionSettings,
-                kernel.get_prompt_execution_settings_from_service_id(GPT4O_SERVICE_ID),
+                kernel.get_prompt_execution_settings_from_service_id(service_id),
             )
-            file_content = await file.read()
-            encoded_image = base64.b64encode(file_content).decode("ascii")
             filename = file.filename
             file_extension: str = ""
             if filename:
                 file_extension = os.path.splitext(filename)[1].replace(".", "")
+            data_uri = await uploads.enter_async_context(
+                image_data_uri(file, mime_type=f"image/{file_extension}")
+            )
             history.add_message(
                 message=ChatMessageContent(
                     role=AuthorRole.USER,
@@ -98,21 +154,28 @@ async def semantic_kernel_chat(req: Request):
                             """
                         ),
                         ImageContent(
-                            data_uri=f"data:image/{file_extension};base64,{encoded_image}"
+                            data_uri=data_uri
                         ),
                     ],
                 )
             )
 
-        execution_settings.function_choice_behavior = FunctionChoiceBehavior.Auto()
-
-        response = chat_completion.get_streaming_chat_message_content(
-            kernel=kernel,
-            chat_history=history,
-            settings=execution_settings,
+        execution_settings.function_choice_behavior = FunctionChoiceBehavior.Auto(
+            maximum_auto_invoke_attempts=max_auto_invoke_attempts()
         )
+        execution_settings.parallel_tool_calls = True
 
-        response_stream, content = await collect_and_stream(response)
+        with tool_turn(session_id), session_affinity(session_id):
+            response = chat_completion.get_streaming_chat_message_content(
+                kernel=kernel,
+                chat_history=history,
+                settings=execution_settings,
+            )
+
+            with stage("llm", model=chat_completion.ai_model_id):
+                response_stream, content = await collect_and_stream(
+                    response, model=chat_completion.ai_model_id
+                )
 
         history.add_message(
             message=ChatMessageContent(role=AuthorRole.ASSISTANT, content=content)
@@ -120,6 +183,16 @@ async def semantic_kernel_chat(req: Request):
         await history.store_messages()
         await history.reduce()
 
-        return StreamingResponse(response_stream, media_type="text/event-stream")
+        return sse_response(response_stream)
+    except UploadTooLargeError as e:
+        return JSONResponse({"error": str(e)}, status_code=413)
+    except UploadCapacityError as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return llm_error_response(e) or JSONResponse({"error": str(e)}, status_code=500)
+    finally:
+        await uploads.aclose()
@@ -1,198 +1,136 @@
 import os
-import logging
-import base64
-from pydantic import BaseModel
+import uuid
 import azure.functions as func
-from azurefunctions.extensions.http.fastapi import Request, StreamingResponse, JSONResponse
-from semantic_kernel import Kernel
-from semantic_kernel.connectors.ai.open_ai import (
-    AzureChatCompletion,
-    AzureTextEmbedding,
+from azurefunctions.extensions.http.fastapi import Request, JSONResponse
+from contextlib import AsyncExitStack
+from core.uploads import image_data_uri, UploadTooLargeError, UploadCapacityError
+from core.startup import AsyncLazy, register_warm_up
+from core.telemetry import server_timing, stage
+from core.sse import resumable, sse_response
+from core.openai_pool import session_affinity
+from core.traffic_recorder import recorded, annotate_traffic
+from core.admission import admitted
+from core.resilience import deadline
+from core.usage import downgraded, meter_session, metered
+from core.session_store import BoundedSessionStore
+from sk.utils import (
+    get_openai_client,
+    initialize_search_index_client,
+    warm_up_connections,
 )
-from azure.identity import ManagedIdentityCredential, AzureCliCredential, get_bearer_token_provider
-from semantic_kernel.contents import ChatHistory
-from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_prompt_execution_settings import (
-    AzureChatPromptExecutionSettings,
-)
-from semantic_kernel.contents import ChatMessageContent, TextContent, ImageContent
-from semantic_kernel.contents.utils.author_role import AuthorRole
-from azure.search.documents.indexes.aio import SearchIndexClient
-from pydantic import PrivateAttr
-from semantic_kernel.functions import kernel_function
-from typing import Annotated
-from azure.search.documents._generated.models import (
-    QueryType,
-    VectorQuery,
-    VectorizableTextQuery,
-)
-from semantic_kernel.connectors.ai.function_choice_behavior import (
-    FunctionChoiceBehavior,
-)
-import asyncio
+from utils import collect_and_stream, llm_error_response
 
 bp = func.Blueprint()
 
 
-async def collect_and_stream(response):
-    content = ""
+SYSTEM_MESSAGE = """"
+        You are a customer support assistant responsible for recommending hotels based on customer queries.
+        When the question is not clear. generate a standalone question. When a user asks for a hotel recommendation, you must reply with accuracy using the HotelVectorSearch plugin. Each object contains key details such as the hotel name, category, city, state, and description. Your task is to:
 
-    queue = asyncio.Queue()
+        - Use the `description` field from the list of objects to understand the features and amenities of each hotel.
+        - Summarize your answer based on the description.
+        - Format the hotel suggestions into a clear, concise, and user-friendly response.
+        - Present the information in a way that is easy for the customer to understand, emphasizing the details that are most relevant to their query (such as location, category, and description).
+        - If the customer's question is unclear, ask follow-up questions to gather more details about their preferences, such as location, budget, or amenities.
+        - **Do not answer any questions that are not related to hotels and outside the knowledge base. If it's a greeting greet them. If the question is not about hotels, politely inform the user that you can only assist with hotel-related inquiries.**
+    """
 
-    async def collect_content():
-        nonlocal content
-        async for chunk in response:
-            if chunk.content:
-                content += chunk.content
-                await queue.put(chunk.content)
 
-        await queue.put(None)
+async def _initialize_kernel():
+    from semantic_kernel import Kernel
+    from semantic_kernel.connectors.ai.open_ai import (
+        AzureChatCompletion,
+        AzureTextEmbedding,
+    )
+    from sk.plugins.hotel_vector_search_plugin import HotelVectorSearchPlugin
+    from sk.plugins.email_sender_plugin import EmailSenderPlugin
+    from semantic_kernel.filters import FilterTypes
+    from sk.filters.tool_result_cache_filter import tool_result_cache
+    from core.embeddings import embedding_settings
+
+    gpt_4o_service = AzureChatCompletion(
+        service_id="gpt4o",
+        deployment_name="gpt-4o",
+        endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+        async_client=get_openai_client(),
+        api_version=os.getenv("OPENAI_API_VERSION", ""),
+    )
 
-    async def stream_response():
-        while True:
-            chunk = await queue.get()
-            if chunk is None:
-                break
-            yield chunk
+    gpt_4o_mini_service = AzureChatCompletion(
+        service_id="gpt4omini",
+        deployment_name="gpt-4o-mini",
+        endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+        async_client=get_openai_client(),
+        api_version=os.getenv("OPENAI_API_VERSION", ""),
+    )
 
-    await collect_content()
+    embedding_service = AzureTextEmbedding(
+        service_id="embedding",
+        deployment_name=embedding_settings.model,
+        endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+        async_client=get_openai_client(),
+        api_version=os.getenv("OPENAI_API_VERSION", ""),
+    )
 
-    return stream_response(), content
+    kernel = Kernel()
+    kernel.add_service(gpt_4o_service)
+    kernel.add_service(gpt_4o_mini_service)
+    kernel.add_service(embedding_service)
+
+    kernel.add_plugin(
+        HotelVectorSearchPlugin(search_index_client=await lazy_search_index_client.get()),
+        plugin_name="HotelSearchPlugin")
+    kernel.add_plugin(
+        EmailSenderPlugin(),
+        plugin_name="EmailSender"
+    )
+    kernel.add_filter(
+        FilterTypes.FUNCTION_INVOCATION, tool_result_cache.on_function_invocation
+    )
+    return kernel
 
 
-def get_credential() -> ManagedIdentityCredential | AzureCliCredential:
-    client_id = os.getenv("AZURE_CLIENT_ID")
+def _initialize_chat_history():
+    from semantic_kernel.contents import ChatHistory
 
-    if client_id:
-        return ManagedIdentityCredential(client_id=client_id)
+    return ChatHistory(system_message=SYSTEM_MESSAGE)
 
-    return AzureCliCredential()
 
+def _measure_chat_history(history) -> tuple[int, int]:
+    from sk.memory.chat_history_budget import measure_chat_history
 
-search_index_client = SearchIndexClient(
-    endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
-    credential=get_credential(),  # pyright: ignore
-)
+    return measure_chat_history(history)
 
-gpt_4o_service = AzureChatCompletion(
-    service_id="gpt4o",
-    deployment_name="gpt-4o",
-    endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-    ad_token_provider=get_bearer_token_provider(
-        get_credential(), "https://cognitiveservices.azure.com/.default"
-    ),
-    api_version=os.getenv("OPENAI_API_VERSION", ""),
-)
 
-gpt_4o_mini_service = AzureChatCompletion(
-    service_id="gpt4omini",
-    deployment_name="gpt-4o-mini",
-    endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-    ad_token_provider=get_bearer_token_provider(
-        get_credential(), "https://cognitiveservices.azure.com/.default"
-    ),
-    api_version=os.getenv("OPENAI_API_VERSION", ""),
-)
+def _trim_chat_history(history, max_tokens: int) -> int:
+    from sk.memory.chat_history_budget import trim_chat_history
 
-ada_embedding_service = AzureTextEmbedding(
-    service_id="ada_embedding",
-    deployment_name="text-embedding-ada-002",
-    endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-    ad_token_provider=get_bearer_token_provider(
-        get_credential(), "https://cognitiveservices.azure.com/.default"
-    ),
-    api_version=os.getenv("OPENAI_API_VERSION", ""),
-)
+    return trim_chat_history(history, max_tokens)
 
-chat_history = ChatHistory(
-    system_message=""""
-        You are a customer support assistant responsible for recommending hotels based on customer queries.
-        When the question is not clear. generate a standalone question. When a user asks for a hotel recommendation, you must reply with accuracy using the HotelVectorSearch plugin. Each object contains key details such as the hotel name, category, city, state, and description. Your task is to:
 
-        - Use the `description` field from the list of objects to understand the features and amenities of each hotel.
-        - Summarize your answer based on the description.
-        - Format the hotel suggestions into a clear, concise, and user-friendly response.
-        - Present the information in a way that is easy for the customer to understand, emphasizing the details that are most relevant to their query (such as location, category, and description).
-        - If the customer's question is unclear, ask follow-up questions to gather more details about their preferences, such as location, budget, or amenities.
-        - **Do not answer any questions that are not related to hotels and outside the knowledge base. If it's a greeting greet them. If the question is not about hotels, politely inform the user that you can only assist with hotel-related inquiries.**
-    """
+lazy_search_index_client = AsyncLazy(
+    "sk_demo.search_index_client", initialize_search_index_client
 )
+lazy_kernel = AsyncLazy("sk_demo.kernel", _initialize_kernel)
 
+SESSION_HEADER = "X-Chat-Session-Id"
 
-class HotelSearchPlugin:
-    def __init__(self, search_index_client: SearchIndexClient) -> None:
-        self._search_index_client = search_index_client
+sessions = BoundedSessionStore(
+    factory=_initialize_chat_history,
+    measure=_measure_chat_history,
+    trim=_trim_chat_history,
+    max_sessions=int(os.getenv("SK_DEMO_MAX_SESSIONS", "1000")),
+    idle_ttl=float(os.getenv("SK_DEMO_SESSION_TTL_SECONDS", "1800")),
+    max_tokens_per_session=int(os.getenv("SK_DEMO_MAX_SESSION_TOKENS", "8000")),
+)
 
-    @kernel_function(
-        name="search", description="Search for documents similar to the given query."
-    )
-    async def search(
-        self,
-        query: Annotated[str, "Query to be used for searching"],
-    ) -> list[dict]:
-        """Search for documents similar to the given query."""
-        try:
-            vector_queries: list[VectorQuery] | None = [
-                VectorizableTextQuery(
-                    text=query, k_nearest_neighbors=10, fields="text_vector"
-                )
-            ]
-
-            query_args = {
-                "search_text": query,
-                "vector_queries": vector_queries,
-                "query_type": QueryType.SEMANTIC,
-                "semantic_configuration_name": os.environ[
-                    "SEMANTIC_CONFIGURATION_NAME"
-                ],
-            }
-
-            search_client = self._search_index_client.get_search_client(
-                index_name=os.environ["AZURE_AI_SEARCH_INDEX_NAME"]
-            )
 
-            async with search_client:  # pyright: ignore
-                # pyright: ignore
-                results = await search_client.search(**query_args)
-                hotels: list[dict] = []
-
-                async for result in results:
-                    hotels.append(
-                        {
-                            "id": result["Id"],
-                            "hotelName": result["HotelName"],
-                            "category": result["Category"],
-                            "city": result["City"],
-                            "state": result["State"],
-                            "description": result["chunk"],
-                        }
-                    )
-
-                return hotels
-
-        except Exception as e:
-            logging.error(f"Error in search: {e}")
-            return []
-
-
-class EmailSenderPlugin:
-    @kernel_function(
-        name="send_email", description="Send an email to the given email address."
+@register_warm_up
+async def warm_up_sk_demo() -> None:
+    await warm_up_connections(
+        search_index_client=await lazy_search_index_client.get(),
+        kernel=await lazy_kernel.get(),
     )
-    async def send_email(self, email: str, message: str):
-        return f"Email sent to {email} with message: {message}"
-
-kernel = Kernel()
-kernel.add_service(gpt_4o_service)
-kernel.add_service(gpt_4o_mini_service)
-kernel.add_service(ada_embedding_service)
-
-kernel.add_plugin(
-    HotelSearchPlugin(search_index_client=search_index_client),
-    plugin_name="HotelSearchPlugin")
-kernel.add_plugin(
-    EmailSenderPlugin(),
-    plugin_name="EmailSender"
-)
 
 
 @bp.route(
@@ -200,11 +138,41 @@ kernel.add_plugin(
     methods=[func.HttpMethod.POST],
     auth_level=func.AuthLevel.ANONYMOUS
 )
+@server_timing
+@resumable
+@recorded("sk-demo")
+@metered("sk-demo")
+@admitted("sk-demo")
+@deadline("sk-demo")
 async def sk_demo(req: Request) -> JSONResponse:
+    from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
+    from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_prompt_execution_settings import (
+        AzureChatPromptExecutionSettings,
+    )
+    from semantic_kernel.contents import ChatMessageContent, TextContent, ImageContent
+    from semantic_kernel.contents.utils.author_role import AuthorRole
+    from semantic_kernel.connectors.ai.function_choice_behavior import (
+        FunctionChoiceBehavior,
+    )
+    from sk.filters.tool_result_cache_filter import (
+        max_auto_invoke_attempts,
+        tool_turn,
+    )
+
+    request_scope = AsyncExitStack()
     try:
+        kernel = await lazy_kernel.get()
+        session_id = req.headers.get(SESSION_HEADER) or str(uuid.uuid4())
+        meter_session(session_id)
+        chat_history = await request_scope.enter_async_context(sessions.session(session_id))
         form_data = await req.form()
         prompt = form_data.get("prompt")
         file = form_data.get("file")
+        annotate_traffic(
+            prompt=prompt,
+            history_length=len(chat_history.messages),
+            image_bytes=(file.size or 0) if file else 0,
+        )
 
         response: ChatMessageContent
         execution_settings: AzureChatPromptExecutionSettings
@@ -223,17 +191,20 @@ async def sk_demo(req: Request) -> JSONResponse:
             )
 
         else:
+            # Sessions over their downgrade budget are answered by the smaller model.
+            service_id = "gpt4omini" if downgraded() else "gpt4o"
             chat_completion: AzureChatCompletion = kernel.get_service(
-                service_id="gpt4o")
+                service_id=service_id)
             execution_settings = kernel.get_prompt_execution_settings_from_service_id(
-                service_id="gpt4o")
+                service_id=service_id)
 
-            file_content = await file.read()
-            encoded_image = base64.b64encode(file_content).decode("ascii")
             filename = file.filename
             file_extension: str = ""
             if filename:
                 file_extension = os.path.splitext(filename)[1].replace(".", "")
+            data_uri = await request_scope.enter_async_context(
+                image_data_uri(file, mime_type=f"image/{file_extension}")
+            )
 
             chat_history.add_message(
                 message=ChatMessageContent(
@@ -245,23 +216,49 @@ async def sk_demo(req: Request) -> JSONResponse:
                             """
                         ),
                         ImageContent(
-                            data_uri=f"data:image/{file_extension};base64,{encoded_image}"
+                            data_uri=data_uri
                         ),
                     ],
                 )
             )
 
-        execution_settings.function_choice_behavior = FunctionChoiceBehavior.Auto()
-        response = chat_completion.get_streaming_chat_message_content(
-            kernel=kernel,
-            chat_history=chat_history,
-            settings=execution_settings,
+        execution_settings.function_choice_behavior = FunctionChoiceBehavior.Auto(
+            maximum_auto_invoke_attempts=max_auto_invoke_attempts()
         )
-        response_stream, content = await collect_and_stream(response)
+        execution_settings.parallel_tool_calls = True
+        with tool_turn(session_id), session_affinity(session_id):
+            response = chat_completion.get_streaming_chat_message_content(
+                kernel=kernel,
+                chat_history=chat_history,
+                settings=execution_settings,
+            )
+            with stage("llm", model=chat_completion.ai_model_id):
+                response_stream, content = await collect_and_stream(
+                    response, model=chat_completion.ai_model_id
+                )
         chat_history.add_message(
             message=ChatMessageContent(
                 role=AuthorRole.ASSISTANT, content=content)
         )
-        return StreamingResponse(response_stream, media_type="text/event-stream")
+        return sse_response(response_stream, headers={SESSION_HEADER: session_id})
+    except UploadTooLargeError as e:
+        return JSONResponse({"message": str(e)}, status_code=413)
+    except UploadCapacityError as e:
+        return JSONResponse(
+            {"message": str(e)},
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except Exception as e:
-        return JSONResponse({"message": str(e)})
+        return llm_error_response(e) or JSONResponse({"message": str(e)})
+    finally:
+        await request_scope.aclose()
+
+
+@bp.route(
+    route="sk-demo/metrics",
+    methods=[func.HttpMethod.GET],
+    auth_level=func.AuthLevel.FUNCTION
+)
+async def sk_demo_metrics(req: Request) -> JSONResponse:
+    return JSONResponse(sessions.stats())
@@ -0,0 +1,292 @@
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+import functools
+from collections import deque
+from typing import Any, AsyncIterator, Callable
+
+from azurefunctions.extensions.http.fastapi import JSONResponse
+
+from core.telemetry import counter, histogram, register_gauge, stage
+
+DEFAULTS = {
+    "limit": 16,
+    "min_limit": 2,
+    "max_limit": 64,
+    "queue": 32,
+    "queue_timeout": 5.0,
+    "target_ms": 5000.0,
+}
+
+# Multiplicative decrease applied when a response is slow or an upstream refused it.
+BACKOFF = 0.7
+LATENCY_SMOOTHING = 0.1
+
+_queue_time = histogram(
+    "app.admission.queue_time", unit="ms", description="Time a request waited for admission"
+)
+_rejections = counter(
+    "app.admission.rejections", unit="{request}", description="Requests rejected with 429"
+)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("The service is busy, please try again shortly.")
+        self.retry_after = retry_after
+
+
+class _Slot:
+    """One admitted request; released exactly once, even if its stream is never consumed."""
+
+    def __init__(self, controller: "AdmissionController") -> None:
+        self._controller = controller
+        self._start = time.perf_counter()
+        self.released = False
+
+    def release(self, latency_ms: float | None = None, failed: bool = False) -> None:
+        """Frees the slot and feeds its latency, or failure, to the adaptive limit."""
+        if self.released:
+            return
+        self.released = True
+        if latency_ms is None:
+            latency_ms = (time.perf_counter() - self._start) * 1000
+        self._controller._release(latency_ms, failed)
+
+    def abandon(self) -> None:
+        """Frees the slot without judging the upstream, e.g. when the client went away."""
+        if not self.released:
+            self.released = True
+            self._controller._release(None, False)
+
+    def __del__(self) -> None:
+        self.abandon()
+
+
+class AdmissionController:
+    """Caps the requests one worker serves on a route at once.
+
+    Requests beyond the limit wait in a bounded FIFO queue for at most
+    `queue_timeout` seconds; a full queue or an expired wait is rejected.
+    The limit grows by one per limit's worth of responses faster than
+    `target_ms` to first byte and shrinks by BACKOFF, at most once per
+    target interval, when a response is slower or fails upstream.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: float,
+        min_limit: float,
+        max_limit: float,
+        queue: int,
+        queue_timeout: float,
+        target_ms: float,
+    ) -> None:
+        self.name = name
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue
+        self.queue_timeout = queue_timeout
+        self.target_ms = target_ms
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.latency_ms = 0.0
+        self._last_decrease = 0.0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    def retry_after(self) -> int:
+        service_seconds = (self.latency_ms or self.target_ms) / 1000
+        backlog = (len(self._waiters) + 1) / max(self.limit, 1.0)
+        return max(1, min(30, math.ceil(service_seconds * backlog)))
+
+    def _reject(self) -> AdmissionRejected:
+        self.rejected += 1
+        _rejections(1, {"route": self.name})
+        return AdmissionRejected(retry_after=self.retry_after())
+
+    async def acquire(self) -> _Slot:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            _queue_time(0.0, {"route": self.name})
+            return _Slot(self)
+
+        if len(self._waiters) >= self.queue_size:
+            raise self._reject()
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        start = time.perf_counter()
+        try:
+            with stage("admission-queue"):
+                await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                raise self._reject()
+        except asyncio.CancelledError:
+            if not future.cancel():
+                self._release(None, False)
+            raise
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+        _queue_time((time.perf_counter() - start) * 1000, {"route": self.name})
+        self.admitted += 1
+        return _Slot(self)
+
+    def _release(self, latency_ms: float | None, failed: bool) -> None:
+        self.in_flight -= 1
+        if latency_ms is not None:
+            self._adapt(latency_ms, failed)
+        self._wake()
+
+    def _adapt(self, latency_ms: float, failed: bool) -> None:
+        if self.latency_ms:
+            self.latency_ms += LATENCY_SMOOTHING * (latency_ms - self.latency_ms)
+        else:
+            self.latency_ms = latency_ms
+        now = time.monotonic()
+        if failed or latency_ms > self.target_ms:
+            if now - self._last_decrease >= self.target_ms / 1000:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * BACKOFF)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "latency_ms": self.latency_ms,
+        }
+
+
+def _load_config() -> dict[str, dict[str, Any]]:
+    raw = os.getenv("ADMISSION_LIMITS")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        logging.error("ADMISSION_LIMITS is not valid JSON, ignoring it.")
+        return {}
+
+
+_config = _load_config()
+_controllers: dict[str, AdmissionController] = {}
+
+
+def controller_for(route: str) -> AdmissionController:
+    controller = _controllers.get(route)
+    if controller is None:
+        settings = {**DEFAULTS, **_config.get("*", {}), **_config.get(route, {})}
+        controller = _controllers[route] = AdmissionController(name=route, **settings)
+    return controller
+
+
+def admission_stats() -> dict:
+    return {name: controller.stats() for name, controller in _controllers.items()}
+
+
+register_gauge(
+    "app.admission.in_flight",
+    unit="{request}",
+    description="Requests holding an admission slot",
+    observe=lambda: [
+        (controller.in_flight, {"route": name}) for name, controller in _controllers.items()
+    ],
+)
+register_gauge(
+    "app.admission.limit",
+    unit="{request}",
+    description="Current adaptive concurrency limit",
+    observe=lambda: [
+        (controller.limit, {"route": name}) for name, controller in _controllers.items()
+    ],
+)
+
+
+async def _release_after(body: AsyncIterator[Any], slot: _Slot, start: float) -> AsyncIterator[Any]:
+    first_byte: float | None = None
+    try:
+        async for chunk in body:
+            if first_byte is None:
+                first_byte = (time.perf_counter() - start) * 1000
+            yield chunk
+    except GeneratorExit:
+        slot.abandon()
+        raise
+    finally:
+        slot.release(latency_ms=first_byte)
+
+
+def mark_overloaded(response: Any) -> Any:
+    """Marks `response` as passing on an upstream's refusal, e.g. a model's 429.
+
+    Only marked responses count as failures for the adaptive limit; errors
+    the app produces itself, however they are answered, do not.
+    """
+    response.upstream_overloaded = True
+    return response
+
+
+def admitted(route: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Runs the decorated handler under the route's AdmissionController.
+
+    The slot is held until a streamed body has been sent, and the time to
+    its first chunk drives the adaptive limit, as do responses marked with
+    `mark_overloaded`. Rejections return 429 with Retry-After.
+    """
+
+    def decorator(handler: Callable[..., Any]) -> Callable[..., Any]:
+        controller = controller_for(route)
+
+        @functools.wraps(handler)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            try:
+                slot = await controller.acquire()
+            except AdmissionRejected as e:
+                return JSONResponse(
+                    {"message": str(e)},
+                    status_code=429,
+                    headers={"Retry-After": str(e.retry_after)},
+                )
+
+            start = time.perf_counter()
+            try:
+                response = await handler(*args, **kwargs)
+            except Exception:
+                slot.release()
+                raise
+            except BaseException:
+                slot.abandon()
+                raise
+
+            if getattr(response, "upstream_overloaded", False):
+                slot.release(failed=True)
+            elif hasattr(response, "body_iterator"):
+                response.body_iterator = _release_after(response.body_iterator, slot, start)
+            else:
+                slot.release()
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+from core.resp import RespClient
+from core.singleflight import SingleFlight, fingerprint
+from core.telemetry import register_gauge
+
+T = TypeVar("T")
+
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "hotels")
+CACHE_REDIS_TIMEOUT_SECONDS = float(os.getenv("CACHE_REDIS_TIMEOUT_SECONDS", "0.25"))
+CACHE_REDIS_MAX_CONNECTIONS = int(os.getenv("CACHE_REDIS_MAX_CONNECTIONS", "16"))
+# How long L2 is bypassed after it fails, so a cache outage costs one timeout, not one per request.
+CACHE_REDIS_RETRY_SECONDS = float(os.getenv("CACHE_REDIS_RETRY_SECONDS", "10"))
+COMPRESS_MIN_BYTES = 512
+
+# Format byte in front of every L2 value.
+_JSON = b"\x01"
+_JSON_ZLIB = b"\x02"
+
+
+def dumps(value: Any) -> bytes:
+    """Compact JSON, zlib-compressed when large, behind a one-byte format marker.
+
+    Only JSON data is accepted, never pickles: a value read from a shared
+    server must not be able to run code in the reader.
+    """
+    data = json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    if len(data) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return _JSON_ZLIB + compressed
+    return _JSON + data
+
+
+def loads(data: bytes) -> Any:
+    marker, body = data[:1], data[1:]
+    if marker == _JSON_ZLIB:
+        body = zlib.decompress(body)
+    elif marker != _JSON:
+        raise ValueError(f"Unknown cache value format {marker!r}")
+    return json.loads(body)
+
+
+@dataclass(frozen=True)
+class CacheSettings:
+    """`ttl` applies to L2; `l1_ttl` (default `ttl`) bounds how stale a local copy may be.
+
+    Values another instance may rewrite under the same key should use a
+    short or zero `l1_ttl`; state that is read, changed and written back,
+    such as chat history, must not be cached at all, since a failed write
+    to L2 leaves the old value there. `lock_seconds` is how long other instances wait
+    for the one loading a missing key before loading it themselves. Local
+    copies stay readable through `get_stale` for `stale_seconds` after they
+    expire, as a fallback while the source is down.
+    """
+
+    ttl: float
+    l1_ttl: float | None = None
+    l1_entries: int = 1000
+    lock_seconds: float = 5.0
+    stale_seconds: float = 0.0
+
+
+def _load_overrides() -> dict[str, dict]:
+    """Per-namespace overrides of CacheSettings from CACHE_NAMESPACES (JSON)."""
+    raw = os.getenv("CACHE_NAMESPACES")
+    if not raw:
+        return {}
+    try:
+        overrides = json.loads(raw)
+        if not isinstance(overrides, dict):
+            raise ValueError("expected an object of namespaces")
+        return overrides
+    except ValueError as e:
+        logging.error(f"CACHE_NAMESPACES is invalid, ignoring it: {e}")
+        return {}
+
+
+_overrides = _load_overrides()
+_l2: RespClient | None = None
+_l2_down_until = 0.0
+
+
+def _shared_client() -> RespClient | None:
+    global _l2
+    if _l2 is None and CACHE_REDIS_URL:
+        try:
+            _l2 = RespClient(
+                CACHE_REDIS_URL,
+                max_connections=CACHE_REDIS_MAX_CONNECTIONS,
+                timeout=CACHE_REDIS_TIMEOUT_SECONDS,
+            )
+        except ValueError as e:
+            logging.error(f"CACHE_REDIS_URL is invalid, using the local cache only: {e}")
+    return _l2
+
+
+class NamespaceCache:
+    """One named cache: an in-process LRU (L1) in front of the shared server (L2).
+
+    Without CACHE_REDIS_URL only L1 is used. Loads of a missing key are
+    deduplicated within the worker by a single-flight group and across
+    instances by a short lock key in L2, so an expired hot key costs one
+    upstream call rather than one per instance and request. L2 errors are
+    logged and L2 is skipped for CACHE_REDIS_RETRY_SECONDS; the cache never
+    fails a request.
+    """
+
+    def __init__(self, name: str, settings: CacheSettings) -> None:
+        self.name = name
+        self.settings = settings
+        self.l1_ttl = settings.ttl if settings.l1_ttl is None else settings.l1_ttl
+        self.counts = {
+            "l1_hit": 0, "l2_hit": 0, "stale_hit": 0, "miss": 0, "load": 0, "l2_error": 0,
+        }
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._flight = SingleFlight(f"cache.{name}", grace=0)
+
+    def _key(self, key: Hashable) -> str:
+        if not isinstance(key, str) or len(key) > 200:
+            key = fingerprint(key)
+        return f"{CACHE_KEY_PREFIX}:{self.name}:{key}"
+
+    def _l1_get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        now = time.monotonic()
+        if expires < now:
+            if expires + self.settings.stale_seconds < now:
+                del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _l1_put(self, key: str, value: Any) -> None:
+        if self.l1_ttl <= 0 or self.settings.l1_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.l1_ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.settings.l1_entries:
+            self._entries.popitem(last=False)
+
+    async def _l2_call(self, call: Callable[[RespClient], Awaitable[T]]) -> T | None:
+        global _l2_down_until
+        client = _shared_client()
+        if client is None or time.monotonic() < _l2_down_until:
+            return None
+        try:
+            return await call(client)
+        except Exception as e:
+            self.counts["l2_error"] += 1
+            _l2_down_until = time.monotonic() + CACHE_REDIS_RETRY_SECONDS
+            logging.warning(f"Shared cache unavailable, using the local cache only: {e!r}")
+            return None
+
+    async def _l2_get(self, key: str) -> Any | None:
+        data = await self._l2_call(lambda client: client.get(key))
+        if data is None:
+            return None
+        try:
+            return loads(data)
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable cache entry {key}: {e}")
+            return None
+
+    async def get(self, key: Hashable) -> Any | None:
+        """The cached value, or None."""
+        full_key = self._key(key)
+        value = self._l1_get(full_key)
+        if value is not None:
+            self.counts["l1_hit"] += 1
+            return value
+        value = await self._l2_get(full_key)
+        if value is not None:
+            self.counts["l2_hit"] += 1
+            self._l1_put(full_key, value)
+            return value
+        self.counts["miss"] += 1
+        return None
+
+    def get_stale(self, key: Hashable) -> Any | None:
+        """The local copy of `key`, even if it expired less than `stale_seconds` ago."""
+        entry = self._entries.get(self._key(key))
+        if entry is None or entry[0] + self.settings.stale_seconds < time.monotonic():
+            return None
+        self.counts["stale_hit"] += 1
+        return entry[1]
+
+    async def set(self, key: Hashable, value: Any) -> None:
+        """Stores a JSON-serializable value in both levels; None is never cached."""
+        if value is not None:
+            await self._store(self._key(key), value)
+
+    async def _store(self, full_key: str, value: Any) -> None:
+        self._l1_put(full_key, value)
+        try:
+            data = dumps(value)
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Not sharing an unserializable {self.name} cache value: {e}")
+            return
+        await self._l2_call(
+            lambda client: client.set(full_key, data, ttl_ms=int(self.settings.ttl * 1000))
+        )
+
+    async def delete(self, key: Hashable) -> None:
+        full_key = self._key(key)
+        self._entries.pop(full_key, None)
+        await self._l2_call(lambda client: client.delete(full_key))
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        load: Callable[[], Awaitable[T]],
+        cacheable: Callable[[T], bool] = lambda value: value is not None,
+    ) -> T:
+        """The cached value, or the result of `load`, stored when `cacheable` accepts it.
+
+        Callers must treat the value as read-only; it is shared with every
+        other caller of the same key.
+        """
+        full_key = self._key(key)
+        value = self._l1_get(full_key)
+        if value is not None:
+            self.counts["l1_hit"] += 1
+            return value
+        return await self._flight.do(full_key, lambda: self._fill(full_key, load, cacheable))
+
+    async def _fill(
+        self,
+        full_key: str,
+        load: Callable[[], Awaitable[T]],
+        cacheable: Callable[[T], bool],
+    ) -> T:
+        value = await self._l2_get(full_key)
+        if value is not None:
+            self.counts["l2_hit"] += 1
+            self._l1_put(full_key, value)
+            return value
+
+        lock_key = f"{full_key}:loading"
+        lock_ms = int(self.settings.lock_seconds * 1000)
+        locked = await self._l2_call(
+            lambda client: client.set(lock_key, b"1", ttl_ms=lock_ms, only_if_missing=True)
+        )
+        if locked is False:
+            # Another instance is loading this key; wait for its result instead of repeating the call.
+            deadline = time.monotonic() + self.settings.lock_seconds
+            delay = 0.02
+            while time.monotonic() < deadline:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.2)
+                value = await self._l2_get(full_key)
+                if value is not None:
+                    self.counts["l2_hit"] += 1
+                    self._l1_put(full_key, value)
+                    return value
+
+        self.counts["miss"] += 1
+        self.counts["load"] += 1
+        try:
+            value = await load()
+            if value is not None and cacheable(value):
+                await self._store(full_key, value)
+            return value
+        finally:
+            if locked:
+                await self._l2_call(lambda client: client.delete(lock_key))
+
+    def stats(self) -> dict:
+        return {
+            **self.counts,
+            "l1_entries": len(self._entries),
+            "ttl": self.settings.ttl,
+            "l1_ttl": self.l1_ttl,
+        }
+
+
+_caches: dict[str, NamespaceCache] = {}
+
+
+def cache(name: str, ttl: float, **settings: Any) -> NamespaceCache:
+    """The cache for namespace `name`; CACHE_NAMESPACES may override its settings.
+
+    For example CACHE_NAMESPACES='{"search.plugin": {"ttl": 900, "l1_ttl": 60}}'.
+    """
+    if name not in _caches:
+        configured = CacheSettings(ttl=ttl, **settings)
+        try:
+            configured = replace(configured, **_overrides.get(name, {}))
+        except TypeError as e:
+            logging.error(f"CACHE_NAMESPACES entry for {name} is invalid, ignoring it: {e}")
+        _caches[name] = NamespaceCache(name, configured)
+    return _caches[name]
+
+
+def cache_stats() -> dict:
+    return {
+        "shared": bool(_shared_client()),
+        "shared_available": time.monotonic() >= _l2_down_until,
+        "namespaces": {name: namespace.stats() for name, namespace in _caches.items()},
+    }
+
+
+register_gauge(
+    "app.cache.requests",
+    unit="{request}",
+    description="Cache lookups by namespace and outcome",
+    observe=lambda: [
+        (count, {"namespace": name, "outcome": outcome})
+        for name, namespace in _caches.items()
+        for outcome, count in namespace.counts.items()
+    ],
+)
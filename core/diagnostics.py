@@ -0,0 +1,219 @@
+import os
+import io
+import gc
+import sys
+import asyncio
+import linecache
+import tracemalloc
+from collections import Counter
+from typing import Any
+
+# Clients whose live instances are counted, by module and class; the modules
+# are only looked up, never imported, so a client the app never loaded counts 0.
+CLIENT_TYPES = {
+    "openai": ["AsyncOpenAI", "AsyncAzureOpenAI", "OpenAI", "AzureOpenAI"],
+    "httpx": ["AsyncClient", "Client"],
+    "aiohttp": ["ClientSession"],
+    "azure.search.documents.aio": ["SearchClient"],
+    "azure.search.documents.indexes.aio": ["SearchIndexClient"],
+    "azure.identity.aio": ["DefaultAzureCredential", "ManagedIdentityCredential", "AzureCliCredential"],
+    "azure.identity": ["DefaultAzureCredential", "ManagedIdentityCredential", "AzureCliCredential"],
+    "semantic_kernel": ["Kernel"],
+    "semantic_kernel.connectors.ai.open_ai": ["AzureChatCompletion", "AzureTextEmbedding"],
+}
+# Allocations of the profiler itself and of imports are left out of snapshots.
+IGNORED_FILES = (tracemalloc.__file__, linecache.__file__, "<frozen importlib._bootstrap>", "<unknown>")
+
+_baseline: tracemalloc.Snapshot | None = None
+
+
+def _rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _open_sockets() -> int | None:
+    try:
+        descriptors = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    sockets = 0
+    for descriptor in descriptors:
+        try:
+            sockets += os.readlink(f"/proc/self/fd/{descriptor}").startswith("socket:")
+        except OSError:
+            pass
+    return sockets
+
+
+def _client_types() -> dict[type, str]:
+    types = {}
+    for module_name, names in CLIENT_TYPES.items():
+        module = sys.modules.get(module_name)
+        for name in names:
+            client_type = getattr(module, name, None)
+            if isinstance(client_type, type):
+                types[client_type] = f"{module_name}.{name}"
+    return types
+
+
+def _httpx_connections(client: Any) -> tuple[int, int]:
+    """(active, idle) connections of an httpx client's pool, looking through wrapping transports."""
+    transport = getattr(client, "_transport", None)
+    while transport is not None and not hasattr(transport, "_pool"):
+        transport = getattr(transport, "_transport", None)
+    pool = getattr(transport, "_pool", None)
+    connections = getattr(pool, "connections", [])
+    idle = sum(connection.is_idle() for connection in connections)
+    return len(connections) - idle, idle
+
+
+def _aiohttp_connections(session: Any) -> tuple[int, int]:
+    connector = getattr(session, "connector", None)
+    if connector is None:
+        return 0, 0
+    idle = sum(len(connections) for connections in getattr(connector, "_conns", {}).values())
+    return len(getattr(connector, "_acquired", ())), idle
+
+
+def _is_closed(client: Any) -> bool:
+    # httpx and aiohttp have a property, the OpenAI clients a method.
+    closed = getattr(client, "is_closed", getattr(client, "closed", False))
+    return bool(closed() if callable(closed) else closed)
+
+
+def clients() -> dict[str, Any]:
+    """Live SDK clients by type, with their open and pooled connections.
+
+    Clients created per request and never closed show up as a count that
+    keeps growing, and as open connections nobody uses.
+    """
+    types = _client_types()
+    report: dict[str, dict[str, int]] = {}
+    if types:
+        classes = tuple(types)
+        for obj in gc.get_objects():
+            # type() rather than isinstance(), which would load lazy module proxies.
+            obj_type = type(obj)
+            if not issubclass(obj_type, classes):
+                continue
+            name = next(name for client_type, name in types.items() if issubclass(obj_type, client_type))
+            entry = report.setdefault(name, {"live": 0, "closed": 0, "active": 0, "idle": 0})
+            entry["live"] += 1
+            if _is_closed(obj):
+                entry["closed"] += 1
+            if name.startswith("httpx."):
+                active, idle = _httpx_connections(obj)
+            elif name.startswith("aiohttp."):
+                active, idle = _aiohttp_connections(obj)
+            else:
+                continue
+            entry["active"] += active
+            entry["idle"] += idle
+    return {"clients": report, "open_sockets": _open_sockets()}
+
+
+def memory() -> dict[str, Any]:
+    return {
+        "rss_bytes": _rss_bytes(),
+        "gc_counts": gc.get_count(),
+        "gc_objects": len(gc.get_objects()),
+        "tracemalloc": tracemalloc_status(),
+    }
+
+
+def tracemalloc_status() -> dict[str, Any]:
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": True,
+        "frames": tracemalloc.get_traceback_limit(),
+        "traced_bytes": current,
+        "peak_traced_bytes": peak,
+        "overhead_bytes": tracemalloc.get_tracemalloc_memory(),
+        "baseline": _baseline is not None,
+    }
+
+
+def start_tracing(frames: int) -> dict[str, Any]:
+    """Starts tracing allocations, `frames` deep; a run started earlier is restarted."""
+    global _baseline
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _baseline = None
+    tracemalloc.start(frames)
+    return tracemalloc_status()
+
+
+def stop_tracing() -> dict[str, Any]:
+    """Stops tracing and frees the traces and the baseline."""
+    global _baseline
+    _baseline = None
+    tracemalloc.stop()
+    return tracemalloc_status()
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, pattern) for pattern in IGNORED_FILES]
+    )
+
+
+async def take_baseline() -> dict[str, Any]:
+    """Snapshots the traced allocations as the baseline later diffs are taken against."""
+    global _baseline
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("Allocation tracing is not running, start it first.")
+    # Snapshots of a large heap take a while; the event loop keeps serving meanwhile.
+    _baseline = await asyncio.to_thread(_snapshot)
+    return tracemalloc_status()
+
+
+def _format_stat(stat: tracemalloc.StatisticDiff) -> dict[str, Any]:
+    return {
+        "size_diff": stat.size_diff,
+        "size": stat.size,
+        "count_diff": stat.count_diff,
+        "count": stat.count,
+        # The allocating line first.
+        "traceback": [f"{frame.filename}:{frame.lineno}" for frame in reversed(stat.traceback)],
+    }
+
+
+async def diff(top: int, group_by: str) -> dict[str, Any]:
+    """The `top` allocation sites by growth since the baseline, grouped by "lineno", "filename" or "traceback"."""
+    if _baseline is None:
+        raise RuntimeError("There is no baseline snapshot, take one first.")
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise ValueError("`group_by` must be lineno, filename or traceback")
+
+    def compare() -> list[tracemalloc.StatisticDiff]:
+        return _snapshot().compare_to(_baseline, group_by)
+
+    stats = await asyncio.to_thread(compare)
+    return {
+        "size_diff": sum(stat.size_diff for stat in stats),
+        "count_diff": sum(stat.count_diff for stat in stats),
+        "top": [_format_stat(stat) for stat in stats[:top]],
+    }
+
+
+def tasks(stacks: bool, limit: int) -> dict[str, Any]:
+    """The event loop's tasks by coroutine, and each one's stack when `stacks` is set."""
+    all_tasks = asyncio.all_tasks()
+    counts = Counter(
+        getattr(task.get_coro(), "__qualname__", type(task.get_coro()).__name__) for task in all_tasks
+    )
+    report: dict[str, Any] = {"total": len(all_tasks), "by_coroutine": dict(counts.most_common())}
+    if stacks:
+        dumps = []
+        for task in list(all_tasks)[:limit]:
+            stack = io.StringIO()
+            task.print_stack(file=stack)
+            dumps.append({"name": task.get_name(), "stack": stack.getvalue()})
+        report["stacks"] = dumps
+    return report
@@ -0,0 +1,72 @@
+import os
+import math
+import logging
+from dataclasses import dataclass
+
+NATIVE_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+
+def supports_dimensions(model: str) -> bool:
+    """Whether the model can return shortened embeddings (the text-embedding-3 family)."""
+    return model.startswith("text-embedding-3")
+
+
+@dataclass(frozen=True)
+class EmbeddingSettings:
+    """The embedding model used by every path, and the vector field queries read.
+
+    `dimensions` shortens text-embedding-3 embeddings; None keeps the
+    model's native size. It must match the dimensions of `vector_field`.
+    """
+
+    model: str
+    dimensions: int | None
+    vector_field: str
+
+    @property
+    def size(self) -> int:
+        return self.dimensions or NATIVE_DIMENSIONS.get(self.model, 1536)
+
+    def request_options(self) -> dict:
+        """Extra arguments for embeddings.create."""
+        return {"dimensions": self.dimensions} if self.dimensions else {}
+
+
+def _load_settings() -> EmbeddingSettings:
+    # The model the existing indexes were built with; moving to another one
+    # means re-embedding them first (tools/migrate_embeddings.py).
+    model = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+    raw_dimensions = os.getenv("EMBEDDING_DIMENSIONS")
+    try:
+        dimensions = int(raw_dimensions) if raw_dimensions else None
+    except ValueError:
+        logging.error(f"EMBEDDING_DIMENSIONS={raw_dimensions} is not a number, ignoring it.")
+        dimensions = None
+    if dimensions and not supports_dimensions(model):
+        logging.error(f"{model} cannot shorten embeddings, ignoring EMBEDDING_DIMENSIONS={dimensions}.")
+        dimensions = None
+    return EmbeddingSettings(
+        model=model,
+        dimensions=dimensions,
+        vector_field=os.getenv("EMBEDDING_VECTOR_FIELD", "text_vector"),
+    )
+
+
+embedding_settings = _load_settings()
+
+
+def truncate(vector: list[float], dimensions: int) -> list[float]:
+    """Shortens a text-embedding-3 vector the way the API does: cut, then L2-normalize."""
+    head = vector[:dimensions]
+    norm = math.sqrt(sum(value * value for value in head)) or 1.0
+    return [value / norm for value in head]
+
+
+def parse_vector_field(spec: str) -> tuple[str, int | None]:
+    """Parses `name` or `name:dimensions` as used on the command line."""
+    name, _, dimensions = spec.partition(":")
+    return name, int(dimensions) if dimensions else None
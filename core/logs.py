@@ -0,0 +1,151 @@
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from contextvars import ContextVar
+
+from core.telemetry import register_gauge
+
+LOG_FORMAT = "[%(asctime)s - %(name)s:%(lineno)d - %(levelname)s] %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Per-logger levels; LOG_LEVELS (JSON, e.g. '{"semantic_kernel": "DEBUG", "azure": "WARNING"}')
+# overrides them and LOG_LEVEL sets the root logger's. Semantic Kernel's debug
+# records hold whole prompts and tool results, i.e. user content, so they
+# are only logged when LOG_LEVELS asks for them.
+LEVELS = {"semantic_kernel": "WARNING"}
+# Share of requests whose debug records are kept, for loggers LOG_LEVELS sets
+# to DEBUG; the rest are dropped before they are queued.
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.05"))
+# Longest message passed on; prompts and tool results logged whole are cut here.
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "2000"))
+# Records waiting to be written; more are dropped rather than blocking the event loop.
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+_debug_sampled: ContextVar[bool | None] = ContextVar("debug_sampled", default=None)
+_counts = {"queued": 0, "sampled_out": 0, "truncated": 0, "dropped": 0}
+_listener: logging.handlers.QueueListener | None = None
+_queue: queue.Queue | None = None
+
+
+def _levels() -> dict[str, str]:
+    raw = os.getenv("LOG_LEVELS")
+    if not raw:
+        return dict(LEVELS)
+    try:
+        return {**LEVELS, **json.loads(raw)}
+    except ValueError:
+        logging.error("LOG_LEVELS is not valid JSON, ignoring it.")
+        return dict(LEVELS)
+
+
+class _DebugSampler(logging.Filter):
+    """Keeps the debug records of a sampled share of requests, all others of every request.
+
+    The decision is made at a request's first debug record and kept in its
+    context, so a sampled request logs its whole debug trail and tasks it
+    starts afterwards follow it.
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.INFO:
+            return True
+        sampled = _debug_sampled.get()
+        if sampled is None:
+            sampled = random.random() < self.rate
+            _debug_sampled.set(sampled)
+        if not sampled:
+            _counts["sampled_out"] += 1
+        return sampled
+
+
+class _TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the listener thread with only their message rendered.
+
+    The message is rendered here because its arguments may change after the
+    call; formatting, timestamps and tracebacks are left to the listener.
+    """
+
+    def __init__(self, records: queue.Queue, max_chars: int) -> None:
+        super().__init__(records)
+        self.max_chars = max_chars
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            _counts["truncated"] += 1
+            message = f"{message[:self.max_chars]}... [{len(message) - self.max_chars} chars truncated]"
+        record.msg = message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            _counts["queued"] += 1
+        except queue.Full:
+            _counts["dropped"] += 1
+
+
+def configure_logging() -> None:
+    """Routes the root logger's records through a queue to its handlers on a background thread.
+
+    The handlers already on the root logger, e.g. the Functions host's, or
+    a stream handler when there are none, are moved behind the queue. The
+    event loop only samples, truncates and queues.
+    """
+    global _listener, _queue
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    if os.getenv("LOG_LEVEL"):
+        root.setLevel(os.environ["LOG_LEVEL"].upper())
+    for name, level in _levels().items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    handlers = list(root.handlers)
+    if not handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+        handlers = [handler]
+
+    _queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _TruncatingQueueHandler(_queue, LOG_MAX_MESSAGE_CHARS)
+    queue_handler.addFilter(_DebugSampler(LOG_DEBUG_SAMPLE_RATE))
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Writes out the queued records and stops the writer thread; later records are dropped."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> dict:
+    return {
+        "queue_depth": _queue.qsize() if _queue is not None else 0,
+        "debug_sample_rate": LOG_DEBUG_SAMPLE_RATE,
+        **_counts,
+    }
+
+
+register_gauge(
+    "app.logging.queue_depth",
+    unit="{record}",
+    description="Log records waiting for the background writer",
+    observe=lambda: [(_queue.qsize() if _queue is not None else 0, {})],
+)
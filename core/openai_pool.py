@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+import httpx
+
+LATENCY_SMOOTHING = 0.2
+EJECT_AFTER_FAILURES = 3
+EJECT_BASE_SECONDS = 10.0
+EJECT_MAX_SECONDS = 300.0
+
+current_affinity: ContextVar[str | None] = ContextVar("current_affinity", default=None)
+
+
+@contextmanager
+def session_affinity(key: str | None) -> Iterator[None]:
+    """Prefers the same pool member for the OpenAI calls of one session, so prompt caching applies."""
+    token = current_affinity.set(key)
+    try:
+        yield
+    finally:
+        current_affinity.reset(token)
+
+
+@dataclass
+class PoolMember:
+    """One endpoint/deployment pair serving a logical model.
+
+    A member without an endpoint serves requests where the client sent them;
+    it stands in for models that have no pool configured.
+    """
+
+    model: str
+    deployment: str
+    endpoint: httpx.URL | None = None
+    api_key: str | None = None
+    rpm: float | None = None
+    tpm: float | None = None
+    latency_ms: float = 0.0
+    failures: int = 0
+    ejections: int = 0
+    ejected_until: float = 0.0
+
+    @property
+    def key(self) -> str:
+        if self.endpoint is None:
+            return self.deployment
+        return f"{self.deployment}@{self.endpoint.host}"
+
+    def healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def route(self, request: httpx.Request) -> httpx.Request:
+        url = request.url
+        path = url.path.replace(
+            f"/openai/deployments/{self.model}/", f"/openai/deployments/{self.deployment}/", 1
+        )
+        if self.endpoint is not None:
+            url = url.copy_with(
+                scheme=self.endpoint.scheme, host=self.endpoint.host, port=self.endpoint.port
+            )
+        if url == request.url and path == url.path:
+            return request
+
+        headers = request.headers.copy()
+        headers["host"] = url.copy_with(path=path).netloc.decode("ascii")
+        if self.api_key:
+            headers["api-key"] = self.api_key
+            headers.pop("authorization", None)
+        return httpx.Request(
+            request.method,
+            url.copy_with(path=path),
+            headers=headers,
+            content=request.content,
+            extensions=request.extensions,
+        )
+
+    def record_success(self, latency_ms: float) -> None:
+        self.failures = 0
+        self.ejections = 0
+        if self.latency_ms:
+            self.latency_ms += LATENCY_SMOOTHING * (latency_ms - self.latency_ms)
+        else:
+            self.latency_ms = latency_ms
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= EJECT_AFTER_FAILURES:
+            seconds = min(EJECT_MAX_SECONDS, EJECT_BASE_SECONDS * 2**self.ejections)
+            self.ejected_until = time.monotonic() + seconds
+            self.ejections += 1
+            self.failures = 0
+            logging.warning(f"Ejected {self.key} from its pool for {seconds:.0f}s")
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model,
+            "latency_ms": self.latency_ms,
+            "ejected_for": max(0.0, self.ejected_until - time.monotonic()),
+            "ejections": self.ejections,
+        }
+
+
+def _rendezvous(affinity: str, member: PoolMember) -> int:
+    return int.from_bytes(hashlib.sha1(f"{affinity}:{member.key}".encode()).digest()[:8], "big")
+
+
+class DeploymentPool:
+    """Picks the member that serves each call of a logical model.
+
+    Members are chosen by fewest outstanding requests, weighted by their
+    recent latency. Members failing repeatedly are ejected for a growing
+    while. Calls carrying a session affinity stay on one member unless it
+    is busier than the least loaded member by more than `sticky_slack`.
+    """
+
+    def __init__(self, models: dict[str, list[PoolMember]], sticky_slack: float) -> None:
+        self.models = models
+        self.sticky_slack = sticky_slack
+
+    def members(self, model: str) -> list[PoolMember]:
+        members = self.models.get(model)
+        if not members:
+            members = self.models[model] = [PoolMember(model=model, deployment=model)]
+        return members
+
+    def select(
+        self, model: str, load: Callable[[PoolMember], float], affinity: str | None = None
+    ) -> PoolMember:
+        members = self.members(model)
+        if len(members) == 1:
+            return members[0]
+
+        now = time.monotonic()
+        candidates = [member for member in members if member.healthy(now)] or members
+        loads = {member.key: load(member) for member in candidates}
+
+        if affinity is not None:
+            sticky = max(candidates, key=lambda member: _rendezvous(affinity, member))
+            if loads[sticky.key] <= min(loads.values()) + self.sticky_slack:
+                return sticky
+
+        return min(
+            candidates,
+            key=lambda member: (loads[member.key] + 1) * (member.latency_ms or 1.0),
+        )
+
+    def stats(self) -> dict:
+        return {
+            member.key: member.stats()
+            for members in self.models.values()
+            for member in members
+        }
+
+
+def _load_pool() -> DeploymentPool:
+    models: dict[str, list[PoolMember]] = {}
+    raw = os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+    if raw:
+        try:
+            for model, entries in json.loads(raw).items():
+                models[model] = [
+                    PoolMember(
+                        model=model,
+                        deployment=entry.get("deployment", model),
+                        endpoint=httpx.URL(entry["endpoint"]) if entry.get("endpoint") else None,
+                        api_key=os.getenv(entry["api_key_env"]) if entry.get("api_key_env") else None,
+                        rpm=entry.get("rpm"),
+                        tpm=entry.get("tpm"),
+                    )
+                    for entry in entries
+                ]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.error(f"AZURE_OPENAI_DEPLOYMENTS is invalid, ignoring it: {e}")
+            models = {}
+    return DeploymentPool(
+        models, sticky_slack=float(os.getenv("AZURE_OPENAI_STICKY_SLACK", "2"))
+    )
+
+
+pool = _load_pool()
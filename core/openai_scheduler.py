@@ -0,0 +1,451 @@
+import os
+import re
+import json
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Iterator
+
+import httpx
+
+from core.resilience import remaining, waiting_locally
+from core.telemetry import register_gauge, stage
+from core.openai_pool import PoolMember, current_affinity, pool
+
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+LANES = {INTERACTIVE: "interactive", BACKGROUND: "background", BULK: "bulk"}
+
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 765
+DEFAULT_COMPLETION_TOKENS = 1000
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_DEPLOYMENT_PATH = re.compile(r"/openai/deployments/([^/]+)/")
+
+current_lane: ContextVar[int | None] = ContextVar("current_lane", default=None)
+
+
+@contextmanager
+def lane(priority: int) -> Iterator[None]:
+    """Schedules the OpenAI calls made inside the block in the given lane."""
+    token = current_lane.set(priority)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+class SchedulerTimeoutError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute: float | None) -> None:
+        self.capacity = per_minute
+        self.level = per_minute or 0.0
+        self.rate = (per_minute or 0.0) / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def clamp(self, amount: float) -> float:
+        return amount if self.capacity is None else min(amount, self.capacity)
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.capacity is None:
+            return 0.0
+        self._refill(now)
+        missing = self.clamp(amount) - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def take(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.level -= self.clamp(amount)
+
+    def observe_remaining(self, remaining: float) -> None:
+        """Trusts the service when it reports less headroom than we think we have."""
+        if self.capacity is not None:
+            self.level = min(self.level, remaining)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    sequence: int
+    tokens: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class DeploymentScheduler:
+    """Admits requests to one deployment within its RPM and TPM limits.
+
+    Waiters are served strictly by lane and then in arrival order, so
+    interactive streams overtake queued rewrites and embeddings. A 429 pauses
+    the whole deployment until its Retry-After has passed.
+    """
+
+    def __init__(self, name: str, rpm: float | None, tpm: float | None, timeout: float) -> None:
+        self.name = name
+        self.timeout = timeout
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.in_flight = 0
+        # Sent and not yet read to the end: a stream counts until it is closed,
+        # long after its headers released the rate limit slot.
+        self.outstanding = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self._waiters: list[_Waiter] = []
+        self._sequence = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def queue_depth(self, priority: int | None = None) -> int:
+        return sum(
+            1
+            for waiter in self._waiters
+            if not waiter.future.done() and (priority is None or waiter.priority == priority)
+        )
+
+    async def acquire(self, tokens: int, priority: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, _Waiter(priority, next(self._sequence), tokens, future))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.timeouts += 1
+                raise SchedulerTimeoutError(
+                    f"Deployment {self.name} is saturated, waited {self.timeout}s"
+                )
+        except asyncio.CancelledError:
+            if not future.cancel():
+                # Granted while we were being cancelled; nobody will use it.
+                self.in_flight -= 1
+            raise
+        finally:
+            self._dispatch()
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def finish(self) -> None:
+        self.outstanding -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.throttled += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self._dispatch()
+
+    def observe(self, headers: httpx.Headers) -> None:
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        try:
+            if remaining_requests is not None:
+                self.requests.observe_remaining(float(remaining_requests))
+            if remaining_tokens is not None:
+                self.tokens.observe_remaining(float(remaining_tokens))
+        except ValueError:
+            pass
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._waiters:
+            head = self._waiters[0]
+            if head.future.done():
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            delay = max(
+                self.paused_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(head.tokens, now),
+            )
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self.requests.take(1)
+            self.tokens.take(head.tokens)
+            self.in_flight += 1
+            head.future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "queued": {name: self.queue_depth(priority) for priority, name in LANES.items()},
+            "in_flight": self.in_flight,
+            "outstanding": self.outstanding,
+            "throttled": self.throttled,
+            "timeouts": self.timeouts,
+            "paused_for": max(0.0, self.paused_until - time.monotonic()),
+        }
+
+
+def _load_limits() -> dict[str, dict[str, float]]:
+    raw = os.getenv("AZURE_OPENAI_RATE_LIMITS")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        logging.error("AZURE_OPENAI_RATE_LIMITS is not valid JSON, ignoring it.")
+        return {}
+
+
+_limits = _load_limits()
+_schedulers: dict[str, DeploymentScheduler] = {}
+
+
+def scheduler_for(member: PoolMember) -> DeploymentScheduler:
+    scheduler = _schedulers.get(member.key)
+    if scheduler is None:
+        limits = _limits.get(member.deployment, _limits.get("*", {}))
+        scheduler = _schedulers[member.key] = DeploymentScheduler(
+            name=member.key,
+            rpm=member.rpm if member.rpm is not None else limits.get("rpm"),
+            tpm=member.tpm if member.tpm is not None else limits.get("tpm"),
+            timeout=float(os.getenv("AZURE_OPENAI_QUEUE_TIMEOUT_SECONDS", "60")),
+        )
+    return scheduler
+
+
+def _load(member: PoolMember) -> float:
+    scheduler = scheduler_for(member)
+    throttled = scheduler.paused_until > time.monotonic()
+    return scheduler.outstanding + scheduler.queue_depth() + (1000 if throttled else 0)
+
+
+def scheduler_stats() -> dict:
+    members = pool.stats()
+    return {
+        name: {**scheduler.stats(), **members.get(name, {})}
+        for name, scheduler in _schedulers.items()
+    }
+
+
+register_gauge(
+    "llm.queue.depth",
+    unit="{request}",
+    description="OpenAI requests waiting for rate limit capacity",
+    observe=lambda: [
+        (scheduler.queue_depth(priority), {"deployment": name, "lane": lane_name})
+        for name, scheduler in _schedulers.items()
+        for priority, lane_name in LANES.items()
+    ],
+)
+
+
+def estimate_tokens(body: dict) -> int:
+    """A rough upper bound of the tokens a request will be charged for."""
+    characters = 0
+    images = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            characters += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    images += 1
+                else:
+                    characters += len(part.get("text", ""))
+    embedding_input = body.get("input", "")
+    if isinstance(embedding_input, list):
+        characters += sum(len(item) for item in embedding_input if isinstance(item, str))
+    else:
+        characters += len(embedding_input)
+
+    completion = body.get("max_tokens") or body.get("max_completion_tokens")
+    if completion is None:
+        completion = DEFAULT_COMPLETION_TOKENS if "messages" in body else 0
+    return characters // CHARS_PER_TOKEN + images * IMAGE_TOKENS + completion
+
+
+def _lane_of(request: httpx.Request, body: dict) -> int:
+    priority = current_lane.get()
+    if priority is not None:
+        return priority
+    if request.url.path.endswith("/embeddings"):
+        return BULK
+    return INTERACTIVE if body.get("stream") else BACKGROUND
+
+
+def _retry_after(response: httpx.Response | None, attempt: int) -> float:
+    if response is not None:
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            value = response.headers.get(header)
+            if value is not None:
+                try:
+                    return float(value) * scale
+                except ValueError:
+                    pass
+    return min(30.0, 0.5 * 2**attempt)
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """A response body that calls `on_close` once, when it is closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]) -> None:
+        self._stream = stream
+        self._on_close: Callable[[], None] | None = on_close
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+                self._on_close = None
+
+
+class SchedulingTransport(httpx.AsyncBaseTransport):
+    """Sends Azure OpenAI deployment calls to a pool member, through its DeploymentScheduler.
+
+    Retries throttled and failed calls itself, but not past the current
+    request's deadline, so the OpenAI clients using it should be created
+    with `max_retries=0`. Queueing and backing off count as local waits,
+    which do not use up the calling dependency's timeout.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_retries: int) -> None:
+        self._transport = transport
+        self.max_retries = max_retries
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        match = _DEPLOYMENT_PATH.search(request.url.path)
+        if match is None:
+            return await self._transport.handle_async_request(request)
+
+        model = match.group(1)
+        try:
+            body = json.loads(request.content or b"{}")
+        except ValueError:
+            body = {}
+        tokens = estimate_tokens(body)
+        priority = _lane_of(request, body)
+        affinity = current_affinity.get()
+
+        attempt = 0
+        while True:
+            _limit_to_deadline(request, streaming=bool(body.get("stream")))
+            member = pool.select(model, load=_load, affinity=affinity)
+            scheduler = scheduler_for(member)
+            try:
+                with stage("llm-queue", deployment=scheduler.name, lane=LANES[priority]), waiting_locally():
+                    await scheduler.acquire(tokens, priority)
+            except SchedulerTimeoutError as e:
+                logging.warning(str(e))
+                return httpx.Response(
+                    429,
+                    headers={"retry-after": str(int(scheduler.timeout))},
+                    json={"error": {"code": "429", "message": str(e)}},
+                    request=request,
+                )
+
+            response: httpx.Response | None = None
+            start = time.perf_counter()
+            scheduler.outstanding += 1
+            try:
+                response = await self._transport.handle_async_request(member.route(request))
+            except httpx.TransportError:
+                member.record_failure()
+                if attempt >= self.max_retries or not _time_to_retry(_retry_after(None, attempt)):
+                    raise
+            finally:
+                scheduler.release()
+                if response is None or response.is_closed:
+                    scheduler.finish()
+                else:
+                    response.stream = _TrackedStream(response.stream, scheduler.finish)  # pyright: ignore
+
+            delay = _retry_after(response, attempt)
+            if response is not None:
+                scheduler.observe(response.headers)
+                if response.status_code >= 500:
+                    member.record_failure()
+                elif response.status_code != 429:
+                    member.record_success((time.perf_counter() - start) * 1000)
+                if (
+                    response.status_code not in RETRYABLE_STATUS
+                    or attempt >= self.max_retries
+                    or not _time_to_retry(delay)
+                ):
+                    return response
+                await response.aclose()
+
+            if response is not None and response.status_code == 429:
+                scheduler.pause(delay)
+                if len(pool.members(model)) > 1:
+                    # Another member may have quota left; selection skips paused ones.
+                    delay = 0.0
+            attempt += 1
+            with waiting_locally():
+                await asyncio.sleep(delay + random.uniform(0, min(1.0, delay * 0.2)))
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _time_to_retry(delay: float) -> bool:
+    """Whether a retry after `delay` seconds could still finish within the request's deadline."""
+    left = remaining()
+    return left is None or left > delay
+
+
+def _limit_to_deadline(request: httpx.Request, streaming: bool) -> None:
+    """Caps the request's timeouts at what is left of the current request's deadline.
+
+    A stream's read timeout is left alone: it bounds the gap between chunks,
+    not the length of the completion.
+    """
+    left = remaining()
+    if left is None:
+        return
+    left = max(left, 0.001)
+    timeouts = dict(request.extensions.get("timeout") or {})
+    for name in ("connect", "write", "pool") if streaming else ("connect", "read", "write", "pool"):
+        current = timeouts.get(name)
+        timeouts[name] = left if current is None else min(current, left)
+    request.extensions["timeout"] = timeouts
+
+
+_http_client: httpx.AsyncClient | None = None
+
+
+def scheduled_http_client() -> httpx.AsyncClient:
+    """The HTTP client shared by every Azure OpenAI client in the app."""
+    global _http_client
+    if _http_client is None:
+        from openai import DEFAULT_CONNECTION_LIMITS, DEFAULT_TIMEOUT
+
+        _http_client = httpx.AsyncClient(
+            transport=SchedulingTransport(
+                httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS),
+                max_retries=int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "4")),
+            ),
+            timeout=DEFAULT_TIMEOUT,
+            follow_redirects=True,
+        )
+    return _http_client
@@ -0,0 +1,453 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+
+from core.telemetry import counter, register_gauge
+
+T = TypeVar("T")
+
+DEFAULT_DEADLINE_SECONDS = 30.0
+
+# Settings of every dependency; DEPENDENCIES and the UPSTREAM_DEPENDENCIES
+# environment variable (JSON, "*" for all) override them per dependency.
+DEFAULTS = {
+    # Longest a single call may take, further capped by the request's deadline.
+    "timeout": 10.0,
+    # Longest gap between two chunks of a stream.
+    "idle_timeout": 30.0,
+    "hedge": False,
+    # At most this share of calls is hedged, so a slow dependency is not doubled in load.
+    "hedge_ratio": 0.1,
+    "hedge_min_ms": 20.0,
+    "hedge_samples": 20,
+    "window": 20,
+    "min_calls": 10,
+    "failure_ratio": 0.5,
+    "open_seconds": 15.0,
+}
+DEPENDENCIES = {
+    "search": {"timeout": 3.0, "hedge": True},
+    "openai.chat": {"timeout": 15.0},
+    "openai.stream": {"timeout": 20.0, "idle_timeout": 15.0},
+    "openai.embeddings": {"timeout": 5.0},
+}
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_calls = counter(
+    "app.dependency.calls", unit="{call}", description="Upstream calls by dependency and outcome"
+)
+
+current_deadline: ContextVar[float | None] = ContextVar("current_deadline", default=None)
+
+
+class _LocalWait:
+    """Time a dependency call spent waiting in this process, e.g. queued for rate limit capacity."""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.since: float | None = None
+
+    def total(self, now: float) -> float:
+        return self.seconds + (now - self.since if self.since is not None else 0.0)
+
+
+current_local_wait: ContextVar[_LocalWait | None] = ContextVar("current_local_wait", default=None)
+
+
+@contextmanager
+def waiting_locally() -> Iterator[None]:
+    """Marks the block as time the current dependency call waits on us rather than on the dependency.
+
+    The call's timeout is extended by it, within the request's budget, so
+    queueing here does not count against the dependency.
+    """
+    wait = current_local_wait.get()
+    if wait is None:
+        yield
+        return
+    start = wait.since = time.monotonic()
+    try:
+        yield
+    finally:
+        wait.since = None
+        wait.seconds += time.monotonic() - start
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's time budget ran out before or during an upstream call."""
+
+
+class DependencyUnavailable(Exception):
+    """A dependency's circuit breaker is open, so the call was not made."""
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f"{name} is unavailable, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def remaining() -> float | None:
+    """Seconds left in the current request's budget, or None outside a request."""
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _load_json(variable: str) -> dict[str, Any]:
+    raw = os.getenv(variable)
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        logging.error(f"{variable} is not valid JSON, ignoring it.")
+        return {}
+
+
+_deadlines = _load_json("REQUEST_DEADLINES")
+
+
+def deadline(route: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Gives the upstream calls made for a request to `route` a shared time budget.
+
+    The budget comes from REQUEST_DEADLINES (JSON seconds per route, "*"
+    for all) and defaults to DEFAULT_DEADLINE_SECONDS. Tasks started by the
+    handler, such as a streamed response, inherit it. Each call's timeout is
+    its dependency's timeout or what is left of the budget, whichever is
+    smaller.
+    """
+    seconds = float(_deadlines.get(route, _deadlines.get("*", DEFAULT_DEADLINE_SECONDS)))
+
+    def decorator(handler: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(handler)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            token = current_deadline.set(time.monotonic() + seconds)
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                current_deadline.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+class CircuitBreaker:
+    """Fails calls fast while a dependency keeps failing.
+
+    Opens once `failure_ratio` of the last `window` calls failed (and at
+    least `min_calls` were made), rejects calls for `open_seconds`, then
+    lets a single probe through: its success closes the breaker, its
+    failure opens it again.
+    """
+
+    def __init__(
+        self, name: str, window: int, min_calls: int, failure_ratio: float, open_seconds: float
+    ) -> None:
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened = 0
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._open_until = 0.0
+        self._probing = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self._open_until - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() < self._open_until:
+                return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def release(self) -> None:
+        """Ends an allowed call that says nothing about the dependency's health."""
+        self._probing = False
+
+    def record(self, success: bool) -> None:
+        if self.state == HALF_OPEN:
+            self._probing = False
+            if success:
+                self.state = CLOSED
+                self._outcomes.clear()
+                logging.warning(f"Circuit for {self.name} closed again.")
+            else:
+                self._open()
+            return
+        self._outcomes.append(success)
+        failures = self._outcomes.count(False)
+        if (
+            self.state == CLOSED
+            and len(self._outcomes) >= self.min_calls
+            and failures >= self.failure_ratio * len(self._outcomes)
+        ):
+            self._open()
+
+    def _open(self) -> None:
+        self.state = OPEN
+        self.opened += 1
+        self._open_until = time.monotonic() + self.open_seconds
+        self._outcomes.clear()
+        logging.warning(f"Circuit for {self.name} opened for {self.open_seconds:.0f}s.")
+
+
+class Dependency:
+    """Timeouts, hedging and a circuit breaker for the calls to one upstream service.
+
+    A call slower than the p95 of recent calls is hedged, when enabled, by
+    a duplicate; the first to succeed is used and the other cancelled. Only
+    idempotent reads should be hedged. Running out of the request's budget
+    is not held against the dependency, its own timeout is. Errors that
+    `is_failure` does not blame on the dependency, such as a rejected
+    query, count as neither success nor failure.
+    """
+
+    def __init__(self, name: str, **settings: Any) -> None:
+        self.name = name
+        self.timeout = float(settings["timeout"])
+        self.idle_timeout = float(settings["idle_timeout"])
+        self.hedge = bool(settings["hedge"])
+        self.hedge_ratio = float(settings["hedge_ratio"])
+        self.hedge_min_ms = float(settings["hedge_min_ms"])
+        self.hedge_samples = int(settings["hedge_samples"])
+        self.breaker = CircuitBreaker(
+            name,
+            window=int(settings["window"]),
+            min_calls=int(settings["min_calls"]),
+            failure_ratio=float(settings["failure_ratio"]),
+            open_seconds=float(settings["open_seconds"]),
+        )
+        self.counts = {
+            "ok": 0, "failed": 0, "client_error": 0, "timed_out": 0, "rejected": 0,
+            "fallback": 0, "hedged": 0, "hedge_won": 0, "hedge_skipped": 0,
+        }
+        self._latencies: deque[float] = deque(maxlen=200)
+
+    def _count(self, outcome: str) -> None:
+        self.counts[outcome] += 1
+        _calls(1, {"dependency": self.name, "outcome": outcome})
+
+    def p95_ms(self) -> float | None:
+        if len(self._latencies) < self.hedge_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _timeout(self) -> tuple[float, bool]:
+        """The timeout of the next call and whether it is the request's budget rather than ours."""
+        left = remaining()
+        if left is None or left >= self.timeout:
+            return self.timeout, False
+        if left <= 0:
+            raise DeadlineExceeded(f"No time left for {self.name}")
+        return left, True
+
+    async def call(
+        self,
+        operation: Callable[[], Awaitable[T]],
+        fallback: Callable[[], Awaitable[T]] | None = None,
+        is_failure: Callable[[BaseException], bool] = lambda error: True,
+        can_hedge: Callable[[], bool] = lambda: True,
+    ) -> T:
+        """Runs `operation` within its timeout; `fallback`, if given, answers when it cannot.
+
+        `can_hedge` is asked before a slow call is duplicated, e.g. whether
+        there is capacity left to run the duplicate on.
+        """
+        if not self.breaker.allow():
+            self._count("rejected")
+            if fallback is not None:
+                self._count("fallback")
+                return await fallback()
+            raise DependencyUnavailable(self.name, self.breaker.retry_after())
+
+        try:
+            timeout, budget_bound = self._timeout()
+        except DeadlineExceeded:
+            self.breaker.release()
+            raise
+        start = time.perf_counter()
+        local_wait = _LocalWait()
+        token = current_local_wait.set(local_wait)
+        try:
+            result = await self._within(
+                asyncio.ensure_future(self._hedged(operation, can_hedge) if self.hedge else operation()),
+                timeout,
+                local_wait,
+            )
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except asyncio.TimeoutError as e:
+            left = remaining()
+            budget_bound = budget_bound or (left is not None and left <= 0)
+            self._count("timed_out")
+            if budget_bound:
+                self.breaker.release()
+            else:
+                self.breaker.record(False)
+            error: Exception = (
+                DeadlineExceeded(f"The request's time ran out waiting for {self.name}")
+                if budget_bound
+                else TimeoutError(f"{self.name} did not answer within {timeout:.1f}s")
+            )
+            if fallback is not None and not budget_bound:
+                self._count("fallback")
+                logging.warning(f"{error}, falling back.")
+                return await fallback()
+            raise error from e
+        except Exception as e:
+            failed = is_failure(e)
+            if failed:
+                self._count("failed")
+                self.breaker.record(False)
+            else:
+                self._count("client_error")
+                self.breaker.release()
+            if fallback is not None and failed:
+                self._count("fallback")
+                logging.warning(f"{self.name} failed, falling back: {e!r}")
+                return await fallback()
+            raise
+        finally:
+            current_local_wait.reset(token)
+        self._count("ok")
+        self.breaker.record(True)
+        self._latencies.append((time.perf_counter() - start) * 1000)
+        return result
+
+    async def _within(self, task: "asyncio.Future[T]", timeout: float, local_wait: _LocalWait) -> T:
+        """Awaits `task` for `timeout` plus the time it waited locally, but never past the request's deadline.
+
+        Raises asyncio.TimeoutError, having cancelled the task, when that runs out.
+        """
+        start = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                limit = start + timeout + local_wait.total(now)
+                left = remaining()
+                if left is not None:
+                    limit = min(limit, now + left)
+                if now >= limit:
+                    raise asyncio.TimeoutError
+                done, _ = await asyncio.wait({task}, timeout=limit - now)
+                if done:
+                    return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+            elif not task.cancelled():
+                task.exception()
+
+    async def _hedged(self, operation: Callable[[], Awaitable[T]], can_hedge: Callable[[], bool]) -> T:
+        tasks = [asyncio.ensure_future(operation())]
+        try:
+            p95 = self.p95_ms()
+            if p95 is None:
+                return await tasks[0]
+            done, _ = await asyncio.wait(tasks, timeout=max(p95, self.hedge_min_ms) / 1000)
+            total = sum(self.counts[outcome] for outcome in ("ok", "failed", "client_error", "timed_out"))
+            if done or self.counts["hedged"] >= self.hedge_ratio * max(total, 1):
+                return await tasks[0]
+            if not can_hedge():
+                self._count("hedge_skipped")
+                return await tasks[0]
+
+            self._count("hedged")
+            tasks.append(asyncio.ensure_future(operation()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is tasks[1]:
+                            self._count("hedge_won")
+                        return task.result()
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # Mark the loser's error as seen.
+                    task.exception()
+
+    async def stream(self, chunks: AsyncIterator[T]) -> AsyncIterator[T]:
+        """Passes `chunks` through, ending the stream when one takes longer than `idle_timeout`.
+
+        Only gaps count: a completion that keeps streaming may outlive the
+        request's budget.
+        """
+        iterator = chunks.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), self.idle_timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as e:
+                self._count("timed_out")
+                self.breaker.record(False)
+                raise TimeoutError(
+                    f"{self.name} sent nothing for {self.idle_timeout:.0f}s"
+                ) from e
+            yield chunk
+
+    def stats(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "opened": self.breaker.opened,
+            "retry_after": round(self.breaker.retry_after(), 1),
+            "p95_ms": self.p95_ms(),
+            **self.counts,
+        }
+
+
+_config = _load_json("UPSTREAM_DEPENDENCIES")
+_dependencies: dict[str, Dependency] = {}
+
+
+def dependency(name: str) -> Dependency:
+    if name not in _dependencies:
+        settings = {
+            **DEFAULTS,
+            **DEPENDENCIES.get(name, {}),
+            **_config.get("*", {}),
+            **_config.get(name, {}),
+        }
+        _dependencies[name] = Dependency(name, **settings)
+    return _dependencies[name]
+
+
+def dependency_stats() -> dict:
+    return {name: dependency.stats() for name, dependency in _dependencies.items()}
+
+
+register_gauge(
+    "app.dependency.circuit_state",
+    unit="1",
+    description="Circuit breaker state per dependency: 0 closed, 1 half-open, 2 open",
+    observe=lambda: [
+        (_STATE_VALUES[dependency.breaker.state], {"dependency": name})
+        for name, dependency in _dependencies.items()
+    ],
+)
@@ -0,0 +1,269 @@
+import ssl
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from urllib.parse import unquote, urlparse
+
+
+class RespError(Exception):
+    """An error reply from the server."""
+
+
+def encode_command(*args: bytes | str | int | float) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by the server")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [await read_reply(reader) for _ in range(count)]
+    raise ConnectionError(f"Unexpected reply {line[:32]!r}")
+
+
+@dataclass(frozen=True)
+class RespSettings:
+    host: str
+    port: int
+    tls: bool
+    username: str | None
+    password: str | None
+    db: int
+
+    @classmethod
+    def from_url(cls, url: str) -> "RespSettings":
+        """Parses redis://[user:password@]host[:port][/db]; rediss:// uses TLS."""
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", "rediss"):
+            raise ValueError(f"Unsupported cache URL scheme '{parsed.scheme}'")
+        tls = parsed.scheme == "rediss"
+        return cls(
+            host=parsed.hostname or "127.0.0.1",
+            port=parsed.port or (6380 if tls else 6379),
+            tls=tls,
+            username=unquote(parsed.username) if parsed.username else None,
+            password=unquote(parsed.password) if parsed.password else None,
+            db=int(parsed.path.strip("/") or 0),
+        )
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    async def call(self, *args: bytes | str | int | float):
+        self.writer.write(encode_command(*args))
+        await self.writer.drain()
+        return await read_reply(self.reader)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class RespClient:
+    """A small pooled client for the Redis protocol (Azure Cache for Redis or any compatible server).
+
+    Each command borrows an idle connection or opens one, up to
+    `max_connections`. A connection that fails or times out mid-command is
+    discarded, since its reply stream can no longer be trusted.
+    """
+
+    def __init__(self, url: str, max_connections: int = 16, timeout: float = 0.25) -> None:
+        self.settings = RespSettings.from_url(url)
+        self.timeout = timeout
+        self._idle: list[_Connection] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self) -> _Connection:
+        settings = self.settings
+        reader, writer = await asyncio.open_connection(
+            settings.host,
+            settings.port,
+            ssl=ssl.create_default_context() if settings.tls else None,
+        )
+        connection = _Connection(reader, writer)
+        try:
+            if settings.password:
+                if settings.username:
+                    await connection.call("AUTH", settings.username, settings.password)
+                else:
+                    await connection.call("AUTH", settings.password)
+            if settings.db:
+                await connection.call("SELECT", settings.db)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    async def execute(self, *args: bytes | str | int | float):
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            try:
+                if connection is None:
+                    connection = await asyncio.wait_for(self._connect(), self.timeout * 4)
+                reply = await asyncio.wait_for(connection.call(*args), self.timeout)
+            except RespError:
+                # The connection is still in sync after an error reply.
+                if connection is not None:
+                    self._idle.append(connection)
+                raise
+            except BaseException:
+                if connection is not None:
+                    connection.close()
+                raise
+            self._idle.append(connection)
+            return reply
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.execute("GET", key)
+
+    async def set(
+        self, key: str, value: bytes, ttl_ms: int | None = None, only_if_missing: bool = False
+    ) -> bool:
+        args: list[bytes | str | int] = ["SET", key, value]
+        if ttl_ms:
+            args += ["PX", ttl_ms]
+        if only_if_missing:
+            args.append("NX")
+        return await self.execute(*args) == "OK"
+
+    async def delete(self, *keys: str) -> int:
+        return await self.execute("DEL", *keys)
+
+    async def close(self) -> None:
+        while self._idle:
+            self._idle.pop().close()
+
+
+class RespServer:
+    """An in-memory server speaking enough of the Redis protocol for the cache.
+
+    It stands in for the shared cache in local runs, benchmarks and tests:
+    GET, SET (EX/PX/NX/XX), DEL, EXISTS, PTTL, DBSIZE, FLUSHDB, PING, AUTH,
+    SELECT and QUIT. All databases share one keyspace.
+    """
+
+    def __init__(self, password: str | None = None) -> None:
+        self.password = password
+        self.commands = 0
+        self._data: dict[bytes, tuple[bytes, float | None]] = {}
+        self._server: asyncio.AbstractServer | None = None
+        self._clients: set[asyncio.StreamWriter] = set()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Starts listening and returns the URL clients connect with."""
+        server = await asyncio.start_server(self._serve, host, port)
+        self._server = server
+        bound_port = server.sockets[0].getsockname()[1]
+        credentials = f":{self.password}@" if self.password else ""
+        return f"redis://{credentials}{host}:{bound_port}"
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._clients):
+                writer.close()
+            await self._server.wait_closed()
+
+    def _get(self, key: bytes) -> bytes | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        authenticated = self.password is None
+        self._clients.add(writer)
+        try:
+            while True:
+                try:
+                    command = await read_reply(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    return
+                if not isinstance(command, list) or not command:
+                    writer.write(b"-ERR Protocol error\r\n")
+                    continue
+                self.commands += 1
+                name = command[0].upper()
+                if name == b"QUIT":
+                    writer.write(b"+OK\r\n")
+                    return
+                if name == b"AUTH":
+                    authenticated = command[-1].decode() == (self.password or command[-1].decode())
+                    writer.write(b"+OK\r\n" if authenticated else b"-WRONGPASS invalid password\r\n")
+                elif not authenticated:
+                    writer.write(b"-NOAUTH Authentication required.\r\n")
+                else:
+                    writer.write(self._execute(name, command[1:]))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.error(f"Embedded cache server failed: {e}")
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    def _execute(self, name: bytes, args: list[bytes]) -> bytes:
+        if name == b"PING":
+            return b"+PONG\r\n"
+        if name == b"SELECT":
+            return b"+OK\r\n"
+        if name == b"GET":
+            value = self._get(args[0])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == b"SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            expires = None
+            if b"PX" in options:
+                expires = time.monotonic() + int(options[options.index(b"PX") + 1]) / 1000
+            elif b"EX" in options:
+                expires = time.monotonic() + int(options[options.index(b"EX") + 1])
+            exists = self._get(key) is not None
+            if (b"NX" in options and exists) or (b"XX" in options and not exists):
+                return b"$-1\r\n"
+            self._data[key] = (value, expires)
+            return b"+OK\r\n"
+        if name == b"DEL":
+            removed = sum(1 for key in args if self._get(key) is not None and self._data.pop(key))
+            return b":%d\r\n" % removed
+        if name == b"EXISTS":
+            return b":%d\r\n" % sum(1 for key in args if self._get(key) is not None)
+        if name == b"PTTL":
+            if self._get(args[0]) is None:
+                return b":-2\r\n"
+            expires = self._data[args[0]][1]
+            return b":-1\r\n" if expires is None else b":%d\r\n" % int((expires - time.monotonic()) * 1000)
+        if name == b"DBSIZE":
+            return b":%d\r\n" % sum(1 for key in list(self._data) if self._get(key) is not None)
+        if name == b"FLUSHDB":
+            self._data.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name
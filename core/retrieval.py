@@ -0,0 +1,159 @@
+import os
+import time
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from core.telemetry import counter, histogram, stage
+
+logger = logging.getLogger("retrieval")
+
+# Hybrid results are ranked by reciprocal rank fusion, each query adding
+# 1 / (RRF_K + rank) to a document's score.
+RRF_K = 60
+_SINGLE_QUERY_BEST = 1 / (RRF_K + 1)
+_HYBRID_BEST = 2 * _SINGLE_QUERY_BEST
+
+_decisions = counter(
+    "app.search.retrieval", unit="{search}", description="Hybrid searches by retrieval decision"
+)
+_attempt_duration = histogram(
+    "app.search.attempt.duration", unit="ms", description="Duration of one hybrid search attempt"
+)
+_counts: dict[str, int] = {}
+
+
+def _record(decision: str) -> None:
+    _counts[decision] = _counts.get(decision, 0) + 1
+    _decisions(1, {"decision": decision})
+
+
+@dataclass(frozen=True)
+class RetrievalSettings:
+    """How many neighbors a hybrid search asks for and when the semantic ranker runs.
+
+    In "adaptive" mode a search first asks for `initial_k` neighbors without
+    the semantic ranker and repeats with `escalated_k` neighbors and the
+    ranker only when the hits look unreliable: the top hit is not ranked
+    high by both the keyword and the vector query (`min_agreement`, a
+    share of the best possible score), too few hits were found by both
+    (`min_consensus`), or the hits cover fewer than `min_hotels` hotels.
+    "semantic" always runs the ranker at `escalated_k`, "hybrid" never does.
+    `top` is the number of chunks returned either way.
+    """
+
+    mode: str
+    initial_k: int
+    escalated_k: int
+    top: int
+    min_agreement: float
+    min_consensus: float
+    min_hotels: int
+
+
+def _load_settings() -> RetrievalSettings:
+    mode = os.getenv("SEARCH_RETRIEVAL_MODE", "adaptive")
+    if mode not in ("adaptive", "semantic", "hybrid"):
+        logging.error(f"Unknown SEARCH_RETRIEVAL_MODE '{mode}', using adaptive retrieval.")
+        mode = "adaptive"
+    return RetrievalSettings(
+        mode=mode,
+        initial_k=int(os.getenv("SEARCH_INITIAL_K", "5")),
+        escalated_k=int(os.getenv("SEARCH_ESCALATED_K", "20")),
+        top=int(os.getenv("SEARCH_TOP", "5")),
+        min_agreement=float(os.getenv("SEARCH_MIN_AGREEMENT", "0.97")),
+        min_consensus=float(os.getenv("SEARCH_MIN_CONSENSUS", "0.5")),
+        min_hotels=int(os.getenv("SEARCH_MIN_HOTELS", "2")),
+    )
+
+
+retrieval_settings = _load_settings()
+
+
+def retrieval_stats() -> dict:
+    return {"mode": retrieval_settings.mode, "decisions": dict(_counts)}
+
+
+@dataclass
+class Confidence:
+    hits: int
+    agreement: float
+    consensus: float
+    hotels: int
+    # Why the hits are not good enough, or None.
+    doubt: str | None
+
+
+def assess(results: list[dict], settings: RetrievalSettings) -> Confidence:
+    """How far the hits of a hybrid search without the semantic ranker can be trusted."""
+    scores = [float(result.get("@search.score") or 0.0) for result in results]
+    hotels = len({result.get("Id") for result in results})
+    agreement = max(scores, default=0.0) / _HYBRID_BEST
+    # A score above the best one query can give means both queries found the hit.
+    consensus = (
+        sum(1 for score in scores if score > _SINGLE_QUERY_BEST) / len(scores) if scores else 0.0
+    )
+    doubt = None
+    if not results:
+        # A deeper search cannot find what a filter excludes; the caller relaxes it instead.
+        pass
+    elif agreement < settings.min_agreement:
+        doubt = "agreement"
+    elif consensus < settings.min_consensus:
+        doubt = "consensus"
+    elif hotels < settings.min_hotels and len(results) >= settings.top:
+        doubt = "diversity"
+    return Confidence(
+        hits=len(results), agreement=agreement, consensus=consensus, hotels=hotels, doubt=doubt
+    )
+
+
+async def adaptive_search(
+    search: Callable[[int, int, bool], Awaitable[list[dict]]],
+    query: str,
+    semantic: bool = True,
+    settings: RetrievalSettings | None = None,
+) -> list[dict]:
+    """Runs `search(k, top, use_semantic_ranker)` once, or twice when the first hits are doubtful.
+
+    Every decision is logged on the "retrieval" logger with the scores it
+    was based on and the time of each attempt, to tune the thresholds.
+    """
+    settings = settings or retrieval_settings
+    mode = settings.mode if semantic else "hybrid"
+
+    async def attempt(k: int, use_semantic: bool) -> tuple[list[dict], float]:
+        start = time.perf_counter()
+        results = await search(k, settings.top, use_semantic)
+        elapsed = (time.perf_counter() - start) * 1000
+        _attempt_duration(elapsed, {"semantic": use_semantic})
+        return results, elapsed
+
+    if mode == "semantic":
+        results, elapsed = await attempt(settings.escalated_k, True)
+        _record("semantic")
+        logger.info(
+            "decision=semantic k=%d hits=%d semantic_ms=%.1f query=%r",
+            settings.escalated_k, len(results), elapsed, query[:100],
+        )
+        return results
+
+    results, initial_ms = await attempt(settings.initial_k, False)
+    confidence = assess(results, settings)
+    escalate = mode == "adaptive" and confidence.doubt is not None
+    if escalate:
+        decision = f"escalated:{confidence.doubt}"
+    else:
+        decision = "initial" if results else "empty"
+    escalated_ms = 0.0
+    if escalate:
+        with stage("search-rerank"):
+            results, escalated_ms = await attempt(settings.escalated_k, True)
+    _record(decision)
+    logger.info(
+        "decision=%s hits=%d agreement=%.3f consensus=%.2f hotels=%d "
+        "initial_ms=%.1f escalated_ms=%.1f query=%r",
+        decision, confidence.hits, confidence.agreement, confidence.consensus,
+        confidence.hotels, initial_ms, escalated_ms, query[:100],
+    )
+    return results
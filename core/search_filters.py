@@ -0,0 +1,383 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, fields, replace
+from typing import Awaitable, Callable, Iterable
+
+from core.singleflight import normalize_query
+
+SEARCH_FILTERS_ENABLED = os.getenv("SEARCH_FILTERS_ENABLED", "true").lower() == "true"
+SEARCH_FILTERS_REFRESH_SECONDS = float(os.getenv("SEARCH_FILTERS_REFRESH_SECONDS", "3600"))
+# How soon a vocabulary that failed to load is tried again.
+SEARCH_FILTERS_RETRY_SECONDS = float(os.getenv("SEARCH_FILTERS_RETRY_SECONDS", "60"))
+
+# Filterable hotel fields, in the order a phrase naming several of them is
+# resolved: "New York" and "Washington" are taken as cities, not states.
+FILTER_FIELDS = ("City", "State", "Category", "Tags")
+_ATTRIBUTES = dict(zip(FILTER_FIELDS, ("cities", "states", "categories", "amenities")))
+
+STATE_NAMES = {
+    "AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas", "CA": "California",
+    "CO": "Colorado", "CT": "Connecticut", "DE": "Delaware", "DC": "District of Columbia",
+    "FL": "Florida", "GA": "Georgia", "HI": "Hawaii", "ID": "Idaho", "IL": "Illinois",
+    "IN": "Indiana", "IA": "Iowa", "KS": "Kansas", "KY": "Kentucky", "LA": "Louisiana",
+    "ME": "Maine", "MD": "Maryland", "MA": "Massachusetts", "MI": "Michigan", "MN": "Minnesota",
+    "MS": "Mississippi", "MO": "Missouri", "MT": "Montana", "NE": "Nebraska", "NV": "Nevada",
+    "NH": "New Hampshire", "NJ": "New Jersey", "NM": "New Mexico", "NY": "New York",
+    "NC": "North Carolina", "ND": "North Dakota", "OH": "Ohio", "OK": "Oklahoma", "OR": "Oregon",
+    "PA": "Pennsylvania", "RI": "Rhode Island", "SC": "South Carolina", "SD": "South Dakota",
+    "TN": "Tennessee", "TX": "Texas", "UT": "Utah", "VT": "Vermont", "VA": "Virginia",
+    "WA": "Washington", "WV": "West Virginia", "WI": "Wisconsin", "WY": "Wyoming",
+}
+
+# Other ways guests name a category or amenity; a synonym is only used when
+# its value is in the index.
+SYNONYMS = {
+    "Category": {
+        "cheap": "Budget",
+        "affordable": "Budget",
+        "inexpensive": "Budget",
+        "luxurious": "Luxury",
+        "upscale": "Luxury",
+        "resort": "Resort and Spa",
+        "extended stay": "Extended-Stay",
+    },
+    "Tags": {
+        "wifi": "free wifi",
+        "wi fi": "free wifi",
+        "pet": "pet-friendly",
+        "pets allowed": "pet-friendly",
+        "dog friendly": "pet-friendly",
+        "gym": "fitness center",
+        "swimming pool": "pool",
+        "beach": "beach access",
+        "24 hour reception": "24-hour front desk",
+    },
+}
+
+
+# Words that make a following place name a location constraint ("in Seattle",
+# "near the Portland airport"), or a preceding one ("Seattle hotels"); a list
+# of places continues after one ("in Seattle, Portland or Denver").
+LOCATIVE_CUES = {"in", "near", "around", "at", "to", "inside", "outside", "visiting", "downtown"}
+LOCATION_FOLLOWERS = {"hotel", "motel", "inn", "area", "downtown"}
+LOCATION_CONNECTORS = {",", "or", "and", "/", "the"}
+# A category phrase only counts when a lodging noun follows it ("budget hotel").
+LODGING_NOUNS = {
+    "hotel", "motel", "inn", "stay", "option", "place", "property", "room", "lodging", "accommodation",
+}
+# Words that negate what follows, up to the end of the clause or NEGATION_SCOPE
+# words; "t" is what is left of "don't" and "can't" once split into words.
+NEGATIONS = {
+    "no", "not", "t", "without", "never", "nor", "dont", "doesnt", "isnt", "cant", "wont",
+    "except", "excluding", "avoid", "exclude",
+}
+NEGATION_SCOPE = 6
+CLAUSE_ENDS = {",", ".", ";", ":", "!", "?", "but", "though", "however", "instead"}
+
+
+def odata_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _word(token: str) -> str:
+    """Lower-cased and without a plural "s", so "Pools" matches "pool"."""
+    word = token.lower()
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def _words(text: str) -> tuple[str, ...]:
+    return tuple(_word(token) for token in re.findall(r"[A-Za-z0-9]+", text))
+
+
+def _tokens(text: str) -> list[str]:
+    """The words of `text` and the punctuation that ends clauses or separates places."""
+    return re.findall(r"[A-Za-z0-9]+|[,.;:!?/]", text)
+
+
+@dataclass(frozen=True)
+class SearchFilters:
+    """Constraints on the filterable hotel fields; every field and amenity must match, preferred states need not."""
+
+    cities: tuple[str, ...] = ()
+    states: tuple[str, ...] = ()
+    categories: tuple[str, ...] = ()
+    amenities: tuple[str, ...] = ()
+    # States only named by an ambiguous two-letter code ("Portland, OR"):
+    # matching hotels are ranked first rather than the others filtered out.
+    preferred_states: tuple[str, ...] = ()
+
+    @classmethod
+    def from_fields(cls, values: dict[str, Iterable[str]]) -> "SearchFilters":
+        return cls(
+            *(tuple(dict.fromkeys(values.get(field, ()))) for field in FILTER_FIELDS)
+        )
+
+    def values(self, field: str) -> tuple[str, ...]:
+        return getattr(self, _ATTRIBUTES[field])
+
+    def __bool__(self) -> bool:
+        return any(getattr(self, attribute.name) for attribute in fields(self))
+
+    def merge(self, other: "SearchFilters") -> "SearchFilters":
+        """These filters with each field `other` sets replaced by its values."""
+        return SearchFilters(
+            *(
+                getattr(other, attribute.name) or getattr(self, attribute.name)
+                for attribute in fields(self)
+            )
+        )
+
+    def odata(self) -> str | None:
+        """The OData `filter` expression, or None when there is nothing to filter on.
+
+        Several cities and a state ("Seattle, Portland or anywhere in CA")
+        are alternatives; a single city and a state ("Portland, OR") both apply.
+        """
+        city, state, category = (
+            _any_of(field, values)
+            for field, values in zip(FILTER_FIELDS, (self.cities, self.states, self.categories))
+        )
+        if city and state and len(self.cities) > 1:
+            city, state = f"({city} or {state})", None
+        clauses = [clause for clause in (city, state, category) if clause]
+        clauses.extend(f"Tags/any(t: t eq {odata_literal(amenity)})" for amenity in self.amenities)
+        return " and ".join(clauses) or None
+
+    def rank(self, results: list[dict]) -> list[dict]:
+        """`results` with those in a preferred state first, otherwise in their order."""
+        if not self.preferred_states:
+            return results
+        return sorted(results, key=lambda result: result.get("State") not in self.preferred_states)
+
+    def relaxations(self) -> list[str | None]:
+        """The filter, then its location part alone, then none; each is tried if the previous matches nothing."""
+        return list(
+            dict.fromkeys([self.odata(), SearchFilters(self.cities, self.states).odata(), None])
+        )
+
+
+def search_cache_key(
+    index_name: str, vector_field: str, query: str, filters: SearchFilters
+) -> tuple[str, str, str, str | None, tuple[str, ...]]:
+    """The key of a hotel search's cached results, shared by every user and instance.
+
+    Only queries that differ in case, whitespace or punctuation share it.
+    """
+    return (index_name, vector_field, normalize_query(query), filters.odata(), filters.preferred_states)
+
+
+def _any_of(field: str, values: tuple[str, ...]) -> str | None:
+    if len(values) == 1:
+        return f"{field} eq {odata_literal(values[0])}"
+    if values:
+        return f"search.in({field}, {odata_literal('|'.join(values))}, '|')"
+    return None
+
+
+class Vocabulary:
+    """The values of the filterable fields of one index and the phrases that name them.
+
+    `extract` finds them in free text by greedy longest match over words,
+    so "Resort and Spa" wins over "spa". Since the result becomes a hard
+    filter, a phrase only counts where the text uses it as a constraint:
+    places after a locative cue ("in New York", "near Seattle, WA") or
+    before "hotel(s)", categories before a lodging noun ("budget hotel"),
+    and nothing within a negation ("I don't need a pool"). A place followed
+    by "state" ("Washington state") is taken as a state. Two-letter state
+    codes, which are mostly also words, only count in capitals after "in"
+    or a comma, and only as a preference.
+    """
+
+    def __init__(self, values: dict[str, list[str]]) -> None:
+        self.values = values
+        self._phrases: dict[tuple[str, ...], list[tuple[str, str]]] = {}
+        self._codes: dict[str, str] = {}
+        for field in FILTER_FIELDS:
+            for value in values.get(field, []):
+                if field == "State" and value.upper() in STATE_NAMES:
+                    self._codes[value.upper()] = value
+                    self._add(_words(STATE_NAMES[value.upper()]), field, value)
+                else:
+                    self._add(_words(value), field, value)
+        for field, synonyms in SYNONYMS.items():
+            known = set(values.get(field, []))
+            for phrase, value in synonyms.items():
+                if value in known:
+                    self._add(_words(phrase), field, value)
+        self._longest = max((len(phrase) for phrase in self._phrases), default=0)
+
+    def _add(self, phrase: tuple[str, ...], field: str, value: str) -> None:
+        if phrase and (field, value) not in self._phrases.get(phrase, []):
+            self._phrases.setdefault(phrase, []).append((field, value))
+
+    def __len__(self) -> int:
+        return sum(len(values) for values in self.values.values())
+
+    def _admits(
+        self, field: str, tokens: list[str], words: list[str], position: int, length: int, locative: bool
+    ) -> bool:
+        end = position + length
+        following = words[end] if end < len(words) else None
+        if field == "State" and (following == "state" or words[position - 2:position] == ["state", "of"]):
+            return True
+        if field in ("City", "State"):
+            # "Portland, OR" names its state right after the city.
+            coded = following == "," and end + 1 < len(tokens) and tokens[end + 1] in self._codes
+            return locative or following in LOCATION_FOLLOWERS or coded
+        if field == "Category":
+            return following in LODGING_NOUNS or words[end - 1] in LODGING_NOUNS
+        return True
+
+    def _match(
+        self,
+        tokens: list[str],
+        words: list[str],
+        position: int,
+        allowed: set[str],
+        cued: bool,
+        locative: bool,
+    ) -> tuple[int, str, str] | None:
+        """The longest phrase at `position` naming a value of an allowed field, as (length, field, value)."""
+        for length in range(min(self._longest, len(words) - position), 0, -1):
+            matches = [
+                (field, value)
+                for field, value in self._phrases.get(tuple(words[position:position + length]), [])
+                if field in allowed
+                and (not cued or self._admits(field, tokens, words, position, length, locative))
+            ]
+            if not matches:
+                continue
+            following = words[position + length] if position + length < len(words) else None
+            if following == "state" or words[position - 2:position] == ["state", "of"]:
+                # "Washington state" and "the state of New York" name the state.
+                matches.sort(key=lambda match: match[0] != "State")
+            return length, *matches[0]
+        return None
+
+    def extract(
+        self, text: str, only: Iterable[str] = FILTER_FIELDS, cued: bool = True
+    ) -> SearchFilters:
+        """The constraints `text` names; with `cued` off, e.g. for a value given as a parameter, any mention counts."""
+        allowed = set(only)
+        tokens = _tokens(text)
+        words = [_word(token) for token in tokens]
+        found: dict[str, list[str]] = {field: [] for field in FILTER_FIELDS}
+        preferred: list[str] = []
+        locative = not cued
+        negated = 0
+        position = 0
+        while position < len(words):
+            word = words[position]
+            if word in CLAUSE_ENDS:
+                negated = 0
+            if cued and word in NEGATIONS:
+                negated = NEGATION_SCOPE
+                locative = False
+                position += 1
+                continue
+
+            match = self._match(tokens, words, position, allowed, cued, locative)
+            if match is not None:
+                length, field, value = match
+                if not negated:
+                    found[field].append(value)
+                # A list of places keeps the cue of its first one.
+                locative = locative and field in ("City", "State") or not cued
+            else:
+                length = 1
+                token = tokens[position]
+                previous = words[position - 1] if position else None
+                if "State" in allowed and token in self._codes and (not cued or previous in ("in", ",")):
+                    if not negated:
+                        (found["State"] if not cued else preferred).append(self._codes[token])
+                elif cued:
+                    locative = word in LOCATIVE_CUES or locative and word in LOCATION_CONNECTORS
+            negated = max(0, negated - length)
+            position += length
+        return replace(SearchFilters.from_fields(found), preferred_states=tuple(dict.fromkeys(preferred)))
+
+    def resolve(self, field: str, requested: Iterable[str]) -> list[str]:
+        """The index values for `requested` values of `field`; unknown ones are dropped."""
+        by_case = {value.lower(): value for value in self.values.get(field, [])}
+        resolved = []
+        for value in requested:
+            if value.lower() in by_case:
+                resolved.append(by_case[value.lower()])
+                continue
+            matched = self.extract(value, only=(field,), cued=False).values(field)
+            if matched:
+                resolved.extend(matched)
+            else:
+                logging.info(f"Ignoring {field} filter '{value}', which is not in the index.")
+        return resolved
+
+
+class _Entry:
+    def __init__(self) -> None:
+        self.vocabulary: Vocabulary | None = None
+        self.loaded_at: float | None = None
+        self.next_refresh = 0.0
+        self.failures = 0
+        self.task: asyncio.Task | None = None
+
+
+class Gazetteer:
+    """The filter vocabulary of each index, reloaded in the background when it gets old.
+
+    Only the first request for an index waits for the load; later ones keep
+    using the current vocabulary while a refresh runs, and keep it if the
+    refresh fails.
+    """
+
+    def __init__(self, refresh_seconds: float, retry_seconds: float) -> None:
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+        self._entries: dict[str, _Entry] = {}
+
+    async def get(
+        self, index_name: str, load: Callable[[], Awaitable[dict[str, list[str]]]]
+    ) -> Vocabulary | None:
+        entry = self._entries.setdefault(index_name, _Entry())
+        if entry.task is None and time.monotonic() >= entry.next_refresh:
+            entry.task = asyncio.create_task(self._refresh(index_name, entry, load))
+        if entry.vocabulary is None and entry.task is not None:
+            await asyncio.shield(entry.task)
+        return entry.vocabulary
+
+    async def _refresh(
+        self,
+        index_name: str,
+        entry: _Entry,
+        load: Callable[[], Awaitable[dict[str, list[str]]]],
+    ) -> None:
+        try:
+            entry.vocabulary = Vocabulary(await load())
+            entry.loaded_at = time.monotonic()
+            entry.next_refresh = entry.loaded_at + self.refresh_seconds
+        except Exception as e:
+            entry.failures += 1
+            entry.next_refresh = time.monotonic() + self.retry_seconds
+            logging.warning(f"Loading the filter vocabulary of {index_name} failed: {e}")
+        finally:
+            entry.task = None
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            index_name: {
+                "values": len(entry.vocabulary) if entry.vocabulary else 0,
+                "age_seconds": round(now - entry.loaded_at, 1) if entry.loaded_at else None,
+                "failures": entry.failures,
+            }
+            for index_name, entry in self._entries.items()
+        }
+
+
+gazetteer = Gazetteer(
+    refresh_seconds=SEARCH_FILTERS_REFRESH_SECONDS, retry_seconds=SEARCH_FILTERS_RETRY_SECONDS
+)
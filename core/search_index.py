@@ -0,0 +1,263 @@
+import os
+import json
+import logging
+from dataclasses import dataclass, replace
+
+from azure.search.documents.indexes.models import (
+    AzureOpenAIVectorizer,
+    AzureOpenAIVectorizerParameters,
+    BinaryQuantizationCompression,
+    ExhaustiveKnnAlgorithmConfiguration,
+    ExhaustiveKnnParameters,
+    HnswAlgorithmConfiguration,
+    HnswParameters,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    SearchableField,
+    SearchField,
+    SearchFieldDataType,
+    SearchIndex,
+    SemanticConfiguration,
+    SemanticField,
+    SemanticPrioritizedFields,
+    SemanticSearch,
+    SimpleField,
+    VectorSearch,
+    VectorSearchProfile,
+)
+
+from core.embeddings import embedding_settings
+
+VECTORIZER_NAME = "openai-vectorizer"
+
+
+@dataclass(frozen=True)
+class VectorIndexProfile:
+    """How a vector field is indexed: the algorithm, its parameters and optional compression.
+
+    `algorithm` is "hnsw" or "exhaustiveKnn". With `compression` set to
+    "scalar" (int8) or "binary" the graph is built over quantized vectors;
+    `oversampling` times k candidates are then rescored with the original
+    full-precision vectors when `rerank` is true.
+    """
+
+    name: str
+    algorithm: str = "hnsw"
+    metric: str = "cosine"
+    m: int = 4
+    ef_construction: int = 400
+    ef_search: int = 500
+    compression: str | None = None
+    oversampling: float | None = None
+    rerank: bool = True
+
+
+# The service defaults first; the others trade recall, latency and memory.
+PROFILES = {
+    profile.name: profile
+    for profile in (
+        VectorIndexProfile("default"),
+        VectorIndexProfile("hnsw-fast", m=4, ef_construction=200, ef_search=100),
+        VectorIndexProfile("hnsw-recall", m=16, ef_construction=600, ef_search=800),
+        VectorIndexProfile("exhaustive", algorithm="exhaustiveKnn"),
+        VectorIndexProfile("scalar", m=8, ef_search=200, compression="scalar", oversampling=4.0),
+        VectorIndexProfile("binary", m=8, ef_search=200, compression="binary", oversampling=10.0),
+    )
+}
+
+
+def _load_profiles() -> dict[str, VectorIndexProfile]:
+    """PROFILES with the overrides and additions from SEARCH_VECTOR_PROFILES (JSON)."""
+    profiles = dict(PROFILES)
+    raw = os.getenv("SEARCH_VECTOR_PROFILES")
+    if not raw:
+        return profiles
+    try:
+        for name, settings in json.loads(raw).items():
+            base = profiles.get(name, VectorIndexProfile(name))
+            profiles[name] = replace(base, **settings)
+    except (ValueError, TypeError) as e:
+        logging.error(f"SEARCH_VECTOR_PROFILES is invalid, ignoring it: {e}")
+        return dict(PROFILES)
+    return profiles
+
+
+profiles = _load_profiles()
+
+
+def get_profile(name: str | None = None) -> VectorIndexProfile:
+    """The named profile, or the one selected by SEARCH_VECTOR_PROFILE."""
+    name = name or os.getenv("SEARCH_VECTOR_PROFILE", "default")
+    if name not in profiles:
+        raise ValueError(f"Unknown vector index profile '{name}', expected one of {sorted(profiles)}")
+    return profiles[name]
+
+
+def vector_search(*index_profiles: VectorIndexProfile, vectorizer: bool = False) -> VectorSearch:
+    """The VectorSearch section defining each profile under its own name."""
+    algorithms = []
+    compressions = []
+    search_profiles = []
+    for profile in index_profiles:
+        algorithm_name = f"{profile.name}-algorithm"
+        if profile.algorithm == "exhaustiveKnn":
+            algorithms.append(
+                ExhaustiveKnnAlgorithmConfiguration(
+                    name=algorithm_name,
+                    parameters=ExhaustiveKnnParameters(metric=profile.metric),
+                )
+            )
+        else:
+            algorithms.append(
+                HnswAlgorithmConfiguration(
+                    name=algorithm_name,
+                    parameters=HnswParameters(
+                        m=profile.m,
+                        ef_construction=profile.ef_construction,
+                        ef_search=profile.ef_search,
+                        metric=profile.metric,
+                    ),
+                )
+            )
+
+        compression_name = None
+        if profile.compression:
+            compression_name = f"{profile.name}-compression"
+            if profile.compression == "scalar":
+                compressions.append(
+                    ScalarQuantizationCompression(
+                        compression_name=compression_name,
+                        rerank_with_original_vectors=profile.rerank,
+                        default_oversampling=profile.oversampling,
+                        parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+                    )
+                )
+            elif profile.compression == "binary":
+                compressions.append(
+                    BinaryQuantizationCompression(
+                        compression_name=compression_name,
+                        rerank_with_original_vectors=profile.rerank,
+                        default_oversampling=profile.oversampling,
+                    )
+                )
+            else:
+                raise ValueError(f"Unknown compression '{profile.compression}' in profile '{profile.name}'")
+
+        search_profiles.append(
+            VectorSearchProfile(
+                name=profile.name,
+                algorithm_configuration_name=algorithm_name,
+                compression_name=compression_name,
+                vectorizer_name=VECTORIZER_NAME if vectorizer else None,
+            )
+        )
+
+    return VectorSearch(
+        algorithms=algorithms,
+        compressions=compressions or None,
+        profiles=search_profiles,
+        vectorizers=[_openai_vectorizer()] if vectorizer else None,
+    )
+
+
+def add_profile(index: SearchIndex, profile: VectorIndexProfile) -> None:
+    """Adds `profile` to an existing index definition unless a profile of that name is there."""
+    if index.vector_search is None:
+        index.vector_search = VectorSearch(algorithms=[], profiles=[])
+    current = index.vector_search
+    if any(existing.name == profile.name for existing in current.profiles or []):
+        return
+    has_vectorizer = any(
+        vectorizer.vectorizer_name == VECTORIZER_NAME for vectorizer in current.vectorizers or []
+    )
+    section = vector_search(profile, vectorizer=True)
+    current.algorithms = (current.algorithms or []) + (section.algorithms or [])
+    current.compressions = (current.compressions or []) + (section.compressions or []) or None
+    current.profiles = (current.profiles or []) + (section.profiles or [])
+    if not has_vectorizer:
+        current.vectorizers = (current.vectorizers or []) + (section.vectorizers or [])
+
+
+def vector_field(name: str, dimensions: int, profile: VectorIndexProfile) -> SearchField:
+    return SearchField(
+        name=name,
+        type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+        searchable=True,
+        vector_search_dimensions=dimensions,
+        vector_search_profile_name=profile.name,
+    )
+
+
+def _openai_vectorizer() -> AzureOpenAIVectorizer:
+    deployment = embedding_settings.model
+    return AzureOpenAIVectorizer(
+        vectorizer_name=VECTORIZER_NAME,
+        parameters=AzureOpenAIVectorizerParameters(
+            resource_url=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            deployment_name=deployment,
+            model_name=deployment,
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        ),
+    )
+
+
+def hotel_index(
+    name: str,
+    profile: VectorIndexProfile,
+    vector_fields: dict[str, int] | None = None,
+) -> SearchIndex:
+    """The hotel chunk index searched by the chat routes.
+
+    `vector_fields` maps field names to dimensions, all indexed with
+    `profile`; by default it is the configured field at the configured size.
+    """
+    vector_fields = vector_fields or {embedding_settings.vector_field: embedding_settings.size}
+    return SearchIndex(
+        name=name,
+        fields=[
+            SearchField(
+                name="chunk_id",
+                type=SearchFieldDataType.String,
+                key=True,
+                analyzer_name="keyword",
+            ),
+            SimpleField(name="parent_id", type=SearchFieldDataType.String, filterable=True),
+            SearchableField(name="chunk", type=SearchFieldDataType.String),
+            *(
+                vector_field(field_name, dimensions, profile)
+                for field_name, dimensions in vector_fields.items()
+            ),
+            SimpleField(name="Id", type=SearchFieldDataType.String, filterable=True),
+            SearchableField(name="HotelName", type=SearchFieldDataType.String),
+            SearchableField(
+                name="Category", type=SearchFieldDataType.String, filterable=True, facetable=True
+            ),
+            SearchableField(
+                name="City", type=SearchFieldDataType.String, filterable=True, facetable=True
+            ),
+            SearchableField(
+                name="State", type=SearchFieldDataType.String, filterable=True, facetable=True
+            ),
+            SearchableField(
+                name="Tags",
+                collection=True,
+                type=SearchFieldDataType.String,
+                filterable=True,
+                facetable=True,
+            ),
+        ],
+        vector_search=vector_search(profile, vectorizer=True),
+        semantic_search=SemanticSearch(
+            default_configuration_name=os.getenv("SEMANTIC_CONFIGURATION_NAME", "default"),
+            configurations=[
+                SemanticConfiguration(
+                    name=os.getenv("SEMANTIC_CONFIGURATION_NAME", "default"),
+                    prioritized_fields=SemanticPrioritizedFields(
+                        title_field=SemanticField(field_name="HotelName"),
+                        content_fields=[SemanticField(field_name="chunk")],
+                        keywords_fields=[SemanticField(field_name="Tags")],
+                    ),
+                )
+            ],
+        ),
+    )
@@ -0,0 +1,98 @@
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Session(Generic[T]):
+    value: T
+    last_access: float
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    tokens: int = 0
+    bytes: int = 0
+
+
+class BoundedSessionStore(Generic[T]):
+    """In-memory per-session state with LRU eviction, idle TTL and a token cap.
+
+    `measure` returns the (tokens, bytes) held by a value and `trim` drops
+    the oldest content until the value fits in the given token budget.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], T],
+        measure: Callable[[T], tuple[int, int]],
+        trim: Callable[[T, int], int],
+        max_sessions: int,
+        idle_ttl: float,
+        max_tokens_per_session: int,
+    ) -> None:
+        self._factory = factory
+        self._measure = measure
+        self._trim = trim
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_tokens_per_session = max_tokens_per_session
+        self._sessions: OrderedDict[str, _Session[T]] = OrderedDict()
+        self._evicted_lru = 0
+        self._evicted_idle = 0
+        self._trimmed = 0
+
+    @asynccontextmanager
+    async def session(self, session_id: str) -> AsyncIterator[T]:
+        """Yields the session's value, serializing turns of the same session."""
+        entry = self._checkout(session_id)
+        async with entry.lock:
+            try:
+                yield entry.value
+            finally:
+                self._trimmed += self._trim(entry.value, self.max_tokens_per_session)
+                entry.tokens, entry.bytes = self._measure(entry.value)
+                entry.last_access = time.monotonic()
+
+    def _checkout(self, session_id: str) -> _Session[T]:
+        now = time.monotonic()
+        self._expire(now)
+
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            entry = _Session(value=self._factory(), last_access=now)
+            self._sessions[session_id] = entry
+            while len(self._sessions) > self.max_sessions:
+                oldest_id, oldest = next(iter(self._sessions.items()))
+                if oldest.lock.locked():
+                    break
+                del self._sessions[oldest_id]
+                self._evicted_lru += 1
+        else:
+            entry.last_access = now
+
+        self._sessions.move_to_end(session_id)
+        return entry
+
+    def _expire(self, now: float) -> None:
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if now - entry.last_access < self.idle_ttl or entry.lock.locked():
+                break
+            del self._sessions[session_id]
+            self._evicted_idle += 1
+
+    def stats(self) -> dict[str, int]:
+        self._expire(time.monotonic())
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "tokens": sum(entry.tokens for entry in self._sessions.values()),
+            "bytes": sum(entry.bytes for entry in self._sessions.values()),
+            "max_tokens_per_session": self.max_tokens_per_session,
+            "evicted_lru": self._evicted_lru,
+            "evicted_idle": self._evicted_idle,
+            "trimmed_messages": self._trimmed,
+        }
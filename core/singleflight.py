@@ -0,0 +1,95 @@
+import re
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+from core.telemetry import register_gauge
+
+T = TypeVar("T")
+
+
+def normalize_query(text: str) -> str:
+    """Folds case, whitespace and punctuation only; word order and repeats change what a query means."""
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def fingerprint(value: Any) -> str:
+    """A short stable key for JSON-like arguments such as a list of chat messages."""
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs one call per key at a time and hands its outcome to every concurrent caller.
+
+    The call runs in its own task, so a caller that is cancelled does not
+    fail the others; it is only cancelled once nobody waits for it anymore.
+    Successful results stay shareable for `grace` seconds after completion
+    to absorb callers arriving just behind; failures are not kept.
+    """
+
+    def __init__(self, name: str, grace: float = 0.5) -> None:
+        self.name = name
+        self.grace = grace
+        self.executed = 0
+        self.shared = 0
+        self._flights: dict[Hashable, _Flight] = {}
+        _groups.append(self)
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        flight = self._flights.get(key)
+        if flight is None:
+            self.executed += 1
+            flight = self._flights[key] = _Flight(asyncio.ensure_future(call()))
+            flight.task.add_done_callback(lambda task: self._landed(key, flight))
+        else:
+            self.shared += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _landed(self, key: Hashable, flight: _Flight) -> None:
+        if flight.task.cancelled() or flight.task.exception() is not None or self.grace <= 0:
+            self._forget(key, flight)
+        else:
+            asyncio.get_running_loop().call_later(self.grace, self._forget, key, flight)
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        return {"executed": self.executed, "shared": self.shared, "in_flight": len(self._flights)}
+
+
+_groups: list[SingleFlight] = []
+
+
+def singleflight_stats() -> dict:
+    return {group.name: group.stats() for group in _groups}
+
+
+register_gauge(
+    "app.singleflight.calls",
+    unit="{call}",
+    description="Upstream calls executed or shared with a concurrent identical call",
+    observe=lambda: [
+        (count, {"group": group.name, "outcome": outcome})
+        for group in _groups
+        for outcome, count in (("executed", group.executed), ("shared", group.shared))
+    ],
+)
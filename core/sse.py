@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import functools
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable
+
+from azurefunctions.extensions.http.fastapi import StreamingResponse
+
+HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "20"))
+REPLAY_EVENTS = int(os.getenv("SSE_REPLAY_EVENTS", "4096"))
+RETAIN_SECONDS = float(os.getenv("SSE_RETAIN_SECONDS", "120"))
+MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "256"))
+
+HEARTBEAT = b": keep-alive\n\n"
+STREAM_HEADER = "X-Stream-Id"
+
+_pumps: set[asyncio.Task] = set()
+
+
+@dataclass
+class SSEEvent:
+    """One typed event: token, tool_status, usage, error or done."""
+
+    event: str
+    data: Any
+
+
+def token(text: str) -> SSEEvent:
+    return SSEEvent("token", {"text": text})
+
+
+def encode(event_id: str | None, event: str, data: Any) -> bytes:
+    payload = data if isinstance(data, str) else json.dumps(data, separators=(",", ":"))
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in payload.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+class EventStream:
+    """The framed events of one response, kept for replay while it runs and shortly after.
+
+    A background task drains the source, so the generation finishes even if
+    the client disconnects, and a reconnect with `Last-Event-ID` picks up
+    from the buffer. Token events arriving within COALESCE_MS of each other
+    are merged into one frame. Only the last `max_events` frames are kept.
+    """
+
+    def __init__(self, source: AsyncIterator[SSEEvent], max_events: int) -> None:
+        self.id = uuid.uuid4().hex
+        self.done = False
+        self.finished_at: float | None = None
+        self.subscribers = 0
+        self._frames: deque[tuple[int, bytes]] = deque(maxlen=max_events)
+        self._sequence = 0
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(source))
+        # The event loop only holds weak references to tasks.
+        _pumps.add(self._task)
+        self._task.add_done_callback(_pumps.discard)
+
+    def can_resume(self, after: int) -> bool:
+        """Whether every frame after `after` is still buffered."""
+        oldest = self._frames[0][0] if self._frames else self._sequence + 1
+        return oldest <= after + 1 and after <= self._sequence
+
+    def _append(self, event: str, data: Any) -> None:
+        self._sequence += 1
+        self._frames.append((self._sequence, encode(f"{self.id}.{self._sequence}", event, data)))
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _pump(self, source: AsyncIterator[SSEEvent]) -> None:
+        queue: asyncio.Queue[SSEEvent | None] = asyncio.Queue()
+
+        async def read() -> None:
+            try:
+                async for event in source:
+                    await queue.put(event)
+            finally:
+                await queue.put(None)
+
+        reader = asyncio.create_task(read())
+        pending: list[str] = []
+        try:
+            while True:
+                if pending:
+                    try:
+                        event = await asyncio.wait_for(queue.get(), COALESCE_MS / 1000)
+                    except asyncio.TimeoutError:
+                        self._append("token", {"text": "".join(pending)})
+                        pending.clear()
+                        continue
+                else:
+                    event = await queue.get()
+
+                if event is not None and event.event == "token":
+                    pending.append(event.data["text"])
+                    continue
+                if pending:
+                    self._append("token", {"text": "".join(pending)})
+                    pending.clear()
+                if event is None:
+                    break
+                self._append(event.event, event.data)
+
+            await reader
+            self._append("done", {})
+        except Exception as e:
+            logging.error(f"Event stream {self.id} failed: {e}")
+            if pending:
+                self._append("token", {"text": "".join(pending)})
+            self._append("error", _error_data(e))
+        except asyncio.CancelledError:
+            reader.cancel()
+            raise
+        finally:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._changed.set()
+
+    async def subscribe(self, after: int = 0) -> AsyncIterator[bytes]:
+        """Frames after sequence `after`, then new ones as they come, with keep-alive comments."""
+        self.subscribers += 1
+        position = after
+        try:
+            while True:
+                for sequence, frame in list(self._frames):
+                    if sequence > position:
+                        position = sequence
+                        yield frame
+                if self.done and position >= self._sequence:
+                    return
+                changed = self._changed
+                try:
+                    await asyncio.wait_for(changed.wait(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+        finally:
+            self.subscribers -= 1
+
+
+def _error_data(error: BaseException) -> dict:
+    import openai
+    from core.resilience import DependencyUnavailable
+
+    if isinstance(error, DependencyUnavailable):
+        return {"message": "The service is temporarily unavailable, please try again shortly.", "status": 503}
+    if isinstance(error, TimeoutError):
+        return {"message": "The response took too long.", "status": 504}
+    cause: BaseException | None = error
+    while cause is not None and not isinstance(cause, openai.APIError):
+        cause = cause.__cause__
+    if isinstance(cause, openai.RateLimitError):
+        return {"message": "The model is busy, please try again shortly.", "status": 429}
+    if isinstance(cause, openai.APIError):
+        return {"message": "The model request failed.", "status": 502}
+    return {"message": "The response could not be completed.", "status": 500}
+
+
+class StreamRegistry:
+    """Recent event streams by id; finished ones are dropped after `retain_seconds`."""
+
+    def __init__(self, max_streams: int, retain_seconds: float, max_events: int) -> None:
+        self.max_streams = max_streams
+        self.retain_seconds = retain_seconds
+        self.max_events = max_events
+        self.resumed = 0
+        self._streams: OrderedDict[str, EventStream] = OrderedDict()
+
+    def start(self, source: AsyncIterator[SSEEvent]) -> EventStream:
+        self._expire()
+        stream = EventStream(source, max_events=self.max_events)
+        self._streams[stream.id] = stream
+        while len(self._streams) > self.max_streams:
+            # Unfinished streams keep running for their current subscriber,
+            # they just can no longer be resumed.
+            self._streams.popitem(last=False)
+        return stream
+
+    def get(self, stream_id: str) -> EventStream | None:
+        self._expire()
+        return self._streams.get(stream_id)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for stream_id, stream in list(self._streams.items()):
+            if stream.finished_at is not None and now - stream.finished_at > self.retain_seconds:
+                del self._streams[stream_id]
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "running": sum(1 for stream in self._streams.values() if not stream.done),
+            "subscribers": sum(stream.subscribers for stream in self._streams.values()),
+            "resumed": self.resumed,
+        }
+
+
+streams = StreamRegistry(
+    max_streams=MAX_STREAMS, retain_seconds=RETAIN_SECONDS, max_events=REPLAY_EVENTS
+)
+
+
+def _headers(stream: EventStream, headers: dict[str, str] | None) -> dict[str, str]:
+    return {
+        "Cache-Control": "no-cache",
+        # Ask reverse proxies not to buffer the stream.
+        "X-Accel-Buffering": "no",
+        STREAM_HEADER: stream.id,
+        **(headers or {}),
+    }
+
+
+def sse_response(
+    source: AsyncIterator[SSEEvent], headers: dict[str, str] | None = None
+) -> StreamingResponse:
+    """Streams `source` as server-sent events that a client can resume with Last-Event-ID."""
+    stream = streams.start(source)
+    return StreamingResponse(
+        stream.subscribe(), media_type="text/event-stream", headers=_headers(stream, headers)
+    )
+
+
+def resumable(handler: Callable[..., Any]) -> Callable[..., Any]:
+    """Serves a reconnect carrying `Last-Event-ID` from the buffered stream.
+
+    The handler only runs, and regenerates the answer, when the stream is
+    unknown to this worker or has scrolled out of the replay buffer.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        req = kwargs.get("req", args[0] if args else None)
+        last_event_id = req.headers.get("Last-Event-ID") if req is not None else None
+        if last_event_id:
+            stream_id, _, sequence = last_event_id.partition(".")
+            stream = streams.get(stream_id)
+            if stream is not None and sequence.isdigit() and stream.can_resume(int(sequence)):
+                streams.resumed += 1
+                return StreamingResponse(
+                    stream.subscribe(after=int(sequence)),
+                    media_type="text/event-stream",
+                    headers=_headers(stream, None),
+                )
+        return await handler(*args, **kwargs)
+
+    return wrapper
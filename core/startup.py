@@ -0,0 +1,98 @@
+import time
+import asyncio
+import inspect
+import logging
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Generic, Iterator, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger("startup")
+
+_imports: dict[str, float] = {}
+_inits: dict[str, float] = {}
+_warm_up_hooks: list[Callable[[], Awaitable[None]]] = []
+_process_start = time.perf_counter()
+
+
+@contextmanager
+def profile_import(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _imports[name] = (time.perf_counter() - start) * 1000
+
+
+@contextmanager
+def profile_init(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _inits[name] = (time.perf_counter() - start) * 1000
+
+
+def startup_report() -> dict[str, Any]:
+    return {
+        "import_ms": dict(_imports),
+        "init_ms": dict(_inits),
+        "uptime_ms": (time.perf_counter() - _process_start) * 1000,
+    }
+
+
+def log_startup_report() -> None:
+    report = startup_report()
+    for kind in ("import_ms", "init_ms"):
+        for name, elapsed in sorted(
+            report[kind].items(), key=lambda item: item[1], reverse=True
+        ):
+            logger.info("%s %s: %.1f ms", kind.removesuffix("_ms"), name, elapsed)
+
+
+class AsyncLazy(Generic[T]):
+    """Builds a value on first use; concurrent first callers wait for the same build."""
+
+    def __init__(self, name: str, factory: Callable[[], T | Awaitable[T]]) -> None:
+        self.name = name
+        self._factory = factory
+        self._value: T | None = None
+        self._initialized = False
+        self._lock: asyncio.Lock | None = None
+
+    @property
+    def initialized(self) -> bool:
+        return self._initialized
+
+    async def get(self) -> T:
+        if self._initialized:
+            return self._value  # type: ignore[return-value]
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not self._initialized:
+                with profile_init(self.name):
+                    value = self._factory()
+                    if inspect.isawaitable(value):
+                        value = await value
+                self._value = value  # type: ignore[assignment]
+                self._initialized = True
+
+        return self._value  # type: ignore[return-value]
+
+
+def register_warm_up(hook: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+    _warm_up_hooks.append(hook)
+    return hook
+
+
+async def warm_up() -> None:
+    results = await asyncio.gather(
+        *[hook() for hook in _warm_up_hooks], return_exceptions=True
+    )
+    for hook, result in zip(_warm_up_hooks, results):
+        if isinstance(result, BaseException):
+            logger.warning("Warm-up hook %s failed: %s", hook.__qualname__, result)
+    log_startup_report()
@@ -0,0 +1,258 @@
+import os
+import re
+import time
+import logging
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator
+
+try:
+    from opentelemetry import metrics, trace
+except ImportError:  # pragma: no cover - tracing is optional
+    metrics = None
+    trace = None
+
+_tracer = trace.get_tracer("az-chat-app") if trace else None
+_meter = metrics.get_meter("az-chat-app") if metrics else None
+
+if _meter is not None:
+    _stage_duration = _meter.create_histogram(
+        "app.stage.duration", unit="ms", description="Duration of a request stage"
+    )
+    _ttft = _meter.create_histogram(
+        "llm.time_to_first_token", unit="ms", description="Time to first streamed token"
+    )
+    _stream_duration = _meter.create_histogram(
+        "llm.stream.duration", unit="ms", description="Duration of a streamed completion"
+    )
+    _tokens_per_second = _meter.create_histogram(
+        "llm.tokens_per_second", unit="{token}/s", description="Completion throughput"
+    )
+
+
+def configure_telemetry() -> None:
+    """Exports spans and metrics over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set."""
+    if trace is None or not os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return
+    try:
+        from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import (
+            OTLPMetricExporter,
+        )
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+            OTLPSpanExporter,
+        )
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logging.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but the OpenTelemetry SDK is not installed.")
+        return
+
+    resource = Resource.create(
+        {"service.name": os.getenv("OTEL_SERVICE_NAME", "az-chat-app")}
+    )
+    tracer_provider = TracerProvider(resource=resource)
+    tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(tracer_provider)
+    metrics.set_meter_provider(  # pyright: ignore
+        MeterProvider(
+            resource=resource,
+            metric_readers=[PeriodicExportingMetricReader(OTLPMetricExporter())],
+        )
+    )
+
+
+@dataclass
+class RequestTimings:
+    stages: list[tuple[str, float]] = field(default_factory=list)
+
+    def add(self, name: str, elapsed_ms: float) -> None:
+        self.stages.append((name, elapsed_ms))
+
+    def total(self, name: str) -> float:
+        return sum(elapsed for stage, elapsed in self.stages if stage == name)
+
+    def header(self) -> str:
+        return ", ".join(
+            f"{re.sub(r'[^A-Za-z0-9_-]', '-', name)};dur={elapsed:.1f}"
+            for name, elapsed in self.stages
+        )
+
+
+current_timings: ContextVar[RequestTimings | None] = ContextVar(
+    "current_timings", default=None
+)
+
+
+@contextmanager
+def request_timings() -> Iterator[RequestTimings]:
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+def server_timing(handler: Callable[..., Any]) -> Callable[..., Any]:
+    """Collects the handler's stages and returns them in a Server-Timing header.
+
+    Only stages that finish before the response is returned are reported;
+    time spent streaming the body is recorded on the spans instead.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with request_timings() as timings:
+            response = await handler(*args, **kwargs)
+        if timings.stages and hasattr(response, "headers"):
+            response.headers["Server-Timing"] = timings.header()
+        return response
+
+    return wrapper
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+@contextmanager
+def stage(name: str, **attributes: Any) -> Iterator[Any]:
+    """A span that is also reported in the request's Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        with span(name, **attributes) as current:
+            yield current
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add(name, elapsed)
+        if _meter is not None:
+            _stage_duration.record(elapsed, {"stage": name})
+
+
+def histogram(name: str, unit: str, description: str) -> Callable[[float, dict[str, Any]], None]:
+    """Returns a recorder for a histogram; it does nothing when OpenTelemetry is missing."""
+    if _meter is None:
+        return lambda value, attributes: None
+    instrument = _meter.create_histogram(name, unit=unit, description=description)
+    return lambda value, attributes: instrument.record(value, attributes)
+
+
+def counter(name: str, unit: str, description: str) -> Callable[[float, dict[str, Any]], None]:
+    """Returns an incrementer for a counter; it does nothing when OpenTelemetry is missing."""
+    if _meter is None:
+        return lambda value, attributes: None
+    instrument = _meter.create_counter(name, unit=unit, description=description)
+    return lambda value, attributes: instrument.add(value, attributes)
+
+
+def register_gauge(
+    name: str,
+    unit: str,
+    description: str,
+    observe: Callable[[], Iterable[tuple[float, dict[str, Any]]]],
+) -> None:
+    """Reports the (value, attributes) pairs returned by `observe` on every metric export."""
+    if _meter is None:
+        return
+    _meter.create_observable_gauge(
+        name,
+        callbacks=[
+            lambda options: [
+                metrics.Observation(value, attributes)  # pyright: ignore
+                for value, attributes in observe()
+            ]
+        ],
+        unit=unit,
+        description=description,
+    )
+
+
+def cached_tokens(usage: Any) -> int:
+    """Prompt tokens served from the prompt cache, when the usage reports them."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def record_usage(
+    model: str, prompt_tokens: int, completion_tokens: int, cached: int = 0
+) -> None:
+    """Records one model call's tokens and charges them to the current session.
+
+    `core.usage.account` is their only counter (app.llm.usage.tokens), so a
+    completion's tokens are counted once.
+    """
+    from core.usage import account
+
+    account(model, prompt_tokens, completion_tokens, cached)
+
+
+async def instrument_stream(
+    stream: AsyncIterator[Any],
+    name: str,
+    model: str,
+    text_of: Callable[[Any], str | None],
+    usage_of: Callable[[Any], Any],
+) -> AsyncIterator[Any]:
+    """Passes a completion stream through while recording TTFT, throughput and usage.
+
+    A stream of several completions, like the rounds of automatic function
+    calling, reports usage once per completion; each is recorded.
+    """
+    start = time.perf_counter()
+    first_token: float | None = None
+    chunks = 0
+    prompt_tokens = completion_tokens = 0
+    usages = 0
+    current = _tracer.start_span(name, attributes={"llm.model": model}) if _tracer else None
+    try:
+        async for chunk in stream:
+            if text_of(chunk):
+                chunks += 1
+                if first_token is None:
+                    first_token = time.perf_counter()
+            usage = usage_of(chunk)
+            if usage:
+                usages += 1
+                prompt_tokens += usage.prompt_tokens or 0
+                completion_tokens += usage.completion_tokens or 0
+                record_usage(
+                    model, usage.prompt_tokens or 0, usage.completion_tokens or 0, cached_tokens(usage)
+                )
+            yield chunk
+    finally:
+        end = time.perf_counter()
+        if not usages:
+            completion_tokens = chunks
+        attributes: dict[str, Any] = {"llm.model": model, "llm.completion_tokens": completion_tokens}
+        if usages:
+            attributes["llm.prompt_tokens"] = prompt_tokens
+        if first_token is not None:
+            ttft = (first_token - start) * 1000
+            generation = end - first_token
+            attributes["llm.ttft_ms"] = ttft
+            timings = current_timings.get()
+            if timings is not None:
+                timings.add("ttft", ttft)
+            if generation > 0:
+                attributes["llm.tokens_per_second"] = completion_tokens / generation
+            if _meter is not None:
+                _ttft.record(ttft, {"model": model})
+                if generation > 0:
+                    _tokens_per_second.record(completion_tokens / generation, {"model": model})
+        if _meter is not None:
+            _stream_duration.record((end - start) * 1000, {"model": model})
+        if current is not None:
+            current.set_attributes(attributes)
+            current.end()
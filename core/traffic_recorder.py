@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import time
+import queue
+import hashlib
+import logging
+import secrets
+import functools
+import threading
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncIterator, Callable
+
+from core.telemetry import current_timings
+
+SESSION_HEADER = "X-Chat-Session-Id"
+# Records waiting to be written; more are dropped rather than blocking the event loop.
+TRAFFIC_RECORD_QUEUE_SIZE = int(os.getenv("TRAFFIC_RECORD_QUEUE_SIZE", "10000"))
+
+_SCRUBBERS = [
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), "<email>"),
+    (re.compile(r"\b(?:\d[ -]?){13,19}\b"), "<card>"),
+    (re.compile(r"\+?\d[\d ()-]{7,}\d"), "<phone>"),
+]
+
+
+@dataclass
+class TrafficRecord:
+    route: str
+    session: str
+    timestamp: float
+    prompt: str | None = None
+    prompt_chars: int = 0
+    history_length: int = 0
+    image_bytes: int = 0
+    status: int = 0
+    ttfb_ms: float = 0.0
+    latency_ms: float = 0.0
+    stages: dict[str, float] = field(default_factory=dict)
+
+
+current_record: ContextVar[TrafficRecord | None] = ContextVar(
+    "current_record", default=None
+)
+
+
+def scrub(text: str) -> str:
+    for pattern, replacement in _SCRUBBERS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class TrafficRecorder:
+    """Appends sampled, anonymized request shapes to a JSONL file.
+
+    Sampling is per session so recorded sessions keep all of their turns.
+    Lines are written by a background thread, never from the event loop;
+    when it falls `queue_size` lines behind, further ones are dropped.
+    """
+
+    def __init__(
+        self, path: str, sample_rate: float, salt: str, include_prompts: bool, queue_size: int
+    ) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self.salt = salt
+        self.include_prompts = include_prompts
+        self.dropped = 0
+        self._queue: queue.Queue[str] = queue.Queue(queue_size)
+        self._thread: threading.Thread | None = None
+
+    def anonymize(self, session_id: str) -> str:
+        return hashlib.sha256(f"{self.salt}:{session_id}".encode("utf-8")).hexdigest()[:16]
+
+    def sampled(self, anonymized_session: str) -> bool:
+        return int(anonymized_session[:8], 16) / 0xFFFFFFFF < self.sample_rate
+
+    def write(self, record: TrafficRecord) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._drain, name="traffic-recorder", daemon=True
+            )
+            self._thread.start()
+        try:
+            self._queue.put_nowait(json.dumps(asdict(record), separators=(",", ":")))
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self) -> None:
+        while True:
+            lines = [self._queue.get()]
+            while not self._queue.empty() and len(lines) < 500:
+                lines.append(self._queue.get_nowait())
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+            except OSError as e:
+                logging.warning(f"Traffic recorder could not write {self.path}: {e}")
+
+
+def _create_recorder() -> TrafficRecorder | None:
+    path = os.getenv("TRAFFIC_RECORD_PATH")
+    if not path:
+        return None
+    salt = os.getenv("TRAFFIC_RECORD_SALT")
+    if not salt:
+        # Without a salt anyone could hash a session id and find it in the file.
+        logging.warning(
+            "TRAFFIC_RECORD_SALT is not set, using a random one: sessions are only "
+            "sampled and linked consistently within this process."
+        )
+        salt = secrets.token_hex(16)
+    return TrafficRecorder(
+        path=path,
+        sample_rate=float(os.getenv("TRAFFIC_RECORD_SAMPLE_RATE", "0.01")),
+        salt=salt,
+        include_prompts=os.getenv("TRAFFIC_RECORD_PROMPTS", "true").lower() == "true",
+        queue_size=TRAFFIC_RECORD_QUEUE_SIZE,
+    )
+
+
+recorder = _create_recorder()
+
+
+def annotate_traffic(
+    prompt: str | None = None,
+    history_length: int | None = None,
+    image_bytes: int | None = None,
+) -> None:
+    """Adds request details to the current traffic record, if it is being recorded."""
+    record = current_record.get()
+    if record is None or recorder is None:
+        return
+    if isinstance(prompt, str):
+        record.prompt_chars = len(prompt)
+        record.prompt = scrub(prompt) if recorder.include_prompts else None
+    if history_length is not None:
+        record.history_length = history_length
+    if image_bytes is not None:
+        record.image_bytes = image_bytes
+
+
+async def _record_stream(
+    body: AsyncIterator[Any], record: TrafficRecord, start: float
+) -> AsyncIterator[Any]:
+    try:
+        async for chunk in body:
+            if not record.ttfb_ms:
+                record.ttfb_ms = (time.perf_counter() - start) * 1000
+            yield chunk
+    finally:
+        record.latency_ms = (time.perf_counter() - start) * 1000
+        if recorder is not None:
+            recorder.write(record)
+
+
+def recorded(route: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Records the decorated route's traffic when TRAFFIC_RECORD_PATH is set.
+
+    Apply it below `server_timing` so the record includes the stages that ran
+    before the response was returned. Streamed bodies are recorded once they
+    finish, with their time to first byte and total latency. A request
+    without a session header is sampled on the session the response assigns;
+    one that ends up with no session at all is not recorded.
+    """
+
+    def decorator(handler: Callable[..., Any]) -> Callable[..., Any]:
+        if recorder is None:
+            return handler
+
+        @functools.wraps(handler)
+        async def wrapper(req: Any, *args: Any, **kwargs: Any) -> Any:
+            session_id = req.headers.get(SESSION_HEADER)
+            session = recorder.anonymize(session_id) if session_id is not None else ""
+            if session_id is not None and not recorder.sampled(session):
+                return await handler(req, *args, **kwargs)
+
+            record = TrafficRecord(route=route, session=session, timestamp=time.time())
+            start = time.perf_counter()
+            token = current_record.set(record)
+            try:
+                response = await handler(req, *args, **kwargs)
+            except Exception:
+                if session_id is not None:
+                    record.status = 500
+                    record.latency_ms = (time.perf_counter() - start) * 1000
+                    recorder.write(record)
+                raise
+            finally:
+                current_record.reset(token)
+
+            record.status = getattr(response, "status_code", 200)
+            headers = getattr(response, "headers", {})
+            if session_id is None:
+                if SESSION_HEADER not in headers:
+                    return response
+                record.session = recorder.anonymize(headers[SESSION_HEADER])
+                if not recorder.sampled(record.session):
+                    return response
+            timings = current_timings.get()
+            if timings is not None:
+                for name, elapsed in timings.stages:
+                    record.stages[name] = record.stages.get(name, 0.0) + elapsed
+
+            if hasattr(response, "body_iterator"):
+                response.body_iterator = _record_stream(response.body_iterator, record, start)
+            else:
+                record.latency_ms = record.ttfb_ms = (time.perf_counter() - start) * 1000
+                recorder.write(record)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,180 @@
+import os
+import asyncio
+import base64
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable
+
+from starlette.datastructures import UploadFile
+
+# Multiple of 3 so every full chunk base64-encodes without padding and the
+# encoded chunks can be concatenated as-is.
+UPLOAD_CHUNK_SIZE = 3 * 64 * 1024
+UPLOAD_SPOOL_THRESHOLD = 1024 * 1024
+
+
+class UploadTooLargeError(ValueError):
+    pass
+
+
+class UploadCapacityError(RuntimeError):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Too many uploads in flight, try again later.")
+        self.retry_after = retry_after
+
+
+def encoded_size(size: int) -> int:
+    return 4 * ((size + 2) // 3)
+
+
+class InFlightBytesLimiter:
+    """Caps the bytes held by concurrent uploads; waiters queue until there is room.
+
+    ``reserve`` yields a ``release`` callback for handing part of the
+    reservation back early, once a transient copy has been freed.
+    """
+
+    def __init__(self, max_bytes: int, timeout: float) -> None:
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(
+        self, size: int
+    ) -> AsyncIterator[Callable[[int], Awaitable[None]]]:
+        if size > self.max_bytes:
+            raise UploadTooLargeError("Upload exceeds the in-flight byte limit.")
+
+        async with self._condition:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(
+                        lambda: self.in_flight + size <= self.max_bytes
+                    ),
+                    timeout=self.timeout,
+                )
+            except asyncio.TimeoutError:
+                raise UploadCapacityError(retry_after=max(1, int(self.timeout)))
+            finally:
+                self.waiting -= 1
+            self.in_flight += size
+        held = size
+
+        async def release(part: int) -> None:
+            nonlocal held
+            async with self._condition:
+                part = min(part, held)
+                held -= part
+                self.in_flight -= part
+                self._condition.notify_all()
+
+        try:
+            yield release
+        finally:
+            async with self._condition:
+                self.in_flight -= held
+                self._condition.notify_all()
+
+
+upload_limiter = InFlightBytesLimiter(
+    max_bytes=int(os.getenv("UPLOAD_MAX_INFLIGHT_BYTES", str(128 * 1024 * 1024))),
+    timeout=float(os.getenv("UPLOAD_QUEUE_TIMEOUT_SECONDS", "10")),
+)
+
+
+def max_upload_bytes() -> int:
+    return int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+
+
+async def _spool(file: UploadFile, limit: int) -> tuple[BinaryIO, int]:
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD)
+    size = 0
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > limit:
+                raise UploadTooLargeError(f"Upload exceeds {limit} bytes.")
+            spooled.write(chunk)
+    except BaseException:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled, size  # pyright: ignore
+
+
+async def _read(source: UploadFile | BinaryIO, size: int) -> bytes:
+    if isinstance(source, UploadFile):
+        return await source.read(size)
+    return source.read(size)
+
+
+async def _encode_into(
+    source: UploadFile | BinaryIO, buffer: memoryview, size: int
+) -> int:
+    position = 0
+    remaining = size
+    carry = b""
+    while remaining > 0:
+        chunk = await _read(source, min(UPLOAD_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        if carry:
+            chunk = carry + chunk
+        cut = len(chunk) - len(chunk) % 3 if remaining > 0 else len(chunk)
+        carry = chunk[cut:]
+        encoded = base64.b64encode(chunk[:cut])
+        buffer[position : position + len(encoded)] = encoded
+        position += len(encoded)
+    if carry:
+        encoded = base64.b64encode(carry)
+        buffer[position : position + len(encoded)] = encoded
+        position += len(encoded)
+    return position
+
+
+@asynccontextmanager
+async def image_data_uri(file: UploadFile, mime_type: str) -> AsyncIterator[str]:
+    """Yields the upload as a base64 data URI while holding its in-flight bytes.
+
+    The file is read in chunks and encoded straight into one preallocated
+    buffer, so the raw bytes are never held in memory as a whole. Decoding
+    that buffer into the string copies it, so both copies are reserved until
+    the buffer is freed.
+    """
+    limit = max_upload_bytes()
+    source: UploadFile | BinaryIO = file
+    spooled: BinaryIO | None = None
+    size = file.size
+
+    if size is None:
+        spooled, size = await _spool(file, limit)
+        source = spooled
+    elif size > limit:
+        raise UploadTooLargeError(f"Upload exceeds {limit} bytes.")
+
+    try:
+        prefix = f"data:{mime_type};base64,".encode("ascii")
+        reserved = len(prefix) + encoded_size(size)
+
+        async with upload_limiter.reserve(2 * reserved) as release:
+            if spooled is None:
+                await file.seek(0)
+            buffer = bytearray(reserved)
+            view = memoryview(buffer)
+            view[: len(prefix)] = prefix
+            written = len(prefix) + await _encode_into(source, view[len(prefix) :], size)
+            view.release()
+            del buffer[written:]
+            data_uri = buffer.decode("ascii")
+            del buffer
+            await release(reserved)
+
+            yield data_uri
+    finally:
+        if spooled is not None:
+            spooled.close()
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from azurefunctions.extensions.http.fastapi import JSONResponse
+
+from core.telemetry import counter, register_gauge
+from core.traffic_recorder import SESSION_HEADER
+
+logger = logging.getLogger("usage")
+
+# Set by App Service authentication; an opaque id, unlike the principal's name.
+USER_HEADER = "X-MS-CLIENT-PRINCIPAL-ID"
+# The model a session over its downgrade budget is answered with.
+USAGE_DOWNGRADE_MODEL = os.getenv("USAGE_DOWNGRADE_MODEL", "gpt-4o-mini")
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "60"))
+# Sessions idle this long are forgotten, and so is their budget use.
+USAGE_SESSION_TTL_SECONDS = float(os.getenv("USAGE_SESSION_TTL_SECONDS", "86400"))
+USAGE_MAX_SESSIONS = int(os.getenv("USAGE_MAX_SESSIONS", "10000"))
+
+# Tokens (prompt and completion) a session may use before its answers come
+# from USAGE_DOWNGRADE_MODEL, and before its requests are refused; 0 turns a
+# limit off. USAGE_BUDGETS (JSON, per route or "*") overrides them.
+DEFAULT_BUDGET = {"downgrade_tokens": 150_000, "refuse_tokens": 300_000}
+
+_tokens = counter(
+    "app.llm.usage.tokens", unit="{token}", description="Tokens by route, model and kind"
+)
+_refusals = counter(
+    "app.llm.usage.refusals", unit="{request}", description="Requests refused over their session budget"
+)
+
+
+@dataclass
+class Usage:
+    calls: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    updated: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def totals(self) -> dict[str, int]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> None:
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_tokens += cached_tokens
+        self.updated = time.monotonic()
+
+
+@dataclass
+class UsageScope:
+    """Whom the model calls made for the current request are charged to."""
+
+    route: str
+    session: str | None = None
+    user: str | None = None
+
+
+current_usage_scope: ContextVar[UsageScope | None] = ContextVar("current_usage_scope", default=None)
+
+# Totals per (session, user, route) and per session; sessions are kept in
+# least recently used order.
+_usage: OrderedDict[tuple[str, str, str], Usage] = OrderedDict()
+_sessions: OrderedDict[str, Usage] = OrderedDict()
+_dirty: set[tuple[str, str, str]] = set()
+_routes: dict[str, Usage] = {}
+_counts = {"downgraded": 0, "refused": 0}
+_next_flush = time.monotonic() + USAGE_FLUSH_SECONDS
+_flusher: asyncio.Task | None = None
+
+
+def _load_budgets() -> dict[str, dict[str, int]]:
+    raw = os.getenv("USAGE_BUDGETS")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        logging.error("USAGE_BUDGETS is not valid JSON, ignoring it.")
+        return {}
+
+
+_budgets = _load_budgets()
+
+
+def budget(route: str) -> dict[str, int]:
+    return {**DEFAULT_BUDGET, **_budgets.get("*", {}), **_budgets.get(route, {})}
+
+
+def _session_tokens(session: str | None) -> int:
+    usage = _sessions.get(session) if session else None
+    return usage.total_tokens if usage else 0
+
+
+def _over(route: str, session: str | None, limit: str) -> bool:
+    tokens = budget(route)[limit]
+    return bool(tokens) and _session_tokens(session) >= tokens
+
+
+def downgraded() -> bool:
+    """Whether the current session used its downgrade budget, so it is answered by the smaller model."""
+    scope = current_usage_scope.get()
+    if scope is None or not _over(scope.route, scope.session, "downgrade_tokens"):
+        return False
+    _counts["downgraded"] += 1
+    return True
+
+
+def answer_model(model: str) -> str:
+    """`model`, or USAGE_DOWNGRADE_MODEL when the current session is over its downgrade budget."""
+    return USAGE_DOWNGRADE_MODEL if downgraded() else model
+
+
+def meter_session(session: str, user: str | None = None) -> None:
+    """Charges the current request's model calls to `session`, e.g. one the handler just created."""
+    scope = current_usage_scope.get()
+    if scope is not None:
+        scope.session = session
+        if user is not None:
+            scope.user = user
+
+
+def metered(route: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Charges the model calls made for a request to `route` to its session and user.
+
+    The session is the X-Chat-Session-Id header, unless the handler names
+    one with `meter_session`. A session over its refuse budget gets 403
+    without the handler running: retrying will not help, a new session
+    will. Apply it above `admitted`, so refusals take no slot.
+    """
+
+    def decorator(handler: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(handler)
+        async def wrapper(req: Any, *args: Any, **kwargs: Any) -> Any:
+            scope = UsageScope(
+                route=route,
+                session=req.headers.get(SESSION_HEADER),
+                user=req.headers.get(USER_HEADER),
+            )
+            if _over(route, scope.session, "refuse_tokens"):
+                _counts["refused"] += 1
+                _refusals(1, {"route": route})
+                return JSONResponse(
+                    {"message": "This conversation has reached its usage limit, please start a new one."},
+                    status_code=403,
+                )
+            _start_flusher()
+            token = current_usage_scope.set(scope)
+            try:
+                return await handler(req, *args, **kwargs)
+            finally:
+                current_usage_scope.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+def account(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> None:
+    """Adds one model call's usage to the current request's route, session and user."""
+    scope = current_usage_scope.get()
+    route = scope.route if scope else "-"
+    attributes = {"route": route, "model": model}
+    _tokens(prompt_tokens - cached_tokens, {**attributes, "type": "prompt"})
+    _tokens(cached_tokens, {**attributes, "type": "cached"})
+    _tokens(completion_tokens, {**attributes, "type": "completion"})
+    _routes.setdefault(route, Usage()).add(prompt_tokens, completion_tokens, cached_tokens)
+
+    if scope is not None and scope.session:
+        key = (scope.session, scope.user or "-", route)
+        for table, entry_key in ((_usage, key), (_sessions, scope.session)):
+            usage = table.get(entry_key)
+            if usage is None:
+                usage = table[entry_key] = Usage()
+            table.move_to_end(entry_key)
+            usage.add(prompt_tokens, completion_tokens, cached_tokens)
+        _dirty.add(key)
+    if time.monotonic() >= _next_flush:
+        flush()
+
+
+async def _flush_periodically() -> None:
+    while True:
+        await asyncio.sleep(max(0.0, _next_flush - time.monotonic()))
+        if time.monotonic() >= _next_flush:
+            try:
+                flush()
+            except Exception as e:
+                logging.warning(f"Flushing token usage failed: {e}")
+
+
+def _start_flusher() -> None:
+    """Flushes on a timer, so the last totals are logged even when no more tokens are used."""
+    global _flusher
+    loop = asyncio.get_running_loop()
+    if _flusher is None or _flusher.done() or _flusher.get_loop() is not loop:
+        _flusher = loop.create_task(_flush_periodically())
+
+
+def flush() -> None:
+    """Logs the totals of the sessions that used tokens since the last flush and forgets idle ones.
+
+    One JSON line per session, user and route on the "usage" logger; the
+    latest line of a session holds its totals.
+    """
+    global _next_flush
+    now = time.monotonic()
+    _next_flush = now + USAGE_FLUSH_SECONDS
+    for key in sorted(_dirty):
+        usage = _usage.get(key)
+        if usage is not None:
+            session, user, route = key
+            logger.info(
+                json.dumps({"session": session, "user": user, "route": route, **usage.totals()})
+            )
+    _dirty.clear()
+    for table in (_usage, _sessions):
+        while table and (
+            len(table) > USAGE_MAX_SESSIONS
+            or next(iter(table.values())).updated + USAGE_SESSION_TTL_SECONDS < now
+        ):
+            table.popitem(last=False)
+
+
+def usage_stats(top: int = 10) -> dict:
+    heaviest = sorted(_sessions.items(), key=lambda item: item[1].total_tokens, reverse=True)[:top]
+    return {
+        "sessions": len(_sessions),
+        **_counts,
+        "routes": {route: usage.totals() for route, usage in _routes.items()},
+        "top_sessions": [
+            {"session": session, "total_tokens": usage.total_tokens, "calls": usage.calls}
+            for session, usage in heaviest
+        ],
+    }
+
+
+register_gauge(
+    "app.llm.usage.sessions",
+    unit="{session}",
+    description="Sessions with token usage tracked by this worker",
+    observe=lambda: [(len(_sessions), {})],
+)
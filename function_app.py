@@ -1,8 +1,45 @@
+import os
+import logging
 import azure.functions as func
-from blueprints.http_semantic_kernel_bp import bp as semantic_kernel_bp
-from blueprints.http_sk import bp as sk_bp
+from core.logs import configure_logging
+from core.startup import profile_import, warm_up
+from core.telemetry import configure_telemetry
+
+configure_logging()
+configure_telemetry()
+
+with profile_import("blueprints.http_chat_blueprint"):
+    from blueprints.http_chat_blueprint import chat_bp
+with profile_import("blueprints.http_semantic_kernel_bp"):
+    from blueprints.http_semantic_kernel_bp import bp as semantic_kernel_bp
+with profile_import("blueprints.http_sk"):
+    from blueprints.http_sk import bp as sk_bp
 
 app = func.FunctionApp()
 
+app.register_functions(chat_bp)
 app.register_functions(semantic_kernel_bp)
 app.register_functions(sk_bp)
+
+# Off by default, so the diagnostics module is not even imported.
+if os.getenv("DIAGNOSTICS_ENABLED", "false").lower() == "true":
+    from blueprints.http_diagnostics_bp import diagnostics_bp
+
+    app.register_functions(diagnostics_bp)
+
+
+@app.warm_up_trigger("warmup")
+async def warmup(warmup) -> None:
+    await warm_up()
+
+
+@app.timer_trigger(
+    schedule=os.getenv("CHAT_HISTORY_COMPACTION_SCHEDULE", "0 30 3 * * *"),
+    arg_name="timer",
+    run_on_startup=False,
+)
+async def chat_history_compaction(timer: func.TimerRequest) -> None:
+    from sk.memory.chat_history_compaction import compact_chat_history
+
+    report = await compact_chat_history()
+    logging.info(f"Chat history compaction: {report}")
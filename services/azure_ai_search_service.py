@@ -1,18 +1,90 @@
 import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
 from azure.identity import ManagedIdentityCredential, AzureCliCredential
 from azure.search.documents import SearchClient
 from azure.search.documents._generated.models import (
     QueryType,
+    VectorFilterMode,
     VectorQuery,
     VectorizedQuery,
     VectorizableTextQuery,
 )
 from azure.search.documents._paging import SearchItemPaged
+from core.embeddings import embedding_settings
+from core.resilience import dependency
+from core.retrieval import adaptive_search
+from core.search_filters import (
+    FILTER_FIELDS,
+    SEARCH_FILTERS_ENABLED,
+    SearchFilters,
+    Vocabulary,
+    gazetteer,
+)
+from core.singleflight import SingleFlight, normalize_query
+
+T = TypeVar("T")
+
+_hybrid_search_flight = SingleFlight("search.hybrid")
+_search = dependency("search")
+# Threads the synchronous search calls run on.
+SEARCH_THREADS = int(os.getenv("SEARCH_THREADS", "16"))
+# Documents read for the filter vocabulary when the fields are not facetable.
+VOCABULARY_SCAN_DOCUMENTS = 10000
+
+
+class _SearchThreads:
+    """A bounded pool for blocking search calls, apart from the default executor.
+
+    Cancelling the awaiting coroutine does not stop the thread: a call that
+    timed out or lost a hedge holds its thread until the service answers.
+    Here it only holds one of the search threads, and `saturated` tells
+    callers not to add hedges while they are all taken.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.busy = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="search")
+
+    def saturated(self) -> bool:
+        return self.busy >= self.size
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """Runs `function` on a search thread; it counts as busy from being queued until it ran or was cancelled."""
+        context = contextvars.copy_context()
+        with self._lock:
+            self.busy += 1
+        try:
+            job = self._executor.submit(context.run, function, *args)
+        except BaseException:
+            self._done(None)
+            raise
+        # Also called when the job is cancelled before it started, e.g. by a timeout.
+        job.add_done_callback(self._done)
+        return await asyncio.wrap_future(job)
+
+    def _done(self, job: Future | None) -> None:
+        with self._lock:
+            self.busy -= 1
+
+    def stats(self) -> dict:
+        return {"size": self.size, "busy": self.busy}
+
+
+_search_threads = _SearchThreads(SEARCH_THREADS)
 
 
 class AzureAISearchService:
     def __init__(self: "AzureAISearchService", index_name: str):
         if not hasattr(self, "__client"):
+            self.__index_name = index_name
             self.__client = SearchClient(
                 endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
                 index_name=index_name,
@@ -30,7 +102,9 @@ class AzureAISearchService:
             search_text=None,
             vector_queries=[
                 VectorizedQuery(
-                    vector=embedding, k_nearest_neighbors=3, fields="text_vector"
+                    vector=embedding,
+                    k_nearest_neighbors=3,
+                    fields=embedding_settings.vector_field,
                 )
             ],
         )
@@ -39,23 +113,41 @@ class AzureAISearchService:
         self: "AzureAISearchService",
         query: str,
         use_semantic_query: bool = True,
+        vector: list[float] | None = None,
+        filter: str | None = None,
+        k: int | None = None,
+        top: int | None = None,
         **kwargs: dict
     ) -> SearchItemPaged[dict]:
-        # k_nearest_neighbors = 10 if use_semantic_query else 3
+        """Keyword and vector search over the hotel chunks.
+
+        `k` is the number of nearest neighbors the vector query contributes
+        and `top` the number of results; both default to the service's.
+        """
         vector_queries: list[VectorQuery] | None = [
             VectorizableTextQuery(
                 text=query,
-                # k_nearest_neighbors= k_nearest_neighbors,
-                fields="text_vector"
+                k_nearest_neighbors=k,
+                fields=embedding_settings.vector_field,
             )
+            if vector is None
+            else VectorizedQuery(vector=vector, k_nearest_neighbors=k, fields=embedding_settings.vector_field)
         ]
 
         query_args = {
             "search_text": query,
-            # "top": 3,
             "vector_queries": vector_queries
         }
 
+        if top:
+            query_args["top"] = top
+
+        if filter:
+            # Filtering before the nearest-neighbor search keeps k candidates that all match.
+            query_args.update(
+                {"filter": filter, "vector_filter_mode": VectorFilterMode.PRE_FILTER}
+            )
+
         if use_semantic_query:
             query_args.update(
                 {
@@ -66,10 +158,126 @@ class AzureAISearchService:
 
         return self.__client.search(**query_args, **kwargs)
 
-    def __get_credential(self: "AzureAISearchService") -> ManagedIdentityCredential | AzureCliCredential:
+    async def hybrid_search_documents(
+        self: "AzureAISearchService",
+        query: str,
+        use_semantic_query: bool = True,
+        vector: list[float] | None = None,
+        filters: SearchFilters | None = None,
+    ) -> list[dict]:
+        """Runs `hybrid_search` on a search thread, sharing identical concurrent searches.
+
+        `vector` is the query's embedding when the caller already has it,
+        e.g. from a batched embedding request; otherwise the index embeds it.
+        `filters` that match nothing are relaxed rather than answering from
+        no hotels at all, and hits in their preferred states come first. The depth of the search, and whether the semantic
+        ranker runs when `use_semantic_query` allows it, follow the
+        retrieval policy in core.retrieval. Each attempt runs under the
+        "search" dependency's timeout and circuit breaker and is hedged when
+        slow, unless every search thread is taken; a hedged attempt's loser
+        thread runs to completion unobserved.
+        """
+
+        def run(search_filter: str | None, k: int, top: int, semantic: bool) -> list[dict]:
+            return list(
+                self.hybrid_search(
+                    query=query,
+                    use_semantic_query=semantic,
+                    vector=vector,
+                    filter=search_filter,
+                    k=k,
+                    top=top,
+                )
+            )
+
+        filters = filters or SearchFilters()
+        relaxations = filters.relaxations()
+
+        async def search() -> list[dict]:
+            for search_filter in relaxations:
+                results = await adaptive_search(
+                    lambda k, top, semantic: _search.call(
+                        lambda: _search_threads.run(run, search_filter, k, top, semantic),
+                        is_failure=search_failure,
+                        can_hedge=lambda: not _search_threads.saturated(),
+                    ),
+                    query=query,
+                    semantic=use_semantic_query,
+                )
+                if results:
+                    break
+            return filters.rank(results)
+
+        return await _hybrid_search_flight.do(
+            (
+                self.__index_name,
+                normalize_query(query),
+                use_semantic_query,
+                relaxations[0],
+                filters.preferred_states,
+            ),
+            search
+        )
+
+    def facet_values(
+        self: "AzureAISearchService", fields: tuple[str, ...] = FILTER_FIELDS, limit: int = 1000
+    ) -> dict[str, list[str]]:
+        """The distinct values of `fields`, from facets or, if one is not facetable, from the documents."""
+        try:
+            results = self.__client.search(
+                search_text="*",
+                facets=[f"{field},count:{limit}" for field in fields],
+                top=0,
+            )
+            facets = results.get_facets() or {}
+            return {
+                field: [str(facet["value"]) for facet in facets.get(field, [])]
+                for field in fields
+            }
+        except HttpResponseError:
+            values: dict[str, dict[str, None]] = {field: {} for field in fields}
+            results = self.__client.search(search_text="*", select=list(fields))
+            for count, document in enumerate(results):
+                if count >= VOCABULARY_SCAN_DOCUMENTS:
+                    break
+                for field in fields:
+                    value = document.get(field)
+                    for item in value if isinstance(value, list) else [value]:
+                        if item:
+                            values[field][str(item)] = None
+            return {field: list(found) for field, found in values.items()}
+
+    def __get_credential(self: "AzureAISearchService") -> AzureKeyCredential | ManagedIdentityCredential | AzureCliCredential:
+        api_key = os.getenv("AZURE_AI_SEARCH_API_KEY")
+        if api_key:
+            return AzureKeyCredential(api_key)
+
         client_id = os.getenv("AZURE_CLIENT_ID")
 
         if client_id:
             return ManagedIdentityCredential(client_id=client_id)
 
         return AzureCliCredential()
+
+
+def search_failure(error: BaseException) -> bool:
+    """Whether an error says the search service is unhealthy; rejected queries do not."""
+    if isinstance(error, HttpResponseError) and error.status_code is not None:
+        return error.status_code >= 500
+    return isinstance(error, (ServiceRequestError, ServiceResponseError, TimeoutError))
+
+
+async def search_vocabulary(index_name: str) -> Vocabulary | None:
+    """The filter vocabulary of `index_name`; None when filters are off or it cannot be loaded."""
+    if not SEARCH_FILTERS_ENABLED:
+        return None
+    return await gazetteer.get(
+        index_name,
+        lambda: asyncio.to_thread(AzureAISearchService(index_name=index_name).facet_values),
+    )
+
+
+async def search_filters(index_name: str, query: str) -> SearchFilters:
+    """The city, state, category and amenity constraints named in `query`."""
+    vocabulary = await search_vocabulary(index_name)
+    return vocabulary.extract(query) if vocabulary else SearchFilters()
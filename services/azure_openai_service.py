@@ -1,11 +1,44 @@
-import os
 import openai
 import logging
 from openai.types.chat import (
     ChatCompletionMessageParam
 )
 
-from azure.identity import ManagedIdentityCredential, AzureCliCredential, get_bearer_token_provider
+from core.embeddings import embedding_settings
+from core.telemetry import cached_tokens, span, stage, record_usage, instrument_stream
+from core.resilience import dependency
+from core.singleflight import SingleFlight, fingerprint
+from sk.utils import get_openai_client
+
+
+def _chunk_text(chunk) -> str | None:
+    if len(chunk.choices) > 0 and chunk.choices[0].delta is not None:
+        return chunk.choices[0].delta.content
+    return None
+
+
+def openai_failure(error: BaseException) -> bool:
+    """Whether an error says the service is unhealthy; throttling and bad requests do not."""
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return isinstance(error, (openai.APIConnectionError, TimeoutError))
+
+
+def _has_image(messages: list[ChatCompletionMessageParam]) -> bool:
+    return any(
+        isinstance(part, dict) and part.get("type") == "image_url"
+        for message in messages
+        if isinstance(message.get("content"), list)
+        for part in message["content"]  # pyright: ignore
+    )
+
+
+_chat_flight = SingleFlight("openai.chat")
+_embedding_flight = SingleFlight("openai.embeddings")
+_chat = dependency("openai.chat")
+_stream = dependency("openai.stream")
+_embeddings = dependency("openai.embeddings")
+
 
 class AzureOpenAIService:
     @property
@@ -13,35 +46,56 @@ class AzureOpenAIService:
         return self.__client
 
     def __init__(self: "AzureOpenAIService") -> None:
-        if not hasattr(self, "__client"):
-            self.__initialize()
-            self.__client = openai.AsyncAzureOpenAI(
-                azure_endpoint=openai.azure_endpoint,
-                azure_ad_token_provider=openai.azure_ad_token_provider,
-                api_version=openai.api_version
-            )
+        # One client and credential for the process, shared with the Semantic
+        # Kernel services, so the warmed-up token and connections are reused.
+        self.__client = get_openai_client()
 
     async def chat(
         self: "AzureOpenAIService",
         model: str,
         messages: list[ChatCompletionMessageParam]
+    ):
+        # Keying an image request would serialize and hash its whole data
+        # URI, for calls that are practically never identical anyway.
+        if _has_image(messages):
+            return await self.__chat(model=model, messages=messages)
+        return await _chat_flight.do(
+            (model, fingerprint(messages)),
+            lambda: self.__chat(model=model, messages=messages)
+        )
+
+    async def __chat(
+        self: "AzureOpenAIService",
+        model: str,
+        messages: list[ChatCompletionMessageParam]
     ):
         try:
-            completion = await self.__client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=800,
-                temperature=0.7,
-                top_p=0.95,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=None,
-                stream=False,
-            )
+            with span("openai.chat", model=model):
+                completion = await _chat.call(
+                    lambda: self.__client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=800,
+                        temperature=0.7,
+                        top_p=0.95,
+                        frequency_penalty=0,
+                        presence_penalty=0,
+                        stop=None,
+                        stream=False,
+                    ),
+                    is_failure=openai_failure,
+                )
+            if completion.usage:
+                record_usage(
+                    model,
+                    completion.usage.prompt_tokens,
+                    completion.usage.completion_tokens,
+                    cached_tokens(completion.usage)
+                )
             return completion.choices[0].message.content
-        except Exception as e:
-            logging.error("Error during chat", e)
-            return ""
+        except openai.APIError as e:
+            logging.error(f"Error during chat: {e}")
+            raise
 
     async def stream_chat(
             self: "AzureOpenAIService",
@@ -49,48 +103,68 @@ class AzureOpenAIService:
             messages: list[ChatCompletionMessageParam]
         ):
             try:
-                return await self.__client.chat.completions.create(
+                with stage("llm-connect", model=model):
+                    response = await _stream.call(
+                        lambda: self.__client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=1000,
+                            temperature=0.7,
+                            top_p=0.95,
+                            frequency_penalty=0,
+                            presence_penalty=0,
+                            stop=None,
+                            stream=True,
+                            stream_options={"include_usage": True},
+                        ),
+                        is_failure=openai_failure,
+                    )
+                return instrument_stream(
+                    _stream.stream(response),
+                    name="openai.stream_chat",
                     model=model,
-                    messages=messages,
-                    max_tokens=1000,
-                    temperature=0.7,
-                    top_p=0.95,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                    stop=None,
-                    stream=True,
+                    text_of=_chunk_text,
+                    usage_of=lambda chunk: chunk.usage,
                 )
-            except Exception as e:
-                logging.error("Error during chat", e)
-                return ""
-
-    def create_embedding(self: "AzureOpenAIService", input: str) -> list[float]:
-        return (
-            self.__client.embeddings.create(
-                input=input, model="text-embedding-3-small")
-            .data[0]
-            .embedding
+            except openai.APIError as e:
+                logging.error(f"Error during chat: {e}")
+                raise
+
+    async def create_embedding(self: "AzureOpenAIService", input: str) -> list[float]:
+        """Embeds a query with the configured model and dimensions, matching the vector field."""
+        model = embedding_settings.model
+        dimensions = embedding_settings.dimensions
+        return await _embedding_flight.do(
+            (model, dimensions, input),
+            lambda: self.__create_embedding(model=model, input=input, dimensions=dimensions)
         )
 
-    def __initialize(self: "AzureOpenAIService") -> None:
-        try:
-            credential = self.__get_credential()
-            token_provider = get_bearer_token_provider(
-                credential,
-                "https://cognitiveservices.azure.com/.default"
-            )
-            openai.azure_ad_token_provider = token_provider
-            openai.azure_endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
-            openai.api_type = "azure"
-            openai.api_version = os.environ["OPENAI_API_VERSION"]
-        except Exception as e:
-            print("Error during token retrieval", e)
-
-
-    def __get_credential(self: "AzureOpenAIService") -> ManagedIdentityCredential | AzureCliCredential:
-        client_id = os.getenv("AZURE_CLIENT_ID")
-
-        if client_id:
-            return ManagedIdentityCredential(client_id=client_id)
-
-        return AzureCliCredential()
+    async def __create_embedding(
+        self: "AzureOpenAIService", model: str, input: str, dimensions: int | None
+    ) -> list[float]:
+        response = await _embeddings.call(
+            lambda: self.__client.embeddings.create(
+                input=input,
+                model=model,
+                dimensions=dimensions or openai.NOT_GIVEN,
+            ),
+            is_failure=openai_failure,
+        )
+        return response.data[0].embedding
+
+    async def create_embeddings(
+        self: "AzureOpenAIService",
+        inputs: list[str],
+        model: str,
+        dimensions: int | None = None,
+    ) -> list[list[float]]:
+        """Embeds a batch of inputs in one request, returned in input order."""
+        response = await _embeddings.call(
+            lambda: self.__client.embeddings.create(
+                input=inputs,
+                model=model,
+                dimensions=dimensions or openai.NOT_GIVEN,
+            ),
+            is_failure=openai_failure,
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
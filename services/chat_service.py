@@ -1,44 +1,38 @@
 import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterator
+from azure.core.exceptions import AzureError
+from openai.types.chat import ChatCompletionSystemMessageParam
 from services.azure_ai_search_service import (
     AzureAISearchService,
+    search_filters,
 )
 from services.azure_openai_service import (
     AzureOpenAIService,
     ChatCompletionMessageParam
 )
+from core.cache import cache
+from core.embeddings import embedding_settings
+from core.openai_scheduler import BULK, lane
+from core.resilience import DeadlineExceeded, DependencyUnavailable
+from core.search_filters import search_cache_key
+from core.singleflight import fingerprint
+from core.telemetry import stage
+from core.usage import answer_model
+
+_rewrite_cache = cache("rewrite", ttl=3600, l1_ttl=300)
+_search_cache = cache("search.hotels", ttl=300, l1_ttl=60, stale_seconds=3600)
 
 
 class ChatService:
     async def chat(self: "ChatService", prompt: str, chat_history: list) -> str:
-        standalone_question_system_message = self.__create_standalone_question(
-            prompt=prompt, chat_history=chat_history)
-
         openai_service = AzureOpenAIService()
-        standalone_question = await openai_service.chat(
-            model="gpt-4o-mini",
-            messages=[{
-                "role": "system",
-                "content": standalone_question_system_message
-            }]
-        )
+        standalone_question = await self.__rewrite(
+            openai_service, prompt=prompt, chat_history=chat_history)
 
-        search_service = AzureAISearchService(
-            index_name=os.environ["INDEX_NAME"])
-        results = search_service.hybrid_search(query=standalone_question)
-
-        hotels: list[dict] = []
-
-        for result in results:
-            hotels.append(
-                {
-                    "id": result["Id"],
-                    "hotelName": result["HotelName"],
-                    "category": result["Category"],
-                    "city": result["City"],
-                    "state": result["State"],
-                    "description": result["chunk"],
-                }
-            )
+        hotels = await self.__search_hotels(query=standalone_question)
 
         chat_with_context_system_message = self.__create_chat_with_context(
             prompt=standalone_question,
@@ -47,7 +41,7 @@ class ChatService:
         )
 
         return await openai_service.stream_chat(
-            model="gpt-4o",
+            model=answer_model("gpt-4o"),
             messages=[
                 ChatCompletionSystemMessageParam(
                     role="system",
@@ -57,7 +51,143 @@ class ChatService:
             ]
         )
 
-    async def analyza_image(self: "ChatService", encoded_image: str, chat_history: list) -> str:
+    async def chat_batch(
+        self: "ChatService",
+        items: list[dict],
+        concurrency: int = 8,
+        wave_size: int = 16,
+    ) -> AsyncIterator[dict]:
+        """Answers many `{"prompt", "chat_history"}` items, yielding each result when it is ready.
+
+        Identical items are answered once and reported for every index.
+        Items go through in waves of `wave_size`: their rewrites run
+        concurrently, the rewritten questions are embedded in one request and
+        searched once per distinct question, and at most `concurrency`
+        generations run at a time. Every OpenAI call is scheduled in the
+        bulk lane, behind interactive chats.
+        """
+        groups: dict[str, list[int]] = {}
+        for index, item in enumerate(items):
+            key = fingerprint([item.get("prompt"), item.get("chat_history") or []])
+            groups.setdefault(key, []).append(index)
+
+        openai_service = AzureOpenAIService()
+        results: asyncio.Queue[dict | None] = asyncio.Queue()
+        generation_slots = asyncio.Semaphore(concurrency)
+        generations: set[asyncio.Task] = set()
+
+        def report(indexes: list[int], start: float, **result) -> None:
+            latency_ms = round((time.perf_counter() - start) * 1000, 1)
+            for index in indexes:
+                results.put_nowait({
+                    "index": index,
+                    "id": items[index].get("id"),
+                    **result,
+                    "latency_ms": latency_ms,
+                })
+
+        async def generate(indexes: list[int], question: str, hotels: list[dict], start: float) -> None:
+            item = items[indexes[0]]
+            try:
+                async with generation_slots:
+                    response = await openai_service.stream_chat(
+                        model="gpt-4o",
+                        messages=[
+                            ChatCompletionSystemMessageParam(
+                                role="system",
+                                content=self.__create_chat_with_context(
+                                    prompt=question,
+                                    chat_history=list(item.get("chat_history") or []),
+                                    context=hotels
+                                )
+                            )
+                        ]
+                    )
+                    answer = "".join([
+                        chunk.choices[0].delta.content
+                        async for chunk in response
+                        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content
+                    ])
+                report(indexes, start, question=question, hotels=[hotel["id"] for hotel in hotels], answer=answer)
+            except Exception as e:
+                report(indexes, start, question=question, error=str(e))
+
+        async def run_wave(wave: list[list[int]]) -> None:
+            start = time.perf_counter()
+            rewritten = await asyncio.gather(
+                *(
+                    self.__rewrite(
+                        openai_service,
+                        prompt=items[indexes[0]]["prompt"],
+                        chat_history=list(items[indexes[0]].get("chat_history") or [])
+                    )
+                    for indexes in wave
+                ),
+                return_exceptions=True
+            )
+            answered = []
+            for indexes, question in zip(wave, rewritten):
+                if isinstance(question, Exception):
+                    report(indexes, start, error=str(question))
+                else:
+                    answered.append((indexes, question))
+
+            questions = list(dict.fromkeys(question for _, question in answered))
+            vectors: list[list[float] | None] = [None] * len(questions)
+            if questions:
+                try:
+                    with stage("embed"):
+                        vectors = await openai_service.create_embeddings(
+                            questions,
+                            model=embedding_settings.model,
+                            dimensions=embedding_settings.dimensions
+                        )
+                except Exception:
+                    # The index can still embed each question itself.
+                    pass
+            searched = await asyncio.gather(
+                *(
+                    self.__search_hotels(query=question, vector=vector)
+                    for question, vector in zip(questions, vectors)
+                ),
+                return_exceptions=True
+            )
+            hotels_by_question = dict(zip(questions, searched))
+
+            for indexes, question in answered:
+                hotels = hotels_by_question[question]
+                if isinstance(hotels, Exception):
+                    report(indexes, start, question=question, error=str(hotels))
+                    continue
+                task = asyncio.create_task(generate(indexes, question, hotels, start))
+                generations.add(task)
+                task.add_done_callback(generations.discard)
+
+        async def produce() -> None:
+            try:
+                with lane(BULK):
+                    pending = list(groups.values())
+                    for offset in range(0, len(pending), wave_size):
+                        # Rewrite the next wave while earlier answers generate, but no further ahead.
+                        while len(generations) >= concurrency + wave_size:
+                            await asyncio.wait(generations, return_when=asyncio.FIRST_COMPLETED)
+                        await run_wave(pending[offset:offset + wave_size])
+                    if generations:
+                        await asyncio.wait(generations)
+            finally:
+                results.put_nowait(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (result := await results.get()) is not None:
+                yield result
+            await producer
+        finally:
+            producer.cancel()
+            for task in list(generations):
+                task.cancel()
+
+    async def analyza_image(self: "ChatService", image_url: str, chat_history: list) -> str:
         messages = []
         if len(chat_history) > 0:
             messages += chat_history
@@ -76,7 +206,7 @@ class ChatService:
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f'data:image/jpeg;base64,{encoded_image}',
+                        "url": image_url,
                         "detail": "high"
                     }
                 }
@@ -84,29 +214,14 @@ class ChatService:
         })
 
         openai_service = AzureOpenAIService()
-        standalone_question = await openai_service.chat(
-            model="gpt-4o",
-            messages=messages
-        )
-
-        search_service = AzureAISearchService(
-            index_name=os.environ["INDEX_NAME"])
-        results = search_service.hybrid_search(query=standalone_question)
-
-        hotels: list[dict] = []
-
-        for result in results:
-            hotels.append(
-                {
-                    "id": result["Id"],
-                    "hotelName": result["HotelName"],
-                    "category": result["Category"],
-                    "city": result["City"],
-                    "state": result["State"],
-                    "description": result["chunk"],
-                }
+        with stage("rewrite"):
+            standalone_question = await openai_service.chat(
+                model="gpt-4o",
+                messages=messages
             )
 
+        hotels = await self.__search_hotels(query=standalone_question)
+
         chat_with_context_system_message = self.__create_chat_with_context(
             prompt=standalone_question,
             chat_history=chat_history,
@@ -114,13 +229,75 @@ class ChatService:
         )
 
         return await openai_service.stream_chat(
-            model="gpt-4o",
+            model=answer_model("gpt-4o"),
             messages=[{
                 "role": "system",
                 "content": chat_with_context_system_message
             }]
         )
 
+    async def __rewrite(
+        self: "ChatService",
+        openai_service: AzureOpenAIService,
+        prompt: str,
+        chat_history: list
+    ) -> str:
+        standalone_question_system_message = self.__create_standalone_question(
+            prompt=prompt, chat_history=chat_history)
+
+        messages = [{
+            "role": "system",
+            "content": standalone_question_system_message
+        }]
+        with stage("rewrite"):
+            try:
+                return await _rewrite_cache.get_or_load(
+                    ("gpt-4o-mini", fingerprint(messages)),
+                    lambda: openai_service.chat(model="gpt-4o-mini", messages=messages)
+                )
+            except DeadlineExceeded:
+                raise
+            except (DependencyUnavailable, TimeoutError) as e:
+                # A worse search beats no answer: search with the prompt as it is.
+                logging.warning(f"Rewriting the question failed, using the prompt: {e}")
+                return prompt
+
+    async def __search_hotels(
+        self: "ChatService",
+        query: str,
+        vector: list[float] | None = None
+    ) -> list[dict]:
+        index_name = os.environ["INDEX_NAME"]
+
+        async def search() -> list[dict]:
+            search_service = AzureAISearchService(index_name=index_name)
+            results = await search_service.hybrid_search_documents(
+                query=query, vector=vector, filters=filters
+            )
+            return [
+                {
+                    "id": result["Id"],
+                    "hotelName": result["HotelName"],
+                    "category": result["Category"],
+                    "city": result["City"],
+                    "state": result["State"],
+                    "description": result["chunk"],
+                }
+                for result in results
+            ]
+
+        with stage("search"):
+            filters = await search_filters(index_name, query)
+            key = search_cache_key(index_name, embedding_settings.vector_field, query, filters)
+            try:
+                return await _search_cache.get_or_load(key, search)
+            except DeadlineExceeded:
+                raise
+            except (DependencyUnavailable, TimeoutError, AzureError) as e:
+                # Answer from the last results for this search, or from no hotels.
+                logging.warning(f"Hotel search failed, using earlier or no results: {e}")
+                return _search_cache.get_stale(key) or []
+
     def __create_standalone_question(self: "ChatService", prompt: str, chat_history: list[ChatCompletionMessageParam]) -> str:
         system_message = os.getenv(
             "STANDALONE_QUESTION_SYSTEM_MESSAGE",
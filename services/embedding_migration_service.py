@@ -0,0 +1,268 @@
+import os
+import time
+import logging
+from dataclasses import dataclass, field
+
+from azure.core.credentials import AzureKeyCredential
+from azure.identity.aio import ManagedIdentityCredential, AzureCliCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+from azure.search.documents.models import VectorizedQuery
+from core.embeddings import NATIVE_DIMENSIONS, supports_dimensions, truncate
+from core.search_index import VectorIndexProfile, add_profile, vector_field
+from services.azure_openai_service import AzureOpenAIService
+
+
+@dataclass
+class BackfillReport:
+    documents: int = 0
+    truncated: int = 0
+    embedded: int = 0
+    written: int = 0
+    failed: int = 0
+    failures: list[str] = field(default_factory=list)
+    elapsed_seconds: float = 0.0
+    # Vectors kept for the offline recall comparison, keyed by document key.
+    source_vectors: dict[str, list[float]] = field(default_factory=dict, repr=False)
+    target_vectors: dict[str, list[float]] = field(default_factory=dict, repr=False)
+
+
+class EmbeddingMigrationService:
+    """Moves an index to a smaller vector field side by side with the current one.
+
+    The target field is added to the existing index with its own profile,
+    backfilled by truncating the stored source vectors (same text-embedding-3
+    model) or by re-embedding the chunk text (different model, or vectors not
+    retrievable), and compared with the source field for recall and latency
+    before queries are switched over with EMBEDDING_VECTOR_FIELD.
+    """
+
+    def __init__(
+        self: "EmbeddingMigrationService",
+        index_name: str,
+        key_field: str,
+        text_field: str,
+        source_field: str,
+        source_model: str,
+        target_field: str,
+        target_model: str,
+        target_dimensions: int,
+        batch_size: int = 500,
+    ) -> None:
+        if not supports_dimensions(target_model):
+            raise ValueError(f"{target_model} cannot produce {target_dimensions}-dimension embeddings")
+        self.index_name = index_name
+        self.key_field = key_field
+        self.text_field = text_field
+        self.source_field = source_field
+        self.source_model = source_model
+        self.target_field = target_field
+        self.target_model = target_model
+        self.target_dimensions = target_dimensions
+        self.batch_size = batch_size
+        self.__openai_service = AzureOpenAIService()
+
+    async def add_target_field(self: "EmbeddingMigrationService", profile: VectorIndexProfile) -> bool:
+        """Adds the target vector field to the index; False if it already exists."""
+        credential = self.__get_credential()
+        try:
+            async with SearchIndexClient(
+                endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
+                credential=credential,  # pyright: ignore
+            ) as index_client:
+                index = await index_client.get_index(self.index_name)
+                if any(existing.name == self.target_field for existing in index.fields):
+                    return False
+                add_profile(index, profile)
+                index.fields.append(vector_field(self.target_field, self.target_dimensions, profile))
+                await index_client.create_or_update_index(index)
+                return True
+        finally:
+            await self.__close(credential)
+
+    async def backfill(
+        self: "EmbeddingMigrationService", re_embed: bool = False, keep_vectors: int = 20000
+    ) -> BackfillReport:
+        """Writes the target field for every document; keeps up to `keep_vectors` pairs for `compare`."""
+        report = BackfillReport()
+        start = time.perf_counter()
+        can_truncate = not re_embed and self.source_model == self.target_model
+        pending_writes: list[dict] = []
+        pending_texts: list[tuple[str, str, list[float] | None]] = []
+        credential = self.__get_credential()
+
+        async def flush_embeddings() -> None:
+            if not pending_texts:
+                return
+            batch = list(pending_texts)
+            pending_texts.clear()
+            try:
+                vectors = await self.__openai_service.create_embeddings(
+                    [text for _, text, _ in batch],
+                    model=self.target_model,
+                    dimensions=self.target_dimensions,
+                )
+            except Exception as e:
+                # The batch stays without a target vector; a rerun with
+                # --skip-add-field writes it again.
+                report.failed += len(batch)
+                report.failures.append(f"embedding {batch[0][0]}..: {e}")
+                logging.error(f"Embedding batch failed: {e}")
+                return
+            report.embedded += len(vectors)
+            for (key, _, source), vector in zip(batch, vectors):
+                keep(key, source, vector)
+
+        def keep(key: str, source: list[float] | None, target: list[float]) -> None:
+            pending_writes.append({self.key_field: key, self.target_field: target})
+            if source is not None and len(report.target_vectors) < keep_vectors:
+                report.source_vectors[key] = source
+                report.target_vectors[key] = target
+
+        async def flush_writes(search_client: SearchClient) -> None:
+            if not pending_writes:
+                return
+            batch = list(pending_writes)
+            pending_writes.clear()
+            try:
+                results = await search_client.merge_documents(documents=batch)
+            except Exception as e:
+                report.failed += len(batch)
+                report.failures.append(f"merge {batch[0][self.key_field]}..: {e}")
+                logging.error(f"Merge batch failed: {e}")
+                return
+            for result in results:
+                if result.succeeded:
+                    report.written += 1
+                else:
+                    report.failed += 1
+                    report.failures.append(f"merge {result.key}: {result.error_message}")
+
+        try:
+            async with SearchClient(
+                endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
+                index_name=self.index_name,
+                credential=credential,  # pyright: ignore
+            ) as search_client:
+                results = await search_client.search(
+                    search_text="*",
+                    select=[self.key_field, self.text_field, self.source_field],
+                )
+                async for document in results:
+                    report.documents += 1
+                    key = str(document[self.key_field])
+                    source = document.get(self.source_field)
+                    if can_truncate and source and len(source) >= self.target_dimensions:
+                        report.truncated += 1
+                        keep(key, source, truncate(source, self.target_dimensions))
+                    else:
+                        pending_texts.append((key, document.get(self.text_field) or "", source))
+                        if len(pending_texts) >= 64:
+                            await flush_embeddings()
+                    if len(pending_writes) >= self.batch_size:
+                        await flush_writes(search_client)
+                await flush_embeddings()
+                await flush_writes(search_client)
+        finally:
+            await self.__close(credential)
+
+        report.elapsed_seconds = time.perf_counter() - start
+        return report
+
+    async def compare(
+        self: "EmbeddingMigrationService",
+        queries: list[str],
+        backfill: BackfillReport,
+        k: int = 10,
+    ) -> dict:
+        """Recall of the target field against the source field, offline and on the live index."""
+        # Only the migration tool needs NumPy, so the function app does not ship it.
+        import numpy as np
+
+        source_queries = await self.__openai_service.create_embeddings(queries, model=self.source_model)
+        if self.source_model == self.target_model:
+            target_queries = [truncate(vector, self.target_dimensions) for vector in source_queries]
+        else:
+            target_queries = await self.__openai_service.create_embeddings(
+                queries, model=self.target_model, dimensions=self.target_dimensions
+            )
+
+        result: dict = {
+            "queries": len(queries),
+            "k": k,
+            "source_bytes_per_vector": 4 * NATIVE_DIMENSIONS.get(self.source_model, len(source_queries[0])),
+            "target_bytes_per_vector": 4 * self.target_dimensions,
+        }
+
+        keys = list(backfill.source_vectors)
+        if len(keys) >= k:
+            source_matrix = np.array([backfill.source_vectors[key] for key in keys], dtype=np.float32)
+            target_matrix = np.array([backfill.target_vectors[key] for key in keys], dtype=np.float32)
+            source_top = np.argsort(-(np.array(source_queries, dtype=np.float32) @ source_matrix.T), axis=1)[:, :k]
+            target_top = np.argsort(-(np.array(target_queries, dtype=np.float32) @ target_matrix.T), axis=1)[:, :k]
+            recalls = [len(set(a) & set(b)) / k for a, b in zip(source_top.tolist(), target_top.tolist())]
+            result["offline"] = {
+                "documents": len(keys),
+                f"recall@{k}": round(float(np.mean(recalls)), 4),
+                f"min_recall@{k}": round(min(recalls), 4),
+            }
+
+        overlaps = []
+        latencies: dict[str, list[float]] = {self.source_field: [], self.target_field: []}
+        credential = self.__get_credential()
+        try:
+            async with SearchClient(
+                endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
+                index_name=self.index_name,
+                credential=credential,  # pyright: ignore
+            ) as search_client:
+                for source_vector, target_vector in zip(source_queries, target_queries):
+                    source_keys = await self.__vector_keys(search_client, self.source_field, source_vector, k, latencies)
+                    target_keys = await self.__vector_keys(search_client, self.target_field, target_vector, k, latencies)
+                    if source_keys:
+                        overlaps.append(len(set(source_keys) & set(target_keys)) / len(source_keys))
+        finally:
+            await self.__close(credential)
+
+        result["live"] = {
+            f"overlap@{k}": round(sum(overlaps) / len(overlaps), 4) if overlaps else None,
+            "p50_ms": {name: round(float(np.median(values)), 1) for name, values in latencies.items() if values},
+        }
+        return result
+
+    async def __vector_keys(
+        self: "EmbeddingMigrationService",
+        search_client: SearchClient,
+        field_name: str,
+        vector: list[float],
+        k: int,
+        latencies: dict[str, list[float]],
+    ) -> list[str]:
+        start = time.perf_counter()
+        results = await search_client.search(
+            search_text=None,
+            vector_queries=[VectorizedQuery(vector=vector, k_nearest_neighbors=k, fields=field_name)],
+            select=[self.key_field],
+            top=k,
+        )
+        keys = [str(document[self.key_field]) async for document in results]
+        latencies[field_name].append((time.perf_counter() - start) * 1000)
+        return keys
+
+    async def __close(self: "EmbeddingMigrationService", credential) -> None:
+        if not isinstance(credential, AzureKeyCredential):
+            await credential.close()
+
+    def __get_credential(
+        self: "EmbeddingMigrationService",
+    ) -> AzureKeyCredential | ManagedIdentityCredential | AzureCliCredential:
+        api_key = os.getenv("AZURE_AI_SEARCH_API_KEY")
+        if api_key:
+            return AzureKeyCredential(api_key)
+
+        client_id = os.getenv("AZURE_CLIENT_ID")
+
+        if client_id:
+            return ManagedIdentityCredential(client_id=client_id)
+
+        return AzureCliCredential()
@@ -0,0 +1,485 @@
+import os
+import re
+import csv
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceNotFoundError,
+    ServiceRequestError,
+    ServiceResponseError,
+)
+from azure.identity.aio import ManagedIdentityCredential, AzureCliCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+from core.embeddings import NATIVE_DIMENSIONS, supports_dimensions, truncate
+from core.search_index import VectorIndexProfile, hotel_index
+from services.azure_openai_service import AzureOpenAIService
+
+HOTEL_FIELDS = ("Id", "HotelName", "Category", "City", "State", "Tags")
+RETRYABLE_STATUS = {409, 422, 429, 500, 502, 503, 504}
+_INVALID_KEY_CHARACTERS = re.compile(r"[^A-Za-z0-9_\-=]")
+
+
+def _retryable(error: Exception) -> bool:
+    """Whether a failed batch request is worth repeating: throttling, a server error or a lost connection."""
+    if isinstance(error, HttpResponseError):
+        return error.status_code in RETRYABLE_STATUS
+    return isinstance(error, (ServiceRequestError, ServiceResponseError, asyncio.TimeoutError))
+
+
+def _message(error: Exception) -> str:
+    return getattr(error, "message", None) or str(error)
+
+
+def read_hotels(path: str) -> Iterator[dict]:
+    """Streams hotel records from a JSONL or CSV file; CSV tags are separated by `|`."""
+    with open(path, encoding="utf-8", newline="") as f:
+        if Path(path).suffix.lower() == ".csv":
+            for row in csv.DictReader(f):
+                tags = row.get("Tags") or ""
+                row["Tags"] = [tag.strip() for tag in tags.split("|") if tag.strip()]
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def chunk_text(text: str, max_chars: int, overlap: int) -> list[str]:
+    """Splits text into chunks of at most `max_chars`, preferring sentence then word boundaries."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return [text] if text else []
+
+    chunks: list[str] = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + max_chars)
+        if end < len(text):
+            cut = max(text.rfind(". ", start, end), text.rfind("! ", start, end), text.rfind("? ", start, end))
+            if cut <= start + max_chars // 2:
+                cut = text.rfind(" ", start, end)
+            if cut > start:
+                end = cut + 1
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        # Start the overlap on a word boundary.
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+    return chunks
+
+
+def _digest(value: Any) -> str:
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class HotelChunk:
+    chunk_id: str
+    parent_id: str
+    text: str
+    metadata: dict
+    # Changes when the embedding must be recomputed.
+    text_hash: str
+    # Changes when the stored document must be rewritten.
+    document_hash: str
+
+    def document(self, vectors: dict[str, list[float]] | None) -> dict:
+        return {
+            "chunk_id": self.chunk_id,
+            "parent_id": self.parent_id,
+            "chunk": self.text,
+            **self.metadata,
+            **(vectors or {}),
+        }
+
+
+def hotel_key(hotel: dict) -> str:
+    """The key prefix of a hotel's chunks."""
+    return _INVALID_KEY_CHARACTERS.sub("_", str(hotel["Id"]))
+
+
+def chunk_hotel(hotel: dict, embedding_key: Any, max_chars: int, overlap: int) -> list[HotelChunk]:
+    parent_id = hotel_key(hotel)
+    metadata = {name: hotel.get(name) for name in HOTEL_FIELDS if name in hotel}
+    metadata["Id"] = str(hotel["Id"])
+    chunks = []
+    for index, text in enumerate(chunk_text(hotel.get("Description") or "", max_chars, overlap)):
+        text_hash = _digest({"embedding": embedding_key, "text": text})
+        chunks.append(
+            HotelChunk(
+                chunk_id=f"{parent_id}_{index}",
+                parent_id=parent_id,
+                text=text,
+                metadata=metadata,
+                text_hash=text_hash,
+                document_hash=_digest({"text": text_hash, "metadata": metadata}),
+            )
+        )
+    return chunks
+
+
+class IngestionState:
+    """Content hashes of the chunks already in the index, kept in a JSON file between runs."""
+
+    def __init__(self: "IngestionState", path: str) -> None:
+        self.path = path
+        self.chunks: dict[str, list[str]] = {}
+        self.parents: dict[str, int] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.chunks = state.get("chunks", {})
+            self.parents = state.get("parents", {})
+
+    def save(self: "IngestionState") -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"chunks": self.chunks, "parents": self.parents}, f)
+        os.replace(temporary, self.path)
+
+
+@dataclass
+class IngestionReport:
+    hotels: int = 0
+    chunks: int = 0
+    unchanged: int = 0
+    embedded: int = 0
+    uploaded: int = 0
+    deleted: int = 0
+    failed: int = 0
+    elapsed_seconds: float = 0.0
+    failures: list[str] = field(default_factory=list)
+
+    def as_dict(self: "IngestionReport") -> dict:
+        elapsed = self.elapsed_seconds or 1e-9
+        return {
+            "hotels": self.hotels,
+            "chunks": self.chunks,
+            "unchanged": self.unchanged,
+            "embedded": self.embedded,
+            "uploaded": self.uploaded,
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+            "hotels_per_second": round(self.hotels / elapsed, 1),
+            "chunks_per_second": round(self.chunks / elapsed, 1),
+            "uploaded_per_second": round(self.uploaded / elapsed, 1),
+            "failures": self.failures[:20],
+        }
+
+
+class HotelIngestionService:
+    """Loads hotel records into the search index.
+
+    Records are streamed, chunked and compared with the stored content
+    hashes; only chunks whose text changed are embedded, in batches of
+    `embed_batch_size` with `embed_concurrency` requests in flight, and only
+    changed documents are uploaded, in batches of `upload_batch_size` with
+    `upload_concurrency` requests in flight. Throttled or failed documents
+    are retried with backoff.
+    """
+
+    def __init__(
+        self: "HotelIngestionService",
+        index_name: str,
+        embedding_model: str,
+        vector_fields: dict[str, int | None],
+        state: IngestionState,
+        embed_batch_size: int = 64,
+        embed_concurrency: int = 4,
+        upload_batch_size: int = 500,
+        upload_concurrency: int = 4,
+        max_retries: int = 5,
+        chunk_chars: int = 2000,
+        chunk_overlap: int = 200,
+    ) -> None:
+        self.index_name = index_name
+        self.embedding_model = embedding_model
+        self.vector_fields = vector_fields
+        shortened = [dimensions for dimensions in vector_fields.values() if dimensions]
+        if shortened and not supports_dimensions(embedding_model):
+            raise ValueError(f"{embedding_model} cannot produce {shortened[0]}-dimension embeddings")
+        # One request serves every field: shorter fields are truncated from the longest.
+        self.request_dimensions = (
+            None if len(shortened) < len(vector_fields) else max(shortened)
+        )
+        self.state = state
+        self.embed_batch_size = embed_batch_size
+        self.embed_concurrency = embed_concurrency
+        self.upload_batch_size = upload_batch_size
+        self.upload_concurrency = upload_concurrency
+        self.max_retries = max_retries
+        self.chunk_chars = chunk_chars
+        self.chunk_overlap = chunk_overlap
+
+    async def ensure_index(
+        self: "HotelIngestionService", profile: VectorIndexProfile
+    ) -> bool:
+        """Creates the index with the vector fields on `profile` unless it exists; True if created."""
+        credential = self.__get_credential()
+        index_client = SearchIndexClient(
+            endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
+            credential=credential,  # pyright: ignore
+        )
+        try:
+            async with index_client:
+                try:
+                    await index_client.get_index(self.index_name)
+                    return False
+                except ResourceNotFoundError:
+                    await index_client.create_index(
+                        hotel_index(
+                            self.index_name,
+                            profile,
+                            vector_fields={
+                                name: dimensions or NATIVE_DIMENSIONS.get(self.embedding_model, 1536)
+                                for name, dimensions in self.vector_fields.items()
+                            },
+                        )
+                    )
+                    return True
+        finally:
+            if not isinstance(credential, AzureKeyCredential):
+                await credential.close()
+
+    async def ingest(
+        self: "HotelIngestionService", hotels: Iterable[dict], prune: bool = False
+    ) -> IngestionReport:
+        report = IngestionReport()
+        start = time.perf_counter()
+        openai_service = AzureOpenAIService()
+        credential = self.__get_credential()
+
+        embed_slots = asyncio.Semaphore(self.embed_concurrency)
+        upload_slots = asyncio.Semaphore(self.upload_concurrency)
+        tasks: set[asyncio.Task] = set()
+        to_embed: list[HotelChunk] = []
+        to_upload: list[tuple[HotelChunk, dict]] = []
+        stale_keys: list[str] = []
+        seen_parents: set[str] = set()
+        # Part of every text hash, so changing the model or fields re-embeds everything.
+        embedding_key = {"model": self.embedding_model, "fields": sorted(self.vector_fields.items())}
+
+        search_client = SearchClient(
+            endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
+            index_name=self.index_name,
+            credential=credential,  # pyright: ignore
+        )
+
+        def spawn(coroutine) -> None:
+            task = asyncio.create_task(coroutine)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        async def queue_upload(items: list[tuple[HotelChunk, dict]]) -> None:
+            to_upload.extend(items)
+            while len(to_upload) >= self.upload_batch_size:
+                batch = to_upload[: self.upload_batch_size]
+                del to_upload[: self.upload_batch_size]
+                await upload_slots.acquire()
+                spawn(upload(batch))
+
+        async def embed(batch: list[HotelChunk]) -> None:
+            # The embed slot is held until the vectors are queued for upload,
+            # so a slow index applies backpressure all the way to the reader.
+            try:
+                vectors = await openai_service.create_embeddings(
+                    [chunk.text for chunk in batch],
+                    model=self.embedding_model,
+                    dimensions=self.request_dimensions,
+                )
+                report.embedded += len(batch)
+                await queue_upload(
+                    [(chunk, chunk.document(self.__field_vectors(vector))) for chunk, vector in zip(batch, vectors)]
+                )
+            except Exception as e:
+                report.failed += len(batch)
+                report.failures.append(f"embedding {batch[0].chunk_id}..: {e}")
+                logging.error(f"Embedding batch failed: {e}")
+            finally:
+                embed_slots.release()
+
+        async def upload(batch: list[tuple[HotelChunk, dict]]) -> None:
+            try:
+                await self.__upload(search_client, batch, report)
+            finally:
+                upload_slots.release()
+
+        try:
+            async with search_client:
+                for hotel in hotels:
+                    report.hotels += 1
+                    chunks = chunk_hotel(
+                        hotel, embedding_key, self.chunk_chars, self.chunk_overlap
+                    )
+                    # A hotel whose description is now empty has all its chunks deleted.
+                    parent_id = hotel_key(hotel)
+                    seen_parents.add(parent_id)
+                    previous_count = self.state.parents.get(parent_id, 0)
+                    stale_keys.extend(f"{parent_id}_{i}" for i in range(len(chunks), previous_count))
+                    if not chunks:
+                        self.state.parents.pop(parent_id, None)
+                        continue
+                    self.state.parents[parent_id] = len(chunks)
+
+                    for chunk in chunks:
+                        report.chunks += 1
+                        stored = self.state.chunks.get(chunk.chunk_id)
+                        if stored == [chunk.text_hash, chunk.document_hash]:
+                            report.unchanged += 1
+                        elif stored is not None and stored[0] == chunk.text_hash:
+                            # Only metadata changed: merge it and keep the stored vector.
+                            await queue_upload([(chunk, chunk.document(vectors=None))])
+                        else:
+                            to_embed.append(chunk)
+
+                    while len(to_embed) >= self.embed_batch_size:
+                        batch = to_embed[: self.embed_batch_size]
+                        del to_embed[: self.embed_batch_size]
+                        await embed_slots.acquire()
+                        spawn(embed(batch))
+
+                if to_embed:
+                    await embed_slots.acquire()
+                    spawn(embed(to_embed))
+
+                while tasks or to_upload:
+                    if tasks:
+                        # Workers record their own failures; this only waits for them.
+                        await asyncio.gather(*list(tasks), return_exceptions=True)
+                    elif to_upload:
+                        batch = list(to_upload)
+                        to_upload.clear()
+                        await upload_slots.acquire()
+                        spawn(upload(batch))
+
+                if prune:
+                    for parent_id in set(self.state.parents) - seen_parents:
+                        stale_keys.extend(
+                            f"{parent_id}_{i}" for i in range(self.state.parents.pop(parent_id))
+                        )
+                if stale_keys:
+                    await self.__delete(search_client, stale_keys, report)
+
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*list(tasks), return_exceptions=True)
+            if not isinstance(credential, AzureKeyCredential):
+                await credential.close()
+            # What was confirmed so far is not embedded again by the next run.
+            self.state.save()
+        report.elapsed_seconds = time.perf_counter() - start
+        return report
+
+    async def __upload(
+        self: "HotelIngestionService",
+        search_client: SearchClient,
+        batch: list[tuple[HotelChunk, dict]],
+        report: IngestionReport,
+    ) -> None:
+        pending = {chunk.chunk_id: (chunk, document) for chunk, document in batch}
+        for attempt in range(self.max_retries + 1):
+            try:
+                results = await search_client.merge_or_upload_documents(
+                    documents=[document for _, document in pending.values()]
+                )
+            except Exception as e:
+                if not _retryable(e) or attempt == self.max_retries:
+                    report.failed += len(pending)
+                    report.failures.append(f"upload {next(iter(pending))}..: {_message(e)}")
+                    logging.error(f"Upload batch failed: {_message(e)}")
+                    return
+                await self.__backoff(attempt)
+                continue
+
+            retry = {}
+            for result in results:
+                chunk, document = pending[result.key]
+                if result.succeeded:
+                    report.uploaded += 1
+                    self.state.chunks[chunk.chunk_id] = [chunk.text_hash, chunk.document_hash]
+                elif result.status_code in RETRYABLE_STATUS and attempt < self.max_retries:
+                    retry[result.key] = (chunk, document)
+                else:
+                    report.failed += 1
+                    report.failures.append(f"upload {result.key}: {result.error_message}")
+            if not retry:
+                return
+            pending = retry
+            await self.__backoff(attempt)
+
+    async def __delete(
+        self: "HotelIngestionService",
+        search_client: SearchClient,
+        keys: list[str],
+        report: IngestionReport,
+    ) -> None:
+        for start in range(0, len(keys), self.upload_batch_size):
+            pending = keys[start : start + self.upload_batch_size]
+            for attempt in range(self.max_retries + 1):
+                try:
+                    results = await search_client.delete_documents(
+                        documents=[{"chunk_id": key} for key in pending]
+                    )
+                except Exception as e:
+                    if not _retryable(e) or attempt == self.max_retries:
+                        report.failures.append(f"delete {pending[0]}..: {_message(e)}")
+                        logging.error(f"Delete batch failed: {_message(e)}")
+                        break
+                    await self.__backoff(attempt)
+                    continue
+
+                retry = []
+                for result in results:
+                    if result.succeeded:
+                        report.deleted += 1
+                        self.state.chunks.pop(result.key, None)
+                    elif result.status_code in RETRYABLE_STATUS and attempt < self.max_retries:
+                        retry.append(result.key)
+                    else:
+                        report.failures.append(f"delete {result.key}: {result.error_message}")
+                if not retry:
+                    break
+                pending = retry
+                await self.__backoff(attempt)
+
+    def __field_vectors(self: "HotelIngestionService", vector: list[float]) -> dict[str, list[float]]:
+        return {
+            name: truncate(vector, dimensions) if dimensions and dimensions < len(vector) else vector
+            for name, dimensions in self.vector_fields.items()
+        }
+
+    async def __backoff(self: "HotelIngestionService", attempt: int) -> None:
+        delay = min(30.0, 0.5 * 2**attempt)
+        await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    def __get_credential(
+        self: "HotelIngestionService",
+    ) -> AzureKeyCredential | ManagedIdentityCredential | AzureCliCredential:
+        api_key = os.getenv("AZURE_AI_SEARCH_API_KEY")
+        if api_key:
+            return AzureKeyCredential(api_key)
+
+        client_id = os.getenv("AZURE_CLIENT_ID")
+
+        if client_id:
+            return ManagedIdentityCredential(client_id=client_id)
+
+        return AzureCliCredential()
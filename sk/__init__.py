@@ -1,8 +1,13 @@
+import importlib
 
-
-from sk.plugins.hotel_vector_search_plugin import HotelVectorSearchPlugin
-from sk.memory.chat_history_azure_ai_search import ChatHistoryModel
-from sk.utils import initialize_semantic_kernel, initialize_chat_history
+# Exports resolve on first access so that importing `sk` does not pull in
+# Semantic Kernel until something actually needs it.
+_exports = {
+    "HotelVectorSearchPlugin": "sk.plugins.hotel_vector_search_plugin",
+    "ChatHistoryModel": "sk.memory.chat_history_azure_ai_search",
+    "initialize_semantic_kernel": "sk.utils",
+    "initialize_chat_history": "sk.utils",
+}
 
 __all__ = [
     "HotelVectorSearchPlugin",
@@ -10,3 +15,9 @@ __all__ = [
     "initialize_semantic_kernel",
     "initialize_chat_history",
 ]
+
+
+def __getattr__(name: str):
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name]), name)
+    raise AttributeError(f"module 'sk' has no attribute '{name}'")
@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterator
+
+from semantic_kernel.filters import FunctionInvocationContext
+from semantic_kernel.functions import FunctionResult
+
+from core.cache import cache
+from core.singleflight import fingerprint
+
+logger = logging.getLogger("tool_calls")
+
+# Functions without side effects whose results may be reused within a session.
+MEMOIZED_FUNCTIONS = {"HotelVectorSearch-search", "HotelSearchPlugin-search"}
+
+
+@dataclass
+class ToolTurn:
+    session_id: str
+    calls: int = 0
+    cache_hits: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    latency_ms: dict[str, float] = field(default_factory=dict)
+    # One {"tool", "status", "latency_ms"} entry per finished call, in order.
+    statuses: list[dict] = field(default_factory=list)
+
+
+current_tool_turn: ContextVar[ToolTurn | None] = ContextVar(
+    "current_tool_turn", default=None
+)
+
+
+@contextmanager
+def tool_turn(session_id: str) -> Iterator[ToolTurn]:
+    """Scopes tool-call memoization to a session and logs the turn's tool calls."""
+    turn = ToolTurn(session_id=session_id)
+    token = current_tool_turn.set(turn)
+    start = time.perf_counter()
+    try:
+        yield turn
+    finally:
+        current_tool_turn.reset(token)
+        if turn.calls:
+            logger.info(
+                "session=%s tool_calls=%d cache_hits=%d max_parallel=%d "
+                "tool_ms=%s turn_ms=%.1f",
+                turn.session_id,
+                turn.calls,
+                turn.cache_hits,
+                turn.max_in_flight,
+                {name: round(ms, 1) for name, ms in turn.latency_ms.items()},
+                (time.perf_counter() - start) * 1000,
+            )
+
+
+def _normalize(value: object) -> object:
+    if isinstance(value, str):
+        # Only case and spacing are folded: reordered or negated queries mean
+        # something else and must not share a result.
+        return " ".join(value.lower().split())
+    return value
+
+
+class ToolResultCache:
+    """Reuses tool results within a session, on this instance and across instances.
+
+    Results are kept in the "tool-results" namespace of the shared cache;
+    a call identical to one still running waits for it instead of repeating it.
+    """
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        self._cache = cache("tool-results", ttl=ttl, l1_entries=max_entries)
+
+    def _key(self, turn: ToolTurn, context: FunctionInvocationContext) -> tuple:
+        arguments = fingerprint(
+            {
+                name: _normalize(value)
+                for name, value in context.arguments.items()
+                if name != "execution_settings"
+            }
+        )
+        return (turn.session_id, context.function.fully_qualified_name, arguments)
+
+    async def on_function_invocation(
+        self,
+        context: FunctionInvocationContext,
+        next: Callable[[FunctionInvocationContext], Awaitable[None]],
+    ) -> None:
+        turn = current_tool_turn.get()
+        if turn is None:
+            await next(context)
+            return
+
+        name = context.function.fully_qualified_name
+        turn.calls += 1
+        turn.in_flight += 1
+        turn.max_in_flight = max(turn.max_in_flight, turn.in_flight)
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            if name not in MEMOIZED_FUNCTIONS:
+                await next(context)
+                return
+
+            executed = False
+
+            async def invoke() -> object:
+                nonlocal executed
+                executed = True
+                await next(context)
+                return None if context.result is None else context.result.value
+
+            value = await self._cache.get_or_load(self._key(turn, context), invoke)
+            if not executed:
+                turn.cache_hits += 1
+                status = "cached"
+                context.result = FunctionResult(function=context.function.metadata, value=value)
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            turn.in_flight -= 1
+            turn.latency_ms[name] = turn.latency_ms.get(name, 0.0) + elapsed
+            turn.statuses.append(
+                {"tool": name, "status": status, "latency_ms": round(elapsed, 1)}
+            )
+
+
+tool_result_cache = ToolResultCache(
+    ttl=float(os.getenv("TOOL_RESULT_CACHE_TTL_SECONDS", "300")),
+    max_entries=int(os.getenv("TOOL_RESULT_CACHE_MAX_ENTRIES", "2000")),
+)
+
+
+def max_auto_invoke_attempts() -> int:
+    return int(os.getenv("MAX_AUTO_INVOKE_ATTEMPTS", "3"))
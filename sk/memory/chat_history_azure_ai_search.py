@@ -1,27 +1,145 @@
+import os
 import json
+import asyncio
+import logging
 from datetime import datetime
 from dataclasses import dataclass
 from typing import Annotated
+from pydantic import Field
 from semantic_kernel.data import (
+    VectorSearchFilter,
+    VectorSearchOptions,
     VectorStoreRecordCollection,
     VectorStoreRecordDataField,
     VectorStoreRecordKeyField,
+    VectorStoreRecordVectorField,
     vectorstoremodel
 )
+from semantic_kernel.data.const import DistanceFunction, IndexKind
 from semantic_kernel.contents import (
     ChatMessageContent,
-    ChatHistoryTruncationReducer
+    ChatHistoryTruncationReducer,
+    ImageContent,
 )
+from semantic_kernel.contents.utils.author_role import AuthorRole
 from semantic_kernel.connectors.memory.azure_ai_search import AzureAISearchStore
+from core.embeddings import embedding_settings
+from core.telemetry import stage
+
+# With memory on, only the last CHAT_MEMORY_RECENT_TURNS turns are replayed
+# verbatim; earlier turns are indexed with an embedding and the
+# CHAT_MEMORY_RECALL_TOP most relevant to the new prompt are added instead.
+MEMORY_ENABLED = os.getenv("CHAT_MEMORY_ENABLED", "true").lower() == "true"
+RECENT_TURNS = int(os.getenv("CHAT_MEMORY_RECENT_TURNS", "3"))
+RECALL_TOP = int(os.getenv("CHAT_MEMORY_RECALL_TOP", "3"))
+TURN_CHARS = int(os.getenv("CHAT_MEMORY_TURN_CHARS", "1500"))
+
+RECALL_HEADER = (
+    "Earlier parts of this conversation that may be relevant to the user's latest message:"
+)
+# Metadata key of the system message that summarizes turns folded away by
+# compaction, holding how many there were, so later turns keep their numbers.
+COMPACTED_TURNS = "compacted_turns"
+
+# Collections already created by this worker, so requests after the first one
+# skip the existence check round trip.
+_ensured_collections: set[str] = set()
+
+# Turn indexing runs after the response; the event loop only holds weak references to tasks.
+_indexing: set[asyncio.Task] = set()
 
 
 @vectorstoremodel
 @dataclass
 class ChatHistoryModel:
+    """A session with all its messages, or (kind "turn") one indexed turn of a session.
+
+    Turn records are keyed "<session>-turn-<n>" and carry the turn's text
+    and its embedding in `text_vector`; session records leave them empty.
+    """
+
     session_id: Annotated[str, VectorStoreRecordKeyField]
     user_id: Annotated[str, VectorStoreRecordDataField(is_filterable=True)]
     messages: Annotated[str, VectorStoreRecordDataField(is_filterable=True)]
     timestamp: Annotated[str, VectorStoreRecordDataField(is_filterable=True)]
+    kind: Annotated[str, VectorStoreRecordDataField(is_filterable=True)] = "session"
+    conversation_id: Annotated[str, VectorStoreRecordDataField(is_filterable=True)] = ""
+    turn: Annotated[int, VectorStoreRecordDataField(is_filterable=True)] = 0
+    text: Annotated[str, VectorStoreRecordDataField(is_full_text_searchable=True)] = ""
+    text_vector: Annotated[
+        list[float] | None,
+        VectorStoreRecordVectorField(
+            dimensions=embedding_settings.size,
+            distance_function=DistanceFunction.COSINE_DISTANCE,
+            index_kind=IndexKind.HNSW,
+        ),
+    ] = None
+
+
+def _turn_starts(messages: list[ChatMessageContent]) -> list[int]:
+    """Indexes of the messages that begin a turn; a turn starts at each user message."""
+    starts = [
+        index for index, message in enumerate(messages) if message.role == AuthorRole.USER
+    ]
+    first = next(
+        (index for index, message in enumerate(messages) if message.role != AuthorRole.SYSTEM),
+        None,
+    )
+    if first is not None and (not starts or starts[0] > first):
+        starts.insert(0, first)
+    return starts
+
+
+def _compacted_turns(messages: list[ChatMessageContent]) -> int:
+    return next(
+        (int(message.metadata[COMPACTED_TURNS]) for message in messages
+         if COMPACTED_TURNS in message.metadata),
+        0,
+    )
+
+
+def _turn_text(messages: list[ChatMessageContent]) -> str:
+    lines = []
+    for message in messages:
+        if message.role not in (AuthorRole.USER, AuthorRole.ASSISTANT):
+            continue
+        text = " ".join((message.content or "").split())
+        if any(isinstance(item, ImageContent) for item in message.items):
+            text = f"{text} [image]".strip()
+        if text:
+            lines.append(f"{message.role.value}: {text}")
+    return "\n".join(lines)[:TURN_CHARS]
+
+
+async def _add_missing_fields(collection: VectorStoreRecordCollection) -> None:
+    """Adds ChatHistoryModel fields that an older chat-history index does not have yet."""
+    from semantic_kernel.connectors.memory.azure_ai_search.utils import (
+        data_model_definition_to_azure_ai_search_index,
+    )
+
+    index_client = collection.search_index_client  # pyright: ignore
+    index = await index_client.get_index(collection.collection_name)
+    expected = data_model_definition_to_azure_ai_search_index(
+        collection.collection_name, collection.data_model_definition
+    )
+    existing = {field.name for field in index.fields}
+    missing = [field for field in expected.fields if field.name not in existing]
+    if not missing:
+        return
+    index.fields.extend(missing)
+    if index.vector_search is None:
+        index.vector_search = expected.vector_search
+    else:
+        index.vector_search.algorithms = (index.vector_search.algorithms or []) + (
+            expected.vector_search.algorithms or []
+        )
+        index.vector_search.profiles = (index.vector_search.profiles or []) + (
+            expected.vector_search.profiles or []
+        )
+    await index_client.create_or_update_index(index)
+    logging.info(
+        f"Added {[field.name for field in missing]} to the {collection.collection_name} index."
+    )
 
 
 class ChatHistoryInAzureAISearch(ChatHistoryTruncationReducer):
@@ -30,6 +148,12 @@ class ChatHistoryInAzureAISearch(ChatHistoryTruncationReducer):
     user_id: str | None = None
     store: AzureAISearchStore
     collection: VectorStoreRecordCollection | None = None
+    # Stored turns left out of the prompt, written back unchanged by store_messages.
+    archived: list[dict] = Field(default_factory=list)
+    # Number of the first turn in `messages`, and of turns already indexed.
+    first_turn: int = 0
+    stored_turns: int = 0
+    recall_message: ChatMessageContent | None = None
 
     async def create_collection(self, collection_name: str) -> None:
         collection = self.store.get_collection(
@@ -37,32 +161,159 @@ class ChatHistoryInAzureAISearch(ChatHistoryTruncationReducer):
             data_model_type=ChatHistoryModel
         )
         self.collection = collection
-        await self.collection.create_collection_if_not_exists()
+        if collection_name not in _ensured_collections:
+            if await self.collection.does_collection_exist():
+                await _add_missing_fields(self.collection)
+            else:
+                await self.collection.create_collection()
+            _ensured_collections.add(collection_name)
 
     async def store_messages(self) -> None:
         if not self.is_session_info_set():
             raise ValueError(
                 "Session info is not set.")
-        serialized_messages = json.dumps([msg.model_dump() for msg in self.messages])
+        messages = [message for message in self.messages if message is not self.recall_message]
+        system_count = next(
+            (index for index, message in enumerate(messages) if message.role != AuthorRole.SYSTEM),
+            len(messages),
+        )
+        serialized_messages = json.dumps(
+            [msg.model_dump() for msg in messages[:system_count]]
+            + self.archived
+            + [msg.model_dump() for msg in messages[system_count:]]
+        )
         if self.collection:
-            await self.collection.upsert(
-                ChatHistoryModel(
-                    session_id=self.session_id,
-                    user_id=self.user_id,
-                    messages=serialized_messages,
-                    timestamp=datetime.now().isoformat()
+            with stage("history-write"):
+                await self.collection.upsert(
+                    ChatHistoryModel(
+                        session_id=self.session_id,
+                        user_id=self.user_id,
+                        messages=serialized_messages,
+                        timestamp=datetime.now().isoformat()
+                    )
                 )
-            )
+            if MEMORY_ENABLED:
+                self.__index_new_turns(messages)
 
-    async def read_messages(self) -> None:
+    async def read_messages(self, query: str | None = None) -> None:
+        """Loads the session; with memory on, the recent turns plus the earlier ones relevant to `query`."""
         if self.collection:
-            record = await self.collection.get(self.session_id)
-            if record:
-                message_list = json.loads(record.messages)
-                for message in message_list:
-                    # deserialized_message = ChatMessageContent.model_validate(message)
-                    deserialized_message = ChatMessageContent.model_validate(message)
-                    self.messages.append(deserialized_message)
+            # Read from the index every time: a cached copy could be older
+            # than a turn another instance just wrote, and storing it would
+            # overwrite that turn.
+            with stage("history-read"):
+                record = await self.collection.get(self.session_id)
+            serialized_messages = record.messages if record else None
+            if serialized_messages:
+                message_list = json.loads(serialized_messages)
+                messages = [
+                    ChatMessageContent.model_validate(message) for message in message_list
+                ]
+                starts = _turn_starts(messages)
+                compacted = _compacted_turns(messages)
+                self.stored_turns = compacted + len(starts)
+                self.first_turn = compacted
+                if not MEMORY_ENABLED or len(starts) <= RECENT_TURNS:
+                    self.messages.extend(messages)
+                    return
+
+                self.first_turn = compacted + len(starts) - RECENT_TURNS
+                cut = starts[len(starts) - RECENT_TURNS]
+                older = range(starts[0], cut)
+                self.archived = [message_list[index] for index in older]
+                self.messages.extend(
+                    message for index, message in enumerate(messages)
+                    if index < cut and index not in older
+                )
+                if query:
+                    recalled = await self.__recall(query)
+                    if recalled:
+                        self.recall_message = ChatMessageContent(
+                            role=AuthorRole.SYSTEM,
+                            content="\n\n".join([RECALL_HEADER, *recalled]),
+                        )
+                        self.messages.append(self.recall_message)
+                self.messages.extend(messages[cut:])
+
+    async def __recall(self, query: str) -> list[str]:
+        """Texts of the earlier, not replayed turns most similar to `query`, in conversation order."""
+        from services.azure_openai_service import AzureOpenAIService
+
+        try:
+            with stage("memory-recall"):
+                vector = await AzureOpenAIService().create_embedding(query)
+                results = await self.collection.vectorized_search(  # pyright: ignore
+                    vector,
+                    options=VectorSearchOptions(
+                        vector_field_name="text_vector",
+                        top=RECALL_TOP + RECENT_TURNS,
+                        filter=VectorSearchFilter.equal_to("kind", "turn").equal_to(
+                            "conversation_id", (self.session_id or "").replace("'", "''")
+                        ),
+                    ),
+                )
+                recalled: list[tuple[int, str]] = []
+                async for result in results.results:
+                    record = result.record
+                    if (
+                        record.kind == "turn"
+                        and record.conversation_id == self.session_id
+                        and record.turn < self.first_turn
+                    ):
+                        recalled.append((record.turn, record.text))
+                    if len(recalled) >= RECALL_TOP:
+                        break
+        except Exception as e:
+            logging.warning(f"Memory recall failed, continuing with recent turns only: {e}")
+            return []
+        return [text for _, text in sorted(recalled)]
+
+    def __index_new_turns(self, messages: list[ChatMessageContent]) -> None:
+        starts = _turn_starts(messages)
+        turns = [
+            (self.first_turn + position, messages[start:end])
+            for position, (start, end) in enumerate(zip(starts, starts[1:] + [len(messages)]))
+            if self.first_turn + position >= self.stored_turns
+        ]
+        if not turns:
+            return
+        self.stored_turns = self.first_turn + len(starts)
+        task = asyncio.create_task(
+            self.__index_turns(
+                [(number, _turn_text(turn)) for number, turn in turns if _turn_text(turn)]
+            )
+        )
+        _indexing.add(task)
+        task.add_done_callback(_indexing.discard)
+
+    async def __index_turns(self, turns: list[tuple[int, str]]) -> None:
+        from services.azure_openai_service import AzureOpenAIService
+
+        if not turns or self.collection is None:
+            return
+        try:
+            vectors = await AzureOpenAIService().create_embeddings(
+                [text for _, text in turns],
+                model=embedding_settings.model,
+                dimensions=embedding_settings.dimensions,
+            )
+            timestamp = datetime.now().isoformat()
+            await self.collection.upsert_batch([
+                ChatHistoryModel(
+                    session_id=f"{self.session_id}-turn-{number}",
+                    user_id=self.user_id or "",
+                    messages="",
+                    timestamp=timestamp,
+                    kind="turn",
+                    conversation_id=self.session_id or "",
+                    turn=number,
+                    text=text,
+                    text_vector=vector,
+                )
+                for (number, text), vector in zip(turns, vectors)
+            ])
+        except Exception as e:
+            logging.warning(f"Indexing turns of session {self.session_id} failed: {e}")
 
     def set_session_info(self, session_id: str, user_id: str) -> None:
         self.session_id = session_id
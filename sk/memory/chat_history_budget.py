@@ -0,0 +1,92 @@
+from semantic_kernel.contents import (
+    ChatHistory,
+    ChatMessageContent,
+    FunctionCallContent,
+    FunctionResultContent,
+    ImageContent,
+    TextContent,
+)
+from semantic_kernel.contents.utils.author_role import AuthorRole
+
+# Rough sizing used for budgets only: ~4 characters per token, and the
+# high-detail cost of a single 512px image tile pair.
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 765
+
+
+def measure_message(message: ChatMessageContent) -> tuple[int, int]:
+    chars = 0
+    tokens = 0
+    size = 0
+    for item in message.items:
+        if isinstance(item, TextContent):
+            chars += len(item.text or "")
+        elif isinstance(item, ImageContent):
+            tokens += IMAGE_TOKENS
+            size += len(item.data or b"") if item.data else len(item.uri or "")
+        elif isinstance(item, FunctionCallContent):
+            chars += len(item.name or "") + len(str(item.arguments or ""))
+        elif isinstance(item, FunctionResultContent):
+            chars += len(str(item.result))
+    return tokens + chars // CHARS_PER_TOKEN, size + chars
+
+
+def measure_chat_history(history: ChatHistory) -> tuple[int, int]:
+    tokens = 0
+    size = 0
+    for message in history.messages:
+        message_tokens, message_size = measure_message(message)
+        tokens += message_tokens
+        size += message_size
+    return tokens, size
+
+
+def truncate_message(message: ChatMessageContent, max_tokens: int) -> int:
+    """Cuts the message's text, keeping its start, until it fits in `max_tokens`; returns its new size."""
+    tokens = measure_message(message)[0]
+    if tokens <= max_tokens:
+        return tokens
+    excess = (tokens - max_tokens) * CHARS_PER_TOKEN
+    for item in reversed(message.items):
+        if excess <= 0:
+            break
+        if isinstance(item, TextContent) and item.text:
+            cut = min(excess, len(item.text))
+            item.text = item.text[: len(item.text) - cut]
+            excess -= cut
+    return measure_message(message)[0]
+
+
+def trim_chat_history(history: ChatHistory, max_tokens: int) -> int:
+    """Drops the oldest turns until the history fits in `max_tokens`.
+
+    System messages are kept, and the remaining history always starts at a
+    user message so tool calls are never separated from their results. The
+    latest user message is always kept; when it does not fit on its own, its
+    text is cut instead. Returns the number of messages removed.
+    """
+    sizes = [measure_message(message)[0] for message in history.messages]
+    total = sum(sizes)
+    latest = next(
+        (message for message in reversed(history.messages) if message.role == AuthorRole.USER), None
+    )
+    removed = 0
+    index = 0
+    while index < len(history.messages):
+        message = history.messages[index]
+        if message.role == AuthorRole.SYSTEM:
+            index += 1
+            continue
+
+        starts_turn = message.role == AuthorRole.USER
+        if (total <= max_tokens and starts_turn) or message is latest:
+            break
+
+        total -= sizes.pop(index)
+        del history.messages[index]
+        removed += 1
+
+    if latest is not None and total > max_tokens:
+        size = sizes[index]
+        total += truncate_message(latest, max(0, max_tokens - (total - size))) - size
+    return removed
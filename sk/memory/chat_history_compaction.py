@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any
+
+from semantic_kernel.contents import ChatMessageContent, ImageContent, TextContent
+from semantic_kernel.contents.utils.author_role import AuthorRole
+from semantic_kernel.data import VectorStoreRecordCollection
+
+from core.openai_scheduler import BULK, lane
+from sk.memory.chat_history_azure_ai_search import (
+    COMPACTED_TURNS,
+    RECENT_TURNS,
+    ChatHistoryModel,
+    _compacted_turns,
+    _turn_starts,
+    _turn_text,
+)
+
+# Sessions not written for this long are deleted, and so are their indexed turns.
+CHAT_HISTORY_TTL_DAYS = float(os.getenv("CHAT_HISTORY_TTL_DAYS", "30"))
+# Sessions idle this long are compacted: turns before the last
+# CHAT_HISTORY_KEEP_TURNS are summarized, once at least
+# CHAT_HISTORY_COMPACT_MIN_TURNS of them have piled up, and images are dropped.
+CHAT_HISTORY_COMPACT_IDLE_HOURS = float(os.getenv("CHAT_HISTORY_COMPACT_IDLE_HOURS", "6"))
+CHAT_HISTORY_KEEP_TURNS = int(os.getenv("CHAT_HISTORY_KEEP_TURNS", str(RECENT_TURNS)))
+CHAT_HISTORY_COMPACT_MIN_TURNS = int(os.getenv("CHAT_HISTORY_COMPACT_MIN_TURNS", "3"))
+# Limits of one run, so it stays within the function timeout and does not
+# compete with live traffic for the search service.
+CHAT_HISTORY_WRITES_PER_SECOND = float(os.getenv("CHAT_HISTORY_WRITES_PER_SECOND", "50"))
+CHAT_HISTORY_DELETE_BATCH = int(os.getenv("CHAT_HISTORY_DELETE_BATCH", "100"))
+CHAT_HISTORY_MAX_DELETES = int(os.getenv("CHAT_HISTORY_MAX_DELETES", "2000"))
+CHAT_HISTORY_MAX_SCANNED_SESSIONS = int(os.getenv("CHAT_HISTORY_MAX_SCANNED_SESSIONS", "500"))
+CHAT_HISTORY_COMPACTION_MAX_SECONDS = float(os.getenv("CHAT_HISTORY_COMPACTION_MAX_SECONDS", "240"))
+# The largest `skip` the search service accepts.
+MAX_SEARCH_SKIP = 100_000
+
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_HEADER = "Summary of the earlier part of this conversation:"
+SUMMARY_PROMPT = """
+    Summarize this conversation between a user and a hotel recommendation assistant
+    for the assistant to continue it. Keep what the user is looking for (places,
+    dates, budget, amenities, preferences), the hotels already recommended and
+    what the user thought of them. Leave out greetings and repetition. Reply
+    with the summary only, in at most 200 words.
+"""
+
+
+class _Pacer:
+    """Spaces writes out to at most `per_second` documents a second."""
+
+    def __init__(self, per_second: float) -> None:
+        self.interval = 1 / per_second
+        self._next = time.monotonic()
+
+    async def wait(self, documents: int = 1) -> None:
+        now = time.monotonic()
+        if self._next > now:
+            await asyncio.sleep(self._next - now)
+        self._next = max(now, self._next) + documents * self.interval
+
+
+def _strip_images(message: ChatMessageContent) -> bool:
+    """Replaces the message's images with a placeholder; whether it had any."""
+    images = [item for item in message.items if isinstance(item, ImageContent)]
+    if not images:
+        return False
+    message.items = [
+        TextContent(text="[image]") if isinstance(item, ImageContent) else item
+        for item in message.items
+    ]
+    return True
+
+
+async def _summarize(previous: str | None, turns: list[list[ChatMessageContent]]) -> str:
+    from services.azure_openai_service import AzureOpenAIService
+
+    transcript = "\n\n".join(text for text in (_turn_text(turn) for turn in turns) if text)
+    if previous:
+        transcript = f"{SUMMARY_HEADER}\n{previous}\n\n{transcript}"
+    with lane(BULK):
+        return await AzureOpenAIService().chat(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+        )
+
+
+async def compact_messages(serialized: str) -> str | None:
+    """The session's messages with old turns summarized and images dropped, or None if there is nothing to do."""
+    messages = [ChatMessageContent.model_validate(message) for message in json.loads(serialized)]
+    summary = next((message for message in messages if COMPACTED_TURNS in message.metadata), None)
+    starts = _turn_starts(messages)
+    fold = len(starts) - CHAT_HISTORY_KEEP_TURNS
+    if fold < CHAT_HISTORY_COMPACT_MIN_TURNS:
+        fold = 0
+    stripped = sum(_strip_images(message) for message in messages)
+    if not fold and not stripped:
+        return None
+
+    if fold:
+        ends = starts[1:] + [len(messages)]
+        turns = [messages[start:end] for start, end in zip(starts[:fold], ends[:fold])]
+        previous = (summary.content or "").removeprefix(SUMMARY_HEADER).strip() if summary else None
+        text = await _summarize(previous, turns)
+        head = [message for message in messages[:starts[0]] if message is not summary]
+        summary = ChatMessageContent(
+            role=AuthorRole.SYSTEM,
+            content=f"{SUMMARY_HEADER}\n{text}",
+            metadata={COMPACTED_TURNS: _compacted_turns(messages) + fold},
+        )
+        messages = head + [summary] + messages[starts[fold]:]
+    return json.dumps([message.model_dump() for message in messages])
+
+
+async def _delete(
+    collection: VectorStoreRecordCollection, keys: list[str], pacer: _Pacer, stop_at: float
+) -> int:
+    """Deletes `keys` in paced batches."""
+    deleted = 0
+    for offset in range(0, len(keys), CHAT_HISTORY_DELETE_BATCH):
+        if time.monotonic() >= stop_at:
+            break
+        batch = keys[offset:offset + CHAT_HISTORY_DELETE_BATCH]
+        await pacer.wait(len(batch))
+        await collection.delete_batch(batch)
+        deleted += len(batch)
+    return deleted
+
+
+async def _expire(
+    collection: VectorStoreRecordCollection, cutoff: str, pacer: _Pacer, stop_at: float
+) -> int:
+    """Deletes sessions last written before `cutoff`, oldest first, then the turns of sessions that are gone.
+
+    A turn expires with its session, not by its own timestamp: the early
+    turns of a session that is still active stay recallable.
+    """
+    results = await collection.search_client.search(  # pyright: ignore
+        search_text="*",
+        filter=f"timestamp lt '{cutoff}' and (kind eq 'session' or kind eq null)",
+        select=["session_id"],
+        order_by=["timestamp asc"],
+        top=CHAT_HISTORY_MAX_DELETES,
+    )
+    sessions = [result["session_id"] async for result in results]
+    deleted = await _delete(collection, sessions, pacer, stop_at)
+
+    # A turn is written while its session is active, so one newer than `cutoff` belongs to a live session.
+    # Old turns of sessions still in use are paged past, so they cannot hide expired ones behind them.
+    expired: dict[str, bool] = {}
+    keys: list[str] = []
+    skip = 0
+    while len(keys) < CHAT_HISTORY_MAX_DELETES and skip <= MAX_SEARCH_SKIP and time.monotonic() < stop_at:
+        results = await collection.search_client.search(  # pyright: ignore
+            search_text="*",
+            filter=f"timestamp lt '{cutoff}' and kind eq 'turn'",
+            select=["session_id", "conversation_id"],
+            order_by=["timestamp asc", "session_id asc"],
+            skip=skip,
+            top=CHAT_HISTORY_MAX_DELETES,
+        )
+        turns = [(result["session_id"], result["conversation_id"]) async for result in results]
+        skip += len(turns)
+        for key, session_id in turns:
+            if session_id not in expired:
+                session = await collection.get(session_id, include_vectors=False) if session_id else None
+                expired[session_id] = session is None or session.timestamp < cutoff
+            if expired[session_id]:
+                keys.append(key)
+        if len(turns) < CHAT_HISTORY_MAX_DELETES:
+            break
+    return deleted + await _delete(collection, keys[:CHAT_HISTORY_MAX_DELETES], pacer, stop_at)
+
+
+async def _compact(
+    collection: VectorStoreRecordCollection,
+    idle_cutoff: str,
+    expiry_cutoff: str,
+    pacer: _Pacer,
+    stop_at: float,
+    report: dict[str, Any],
+) -> None:
+    """Compacts sessions idle since before `idle_cutoff`, the most recently active first.
+
+    Those were compacted the least; older ones were handled by earlier runs.
+    """
+    results = await collection.search_client.search(  # pyright: ignore
+        search_text="*",
+        filter=(
+            f"timestamp lt '{idle_cutoff}' and timestamp ge '{expiry_cutoff}'"
+            " and (kind eq 'session' or kind eq null)"
+        ),
+        select=["session_id", "timestamp"],
+        order_by=["timestamp desc"],
+        top=CHAT_HISTORY_MAX_SCANNED_SESSIONS,
+    )
+    candidates = [(result["session_id"], result["timestamp"]) async for result in results]
+    for session_id, timestamp in candidates:
+        if time.monotonic() >= stop_at:
+            break
+        report["scanned"] += 1
+        try:
+            record = await collection.get(session_id, include_vectors=False)
+            if record is None or not record.messages:
+                continue
+            compacted = await compact_messages(record.messages)
+            if compacted is None:
+                continue
+            # Leave a session alone that became active again meanwhile. Search
+            # documents have no ETag to write conditionally on, so the check
+            # comes after the pacer's wait, right before the write.
+            await pacer.wait()
+            current = await collection.get(session_id, include_vectors=False)
+            if current is None or current.timestamp != timestamp:
+                continue
+            await collection.upsert(
+                ChatHistoryModel(
+                    session_id=session_id,
+                    user_id=record.user_id,
+                    messages=compacted,
+                    # The last activity is unchanged, so the session still expires on time.
+                    timestamp=timestamp,
+                )
+            )
+            report["compacted"] += 1
+            report["chars_saved"] += len(record.messages) - len(compacted)
+        except Exception as e:
+            report["failed"] += 1
+            logging.warning(f"Compacting chat history session {session_id} failed: {e}")
+
+
+async def compact_chat_history(collection_name: str = "chat-history") -> dict[str, Any]:
+    """Deletes expired chat history and compacts idle sessions; returns what was done."""
+    from sk.utils import initialize_search_index_client, initialize_store
+
+    start = time.monotonic()
+    stop_at = start + CHAT_HISTORY_COMPACTION_MAX_SECONDS
+    now = datetime.now()
+    # Timestamps are written with datetime.now().isoformat(), which compares as text.
+    expiry_cutoff = (now - timedelta(days=CHAT_HISTORY_TTL_DAYS)).isoformat()
+    idle_cutoff = (now - timedelta(hours=CHAT_HISTORY_COMPACT_IDLE_HOURS)).isoformat()
+    report: dict[str, Any] = {"expired": 0, "scanned": 0, "compacted": 0, "failed": 0, "chars_saved": 0}
+    pacer = _Pacer(CHAT_HISTORY_WRITES_PER_SECOND)
+
+    async with initialize_search_index_client() as search_index_client:
+        collection = initialize_store(search_index_client).get_collection(
+            collection_name=collection_name, data_model_type=ChatHistoryModel
+        )
+        if not await collection.does_collection_exist():
+            return report
+        async with collection.search_client:  # pyright: ignore
+            report["expired"] = await _expire(collection, expiry_cutoff, pacer, stop_at)
+            await _compact(collection, idle_cutoff, expiry_cutoff, pacer, stop_at, report)
+    report["seconds"] = round(time.monotonic() - start, 1)
+    return report
@@ -0,0 +1,9 @@
+from semantic_kernel.functions import kernel_function
+
+
+class EmailSenderPlugin:
+    @kernel_function(
+        name="send_email", description="Send an email to the given email address."
+    )
+    async def send_email(self, email: str, message: str):
+        return f"Email sent to {email} with message: {message}"
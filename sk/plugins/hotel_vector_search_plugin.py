@@ -8,9 +8,19 @@ from semantic_kernel.functions import kernel_function
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.search.documents._generated.models import (
     QueryType,
+    VectorFilterMode,
     VectorQuery,
     VectorizableTextQuery,
 )
+from core.cache import cache
+from core.embeddings import embedding_settings
+from core.resilience import DeadlineExceeded, dependency
+from core.retrieval import adaptive_search
+from core.search_filters import SearchFilters, search_cache_key
+from core.telemetry import stage
+from services.azure_ai_search_service import search_failure, search_vocabulary
+
+_search_cache = cache("search.plugin", ttl=300, l1_ttl=60, stale_seconds=3600)
 
 
 class HotelVectorSearchPlugin:
@@ -20,51 +30,133 @@ class HotelVectorSearchPlugin:
         self._search_index_client = search_index_client
 
     @kernel_function(
-        name="search", description="Search for documents similar to the given query."
+        name="search",
+        description=(
+            "Search for hotels similar to the given query, optionally only in a city, "
+            "state or category and with given amenities."
+        ),
     )
     async def search(
         self,
         query: Annotated[str, "Query to be used for searching"],
+        city: Annotated[str | None, "Only hotels in this city, e.g. Seattle"] = None,
+        state: Annotated[str | None, "Only hotels in this US state, as its two-letter code"] = None,
+        category: Annotated[
+            str | None, "Only hotels of this category, e.g. Budget, Boutique or Luxury"
+        ] = None,
+        amenities: Annotated[
+            list[str] | None, "Amenities the hotel must have, e.g. pool or free wifi"
+        ] = None,
     ) -> list[dict]:
-        """Search for documents similar to the given query."""
+        """Search for documents similar to the given query.
+
+        Constraints named in the query are applied as filters as well; the
+        parameters, when given, take precedence over them. While the search
+        service is unavailable, recent results for the same search are
+        returned instead.
+        """
+        key = None
         try:
-            vector_queries: list[VectorQuery] | None = [
-                VectorizableTextQuery(
-                    text=query, k_nearest_neighbors=10, fields="text_vector"
+            index_name = os.environ["AZURE_AI_SEARCH_INDEX_NAME"]
+            with stage("tool-search"):
+                requested = {
+                    "City": [city] if city else [],
+                    "State": [state] if state else [],
+                    "Category": [category] if category else [],
+                    "Tags": amenities or [],
+                }
+                vocabulary = await search_vocabulary(index_name)
+                if vocabulary is None:
+                    filters = SearchFilters.from_fields(requested)
+                else:
+                    filters = vocabulary.extract(query).merge(
+                        SearchFilters.from_fields(
+                            {field: vocabulary.resolve(field, values) for field, values in requested.items()}
+                        )
+                    )
+                key = search_cache_key(index_name, embedding_settings.vector_field, query, filters)
+                return await _search_cache.get_or_load(
+                    key, lambda: self._search(index_name=index_name, query=query, filters=filters)
                 )
-            ]
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            stale = _search_cache.get_stale(key) if key is not None else None
+            if stale is not None:
+                logging.warning(f"Search failed, answering from earlier results: {e}")
+                return stale
+            logging.error(f"Error in search: {e}")
+            return []
 
-            query_args = {
-                "search_text": query,
-                "vector_queries": vector_queries,
-                "query_type": QueryType.SEMANTIC,
-                "semantic_configuration_name": os.environ[
-                    "SEMANTIC_CONFIGURATION_NAME"
-                ],
+    async def _search(
+        self, index_name: str, query: str, filters: SearchFilters | None = None
+    ) -> list[dict]:
+        filters = filters or SearchFilters()
+        # Filters that match nothing are relaxed rather than answering from no hotels.
+        for search_filter in filters.relaxations():
+            results = await adaptive_search(
+                lambda k, top, semantic: dependency("search").call(
+                    lambda: self._query(index_name, query, search_filter, k, top, semantic),
+                    is_failure=search_failure,
+                ),
+                query=query,
+            )
+            if results:
+                break
+        return [
+            {
+                "id": result["Id"],
+                "hotelName": result["HotelName"],
+                "category": result["Category"],
+                "city": result["City"],
+                "state": result["State"],
+                "description": result["chunk"],
             }
+            for result in filters.rank(results)
+        ]
 
-            search_client = self._search_index_client.get_search_client(
-                index_name=os.environ["AZURE_AI_SEARCH_INDEX_NAME"]
+    async def _query(
+        self,
+        index_name: str,
+        query: str,
+        search_filter: str | None,
+        k: int,
+        top: int,
+        semantic: bool,
+    ) -> list[dict]:
+        vector_queries: list[VectorQuery] | None = [
+            VectorizableTextQuery(
+                text=query,
+                k_nearest_neighbors=k,
+                fields=embedding_settings.vector_field,
             )
+        ]
 
-            async with search_client:  # pyright: ignore
-                results = await search_client.search(**query_args)  # pyright: ignore
-                hotels: list[dict] = []
+        query_args = {
+            "search_text": query,
+            "vector_queries": vector_queries,
+            "top": top,
+        }
 
-                async for result in results:
-                    hotels.append(
-                        {
-                            "id": result["Id"],
-                            "hotelName": result["HotelName"],
-                            "category": result["Category"],
-                            "city": result["City"],
-                            "state": result["State"],
-                            "description": result["chunk"],
-                        }
-                    )
+        if semantic:
+            query_args.update(
+                {
+                    "query_type": QueryType.SEMANTIC,
+                    "semantic_configuration_name": os.environ[
+                        "SEMANTIC_CONFIGURATION_NAME"
+                    ],
+                }
+            )
+
+        if search_filter:
+            query_args.update(
+                {"filter": search_filter, "vector_filter_mode": VectorFilterMode.PRE_FILTER}
+            )
 
-                return hotels
+        search_client = self._search_index_client.get_search_client(
+            index_name=index_name
+        )
 
-        except Exception as e:
-            logging.error(f"Error in search: {e}")
-            return []
+        async with search_client:  # pyright: ignore
+            results = await search_client.search(**query_args)  # pyright: ignore
+            return [result async for result in results]
@@ -1,22 +1,31 @@
+from __future__ import annotations
+
 import os
+import asyncio
 import logging
-from azure.identity import ManagedIdentityCredential, AzureCliCredential
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from azure.core.credentials import AzureKeyCredential
+    from azure.identity import ManagedIdentityCredential, AzureCliCredential
+    from azure.search.documents.indexes.aio import SearchIndexClient
+    from openai import AsyncAzureOpenAI
+    from semantic_kernel import Kernel
+    from semantic_kernel.connectors.memory.azure_ai_search import AzureAISearchStore
+    from sk.memory.chat_history_azure_ai_search import ChatHistoryInAzureAISearch
 
-from azure.identity import get_bearer_token_provider
-from semantic_kernel.connectors.ai.open_ai import (
-    AzureChatCompletion,
-    AzureTextEmbedding,
-)
-from semantic_kernel import Kernel
+# Semantic Kernel and the Azure SDKs are imported inside the functions below
+# so that importing a blueprint stays cheap and the cost lands on first use.
 
-from azure.search.documents.indexes.aio import SearchIndexClient
-from semantic_kernel.connectors.memory.azure_ai_search import AzureAISearchStore
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
 
-from sk.memory.chat_history_azure_ai_search import ChatHistoryInAzureAISearch
-from sk.plugins.hotel_vector_search_plugin import HotelVectorSearchPlugin
+_token_provider: Callable[[], str] | None = None
+_openai_client: AsyncAzureOpenAI | None = None
 
 
 def get_credential() -> ManagedIdentityCredential | AzureCliCredential:
+    from azure.identity import ManagedIdentityCredential, AzureCliCredential
+
     client_id = os.getenv("AZURE_CLIENT_ID")
 
     if client_id:
@@ -25,21 +34,92 @@ def get_credential() -> ManagedIdentityCredential | AzureCliCredential:
     return AzureCliCredential()
 
 
+def get_token_provider() -> Callable[[], str]:
+    global _token_provider
+    if _token_provider is None:
+        from azure.identity import get_bearer_token_provider
+
+        _token_provider = get_bearer_token_provider(
+            get_credential(), COGNITIVE_SERVICES_SCOPE
+        )
+    return _token_provider
+
+
+def get_search_credential() -> (
+    AzureKeyCredential | ManagedIdentityCredential | AzureCliCredential
+):
+    api_key = os.getenv("AZURE_AI_SEARCH_API_KEY")
+
+    if api_key:
+        from azure.core.credentials import AzureKeyCredential
+
+        return AzureKeyCredential(api_key)
+
+    return get_credential()
+
+
+def get_openai_auth() -> dict:
+    """Keyword arguments authenticating an Azure OpenAI client.
+
+    AZURE_OPENAI_API_KEY is meant for local stand-ins such as the benchmark
+    fakes; deployed instances use Entra ID tokens.
+    """
+    api_key = os.getenv("AZURE_OPENAI_API_KEY")
+
+    if api_key:
+        return {"api_key": api_key}
+
+    return {"ad_token_provider": get_token_provider()}
+
+
+def get_openai_client() -> AsyncAzureOpenAI:
+    """The Azure OpenAI client shared by the Semantic Kernel services.
+
+    Its requests go through the deployment schedulers, which also own retries.
+    """
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncAzureOpenAI
+        from core.openai_scheduler import scheduled_http_client
+
+        auth = get_openai_auth()
+        _openai_client = AsyncAzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+            api_key=auth.get("api_key"),
+            azure_ad_token_provider=auth.get("ad_token_provider"),
+            api_version=os.getenv("OPENAI_API_VERSION", ""),
+            http_client=scheduled_http_client(),
+            max_retries=0,
+        )
+    return _openai_client
+
+
 def initialize_search_index_client() -> SearchIndexClient:
+    from azure.search.documents.indexes.aio import SearchIndexClient
+
     return SearchIndexClient(
         endpoint=os.getenv("AZURE_AI_SEARCH_ENDPOINT", ""),
-        credential=get_credential(),  # pyright: ignore
+        credential=get_search_credential(),  # pyright: ignore
     )
 
 
 def initialize_semantic_kernel(search_index_client: SearchIndexClient) -> Kernel:
+    from semantic_kernel import Kernel
+    from semantic_kernel.connectors.ai.open_ai import (
+        AzureChatCompletion,
+        AzureTextEmbedding,
+    )
+    from semantic_kernel.filters import FilterTypes
+    from sk.plugins.hotel_vector_search_plugin import HotelVectorSearchPlugin
+    from sk.filters.tool_result_cache_filter import tool_result_cache
+    from core.embeddings import embedding_settings
+    from core.logs import configure_logging
+
     gpt4omini_service = AzureChatCompletion(
         service_id="gp4omini_chat",
         deployment_name="gpt-4o-mini",
         endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-        ad_token_provider=get_bearer_token_provider(
-            get_credential(), "https://cognitiveservices.azure.com/.default"
-        ),
+        async_client=get_openai_client(),
         api_version=os.getenv("OPENAI_API_VERSION", ""),
     )
 
@@ -47,55 +127,68 @@ def initialize_semantic_kernel(search_index_client: SearchIndexClient) -> Kernel
         service_id="gp4o_chat",
         deployment_name="gpt-4o",
         endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-        ad_token_provider=get_bearer_token_provider(
-            get_credential(), "https://cognitiveservices.azure.com/.default"
-        ),
+        async_client=get_openai_client(),
         api_version=os.getenv("OPENAI_API_VERSION", ""),
     )
 
-    ada_embedding_service = AzureTextEmbedding(
-        service_id="ada_embedding",
-        deployment_name="text-embedding-ada-002",
+    embedding_service = AzureTextEmbedding(
+        service_id="embedding",
+        deployment_name=embedding_settings.model,
         endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-        ad_token_provider=get_bearer_token_provider(
-            get_credential(), "https://cognitiveservices.azure.com/.default"
-        ),
+        async_client=get_openai_client(),
         api_version=os.getenv("OPENAI_API_VERSION", ""),
     )
 
     kernel = Kernel()
     kernel.add_service(gpt4omini_service)
     kernel.add_service(gpt4o_service)
-    kernel.add_service(ada_embedding_service)
+    kernel.add_service(embedding_service)
 
     kernel.add_plugin(
         HotelVectorSearchPlugin(search_index_client=search_index_client),
         plugin_name="HotelVectorSearch",
     )
-
-    logging.basicConfig(
-        format="[%(asctime)s - %(name)s:%(lineno)d - %(levelname)s] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
+    kernel.add_filter(
+        FilterTypes.FUNCTION_INVOCATION, tool_result_cache.on_function_invocation
     )
-    logging.getLogger("kernel").setLevel(logging.DEBUG)
+
+    # A no-op when the app already did it.
+    configure_logging()
 
     return kernel
 
 
 def initialize_store(search_index_client: SearchIndexClient) -> AzureAISearchStore:
+    from semantic_kernel.connectors.memory.azure_ai_search import AzureAISearchStore
+
     return AzureAISearchStore(search_index_client=search_index_client)
 
 
+async def ensure_chat_history_collection(store: AzureAISearchStore) -> None:
+    from sk.memory.chat_history_azure_ai_search import ChatHistoryInAzureAISearch
+
+    history = ChatHistoryInAzureAISearch(
+        store=store, target_count=30, threshold_count=30
+    )
+    await history.create_collection(collection_name="chat-history")
+
+
 async def initialize_chat_history(
     store: AzureAISearchStore,
+    session_id: str,
+    user_id: str,
+    query: str | None = None,
 ) -> ChatHistoryInAzureAISearch:
+    """The session's history; `query` selects which earlier turns are recalled into it."""
+    from sk.memory.chat_history_azure_ai_search import ChatHistoryInAzureAISearch
 
     history = ChatHistoryInAzureAISearch(
         store=store, target_count=30, threshold_count=30
     )
 
+    history.set_session_info(session_id=session_id, user_id=user_id)
     await history.create_collection(collection_name="chat-history")
-    await history.read_messages()
+    await history.read_messages(query=query)
 
     if len(history) == 0:
         history.add_system_message(
@@ -113,3 +206,38 @@ async def initialize_chat_history(
         )
 
     return history
+
+
+async def warm_up_connections(
+    search_index_client: SearchIndexClient, kernel: Kernel
+) -> None:
+    """Fetches the AAD token, opens the Search and OpenAI connections and loads the filter vocabulary."""
+    if "ad_token_provider" in get_openai_auth():
+        await asyncio.to_thread(get_token_provider())
+
+    from openai import APIStatusError
+
+    async def open_connection(client) -> None:
+        try:
+            await client.models.list()
+        except APIStatusError:
+            # Any HTTP response means the connection and token are in place.
+            pass
+
+    clients = {
+        id(service.client): service.client  # pyright: ignore
+        for service in kernel.services.values()
+        if hasattr(service, "client")
+    }.values()
+    from services.azure_ai_search_service import search_vocabulary
+
+    index_name = os.getenv("AZURE_AI_SEARCH_INDEX_NAME")
+    results = await asyncio.gather(
+        search_index_client.get_service_statistics(),
+        *([search_vocabulary(index_name)] if index_name else []),
+        *[open_connection(client) for client in clients],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning(f"Warm-up request failed: {result}")
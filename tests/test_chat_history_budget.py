@@ -0,0 +1,41 @@
+from semantic_kernel.contents import ChatHistory
+from semantic_kernel.contents.utils.author_role import AuthorRole
+
+from sk.memory.chat_history_budget import measure_chat_history, trim_chat_history
+
+
+def history(*messages: tuple[AuthorRole, str]) -> ChatHistory:
+    chat_history = ChatHistory()
+    for role, content in messages:
+        chat_history.add_message({"role": role, "content": content})
+    return chat_history
+
+
+def test_oldest_turns_are_dropped_first():
+    chat_history = history(
+        (AuthorRole.SYSTEM, "system"),
+        (AuthorRole.USER, "a" * 400),
+        (AuthorRole.ASSISTANT, "b" * 400),
+        (AuthorRole.USER, "c" * 40),
+    )
+    assert trim_chat_history(chat_history, 150) == 2
+    assert [message.content for message in chat_history.messages] == ["system", "c" * 40]
+
+
+def test_latest_user_message_is_kept_and_cut_when_over_the_cap():
+    chat_history = history(
+        (AuthorRole.SYSTEM, "system"),
+        (AuthorRole.USER, "a" * 400),
+        (AuthorRole.ASSISTANT, "b" * 400),
+        (AuthorRole.USER, "c" * 4000),
+    )
+    trim_chat_history(chat_history, 300)
+    assert [message.role for message in chat_history.messages] == [AuthorRole.SYSTEM, AuthorRole.USER]
+    assert chat_history.messages[-1].content.startswith("c")
+    assert measure_chat_history(chat_history)[0] <= 300
+
+
+def test_history_within_the_cap_is_untouched():
+    chat_history = history((AuthorRole.USER, "a" * 40), (AuthorRole.ASSISTANT, "b" * 40))
+    assert trim_chat_history(chat_history, 300) == 0
+    assert len(chat_history.messages) == 2
@@ -0,0 +1,27 @@
+from core.search_filters import SearchFilters, search_cache_key
+
+
+def key(query: str, filters: SearchFilters = SearchFilters()) -> tuple:
+    return search_cache_key("hotels", "text_vector", query, filters)
+
+
+def test_reordered_queries_do_not_collide():
+    assert key("flights from Seattle to Denver") != key("flights from Denver to Seattle")
+    assert key("hotel near the airport") != key("airport near the hotel")
+
+
+def test_negated_queries_do_not_collide():
+    assert key("hotel with a pool") != key("hotel with no pool")
+    assert key("pet friendly hotel") != key("not a pet friendly hotel")
+
+
+def test_repeated_words_are_kept():
+    assert key("pool") != key("pool pool")
+
+
+def test_case_whitespace_and_punctuation_are_folded():
+    assert key("Hotels in Seattle") == key("  hotels in seattle?! ")
+
+
+def test_filters_are_part_of_the_key():
+    assert key("hotels", SearchFilters(cities=("Seattle",))) != key("hotels")
@@ -0,0 +1,44 @@
+from core.search_filters import SearchFilters, Vocabulary
+
+vocabulary = Vocabulary(
+    {
+        "City": ["New York", "Washington", "Spring", "Seattle", "Portland"],
+        "State": ["NY", "WA", "OR", "IN"],
+        "Category": ["Resort and Spa", "Budget", "Luxury"],
+        "Tags": ["pool", "free wifi"],
+    }
+)
+
+
+def test_negated_amenities_are_skipped():
+    filters = vocabulary.extract("I don't need a pool, something in New York")
+    assert filters == SearchFilters(cities=("New York",))
+
+
+def test_place_followed_by_state_is_the_state():
+    assert vocabulary.extract("hotels in Washington state") == SearchFilters(states=("WA",))
+
+
+def test_places_and_categories_need_a_cue():
+    assert vocabulary.extract("spring break resort") == SearchFilters()
+    assert vocabulary.extract("budget hotel near Seattle") == SearchFilters(
+        cities=("Seattle",), categories=("Budget",)
+    )
+
+
+def test_capitalized_words_are_not_state_codes():
+    filters = vocabulary.extract("Hotels IN Seattle OR Portland")
+    assert filters == SearchFilters(cities=("Seattle", "Portland"))
+
+
+def test_state_codes_are_only_preferred():
+    filters = vocabulary.extract("Portland, OR hotels with a pool")
+    assert filters.odata() == "City eq 'Portland' and Tags/any(t: t eq 'pool')"
+    assert filters.preferred_states == ("OR",)
+    results = [{"State": "ME"}, {"State": "OR"}]
+    assert filters.rank(results) == [{"State": "OR"}, {"State": "ME"}]
+
+
+def test_parameters_resolve_without_cues():
+    assert vocabulary.resolve("City", ["seattle"]) == ["Seattle"]
+    assert vocabulary.resolve("Category", ["resort"]) == ["Resort and Spa"]
@@ -0,0 +1,37 @@
+import time
+import asyncio
+
+from services.azure_ai_search_service import _SearchThreads
+
+
+def test_cancelled_queued_job_frees_its_count():
+    async def scenario() -> _SearchThreads:
+        threads = _SearchThreads(1)
+        running = asyncio.ensure_future(threads.run(time.sleep, 0.2))
+        await asyncio.sleep(0.01)
+        queued = asyncio.ensure_future(threads.run(time.sleep, 0.2))
+        await asyncio.sleep(0.01)
+        assert threads.busy == 2 and threads.saturated()
+        queued.cancel()
+        await running
+        await asyncio.sleep(0.01)
+        return threads
+
+    threads = asyncio.run(scenario())
+    assert threads.busy == 0
+    assert not threads.saturated()
+
+
+def test_failed_job_frees_its_count():
+    def fail() -> None:
+        raise RuntimeError("search failed")
+
+    async def scenario() -> _SearchThreads:
+        threads = _SearchThreads(2)
+        try:
+            await threads.run(fail)
+        except RuntimeError:
+            pass
+        return threads
+
+    assert asyncio.run(scenario()).busy == 0
@@ -0,0 +1,102 @@
+"""Loads hotel records into the search index in bulk.
+
+    python -m tools.ingest_hotels hotels.jsonl --index hotels-sample-index
+
+The input is JSONL, or CSV with `|`-separated tags, with the fields Id,
+HotelName, Category, City, State, Tags and Description. Descriptions are
+chunked, embedded in batches and uploaded in parallel batches. Content
+hashes of what was uploaded are kept in `--state`, so re-running with the
+same file embeds and uploads nothing, and an edited record only re-embeds
+the chunks whose text changed. `--prune` deletes hotels missing from the
+input.
+
+Each `--vector-field` is written with the embedding shortened to its
+dimensions; naming two fields dual-writes them from a single embedding
+request, e.g. while migrating to a smaller field with
+tools/migrate_embeddings.py. With `--create-index` a missing index is
+created first, with its vector fields indexed by `--profile` (see
+core/search_index.py).
+
+Endpoints and credentials are read from the same environment variables as
+the function app. The report is JSON.
+"""
+import os
+import json
+import asyncio
+import argparse
+
+from core.embeddings import embedding_settings, parse_vector_field
+from core.search_index import get_profile, profiles
+from services.hotel_ingestion_service import (
+    HotelIngestionService,
+    IngestionState,
+    read_hotels,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("input", help="JSONL or CSV file of hotel records")
+    parser.add_argument(
+        "--index",
+        default=os.getenv("AZURE_AI_SEARCH_INDEX_NAME") or os.getenv("INDEX_NAME"),
+        help="Target index (default: AZURE_AI_SEARCH_INDEX_NAME)",
+    )
+    parser.add_argument("--state", help="Content hash file (default: .ingestion-state/<index>.json)")
+    parser.add_argument(
+        "--embedding-model",
+        default=embedding_settings.model,
+        help="Embedding deployment (default: EMBEDDING_MODEL)",
+    )
+    parser.add_argument(
+        "--vector-field",
+        action="append",
+        metavar="NAME[:DIMENSIONS]",
+        help="Vector field to write, repeat to dual-write during a migration "
+        "(default: EMBEDDING_VECTOR_FIELD at EMBEDDING_DIMENSIONS)",
+    )
+    parser.add_argument("--embed-batch-size", type=int, default=64)
+    parser.add_argument("--embed-concurrency", type=int, default=4)
+    parser.add_argument("--upload-batch-size", type=int, default=500)
+    parser.add_argument("--upload-concurrency", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--chunk-chars", type=int, default=2000)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--create-index", action="store_true", help="Create the index if it is missing")
+    parser.add_argument(
+        "--profile",
+        choices=sorted(profiles),
+        default=os.getenv("SEARCH_VECTOR_PROFILE", "default"),
+        help="Vector index profile used by --create-index",
+    )
+    parser.add_argument("--prune", action="store_true", help="Delete hotels missing from the input")
+    args = parser.parse_args()
+
+    if not args.index:
+        parser.error("--index is required when AZURE_AI_SEARCH_INDEX_NAME is not set")
+
+    service = HotelIngestionService(
+        index_name=args.index,
+        embedding_model=args.embedding_model,
+        vector_fields=dict(map(parse_vector_field, args.vector_field))
+        if args.vector_field
+        else {embedding_settings.vector_field: embedding_settings.dimensions},
+        state=IngestionState(args.state or os.path.join(".ingestion-state", f"{args.index}.json")),
+        embed_batch_size=args.embed_batch_size,
+        embed_concurrency=args.embed_concurrency,
+        upload_batch_size=args.upload_batch_size,
+        upload_concurrency=args.upload_concurrency,
+        max_retries=args.max_retries,
+        chunk_chars=args.chunk_chars,
+        chunk_overlap=args.chunk_overlap,
+    )
+    if args.create_index and asyncio.run(service.ensure_index(get_profile(args.profile))):
+        print(f"Created index {args.index} with vector profile {args.profile}")
+    report = asyncio.run(service.ingest(read_hotels(args.input), prune=args.prune))
+    print(json.dumps(report.as_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
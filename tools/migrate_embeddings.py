@@ -0,0 +1,126 @@
+"""Migrates the hotel index to shorter embeddings with a side-by-side vector field.
+
+    python -m tools.migrate_embeddings --dimensions 256 --profile scalar
+
+1. Adds `--target-field` (default `text_vector_<dimensions>`) to the index,
+   indexed with `--profile`, next to the current `--source-field`.
+2. Backfills it: stored source vectors are truncated when both fields use
+   the same text-embedding-3 model, otherwise the chunk text is re-embedded.
+3. Reports recall@k of the new field against the full-dimension baseline,
+   exactly over the backfilled vectors and as top-k overlap on the live
+   index, with the query latency of both fields.
+
+While the report is reviewed, ingestion dual-writes both fields:
+
+    python -m tools.ingest_hotels hotels.jsonl --vector-field text_vector --vector-field text_vector_256:256
+
+Moving off text-embedding-ada-002 (the EMBEDDING_MODEL default) re-embeds
+every chunk: pass `--model text-embedding-3-small --source-model
+text-embedding-ada-002`. Queries move over by setting
+EMBEDDING_VECTOR_FIELD=text_vector_256, EMBEDDING_DIMENSIONS=256 and, when
+the model changed, EMBEDDING_MODEL; the old field is dropped when the index is next
+rebuilt with tools/ingest_hotels.py --create-index. The offline comparison
+needs NumPy (benchmarks/requirements.txt).
+"""
+import os
+import json
+import asyncio
+import argparse
+
+from core.embeddings import embedding_settings
+from core.search_index import get_profile, profiles
+from services.embedding_migration_service import EmbeddingMigrationService
+
+DEFAULT_QUERIES = [
+    "luxury hotel with a spa and ocean view",
+    "cheap place to stay near the airport with free parking",
+    "pet-friendly hotel downtown",
+    "family resort with a pool and kids club",
+    "boutique hotel in a historic building",
+    "hotel with a rooftop bar and city views",
+    "quiet mountain lodge for hiking",
+    "business hotel with meeting rooms and fast wifi",
+    "beachfront suites with a kitchen",
+    "budget motel on the highway with breakfast included",
+]
+
+
+async def migrate(args: argparse.Namespace) -> dict:
+    service = EmbeddingMigrationService(
+        index_name=args.index,
+        key_field=args.key_field,
+        text_field=args.text_field,
+        source_field=args.source_field,
+        source_model=args.source_model,
+        target_field=args.target_field or f"{args.source_field}_{args.dimensions}",
+        target_model=args.model,
+        target_dimensions=args.dimensions,
+        batch_size=args.batch_size,
+    )
+    report: dict = {"index": args.index, "target_field": service.target_field}
+    if not args.skip_add_field:
+        report["field_added"] = await service.add_target_field(get_profile(args.profile))
+
+    backfill = await service.backfill(re_embed=args.re_embed, keep_vectors=args.recall_documents)
+    report["backfill"] = {
+        "documents": backfill.documents,
+        "truncated": backfill.truncated,
+        "embedded": backfill.embedded,
+        "written": backfill.written,
+        "failed": backfill.failed,
+        "failures": backfill.failures[:20],
+        "elapsed_seconds": round(backfill.elapsed_seconds, 2),
+    }
+
+    queries = DEFAULT_QUERIES
+    if args.queries_file:
+        with open(args.queries_file, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    report["comparison"] = await service.compare(queries, backfill, k=args.k)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--dimensions", type=int, required=True, help="Dimensions of the new field, e.g. 256 or 512")
+    parser.add_argument(
+        "--index",
+        default=os.getenv("AZURE_AI_SEARCH_INDEX_NAME") or os.getenv("INDEX_NAME"),
+        help="Index to migrate (default: AZURE_AI_SEARCH_INDEX_NAME)",
+    )
+    parser.add_argument("--model", default=embedding_settings.model, help="Embedding deployment of the new field")
+    parser.add_argument("--source-model", help="Embedding deployment of the current field (default: --model)")
+    parser.add_argument("--source-field", default=embedding_settings.vector_field)
+    parser.add_argument("--target-field", help="Name of the new field (default: <source-field>_<dimensions>)")
+    parser.add_argument("--key-field", default="chunk_id")
+    parser.add_argument("--text-field", default="chunk")
+    parser.add_argument(
+        "--profile",
+        choices=sorted(profiles),
+        default=os.getenv("SEARCH_VECTOR_PROFILE", "default"),
+        help="Vector index profile of the new field",
+    )
+    parser.add_argument("--skip-add-field", action="store_true", help="The field exists already, only backfill")
+    parser.add_argument("--re-embed", action="store_true", help="Re-embed the text even when truncation is possible")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--queries-file", help="Comparison queries, one per line")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--recall-documents", type=int, default=20000, help="Vectors kept for the offline recall")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    if not args.index:
+        parser.error("--index is required when AZURE_AI_SEARCH_INDEX_NAME is not set")
+    args.source_model = args.source_model or args.model
+
+    text = json.dumps(asyncio.run(migrate(args)), indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,64 @@
 import asyncio
+from core.sse import SSEEvent, token
+from core.telemetry import instrument_stream
 
 
-async def collect_and_stream(response):
+def _usage_of(chunk):
+    # The OpenAI usage on the raw chunk also reports cached prompt tokens.
+    inner = getattr(chunk, "inner_content", None)
+    if getattr(inner, "usage", None) is not None:
+        return inner.usage
+    metadata = getattr(chunk, "metadata", None) or {}
+    return metadata.get("usage")
+
+
+async def collect_and_stream(response, model: str = ""):
+    """Runs the kernel's streamed turn to completion and returns its SSE events and text.
+
+    The events start with the turn's tool calls, when called inside a
+    `tool_turn`, and end with the token usage of all of the turn's
+    completions when the service reported it.
+    """
+    from sk.filters.tool_result_cache_filter import current_tool_turn
+
     content = ""
+    usage = None
+    prompt_tokens = completion_tokens = 0
 
     queue = asyncio.Queue()
 
     async def collect_content():
-        nonlocal content
-        async for chunk in response:
+        nonlocal content, usage, prompt_tokens, completion_tokens
+        async for chunk in instrument_stream(
+            response,
+            name="sk.stream_chat",
+            model=model,
+            text_of=lambda chunk: chunk.content,
+            usage_of=_usage_of,
+        ):
+            # Each round of automatic function calling reports its own usage.
+            chunk_usage = _usage_of(chunk)
+            if chunk_usage is not None:
+                usage = chunk_usage
+                prompt_tokens += chunk_usage.prompt_tokens or 0
+                completion_tokens += chunk_usage.completion_tokens or 0
             if chunk.content:
                 content += chunk.content
-                await queue.put(chunk.content)
+                await queue.put(token(chunk.content))
 
+        if usage is not None:
+            await queue.put(SSEEvent("usage", {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+            }))
         await queue.put(None)
 
+    turn = current_tool_turn.get()
+
     async def stream_response():
+        # Tool calls finish before the answer streams; report them first.
+        for status in turn.statuses if turn is not None else []:
+            yield SSEEvent("tool_status", status)
         while True:
             chunk = await queue.get()
             if chunk is None:
@@ -25,3 +68,40 @@ async def collect_and_stream(response):
     await collect_content()
 
     return stream_response(), content
+
+
+def llm_error_response(error: BaseException):
+    """Maps a failed upstream call, raised directly or wrapped by Semantic Kernel, to a response."""
+    import math
+    import openai
+    from azurefunctions.extensions.http.fastapi import JSONResponse
+    from core.admission import mark_overloaded
+    from core.resilience import DependencyUnavailable
+
+    cause: BaseException | None = error
+    while cause is not None and not isinstance(
+        cause, (openai.APIError, DependencyUnavailable, TimeoutError)
+    ):
+        cause = cause.__cause__
+
+    if isinstance(cause, DependencyUnavailable):
+        return mark_overloaded(JSONResponse(
+            {"message": "The service is temporarily unavailable, please try again shortly."},
+            status_code=503,
+            headers={"Retry-After": str(max(1, math.ceil(cause.retry_after)))},
+        ))
+    if isinstance(cause, TimeoutError):
+        return JSONResponse({"message": "The response took too long."}, status_code=504)
+    if isinstance(cause, openai.RateLimitError):
+        try:
+            retry_after = math.ceil(float(cause.response.headers.get("retry-after", "1")))
+        except ValueError:
+            retry_after = 1
+        return mark_overloaded(JSONResponse(
+            {"message": "The model is busy, please try again shortly."},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+        ))
+    if isinstance(cause, openai.APIError):
+        return JSONResponse({"message": "The model request failed."}, status_code=502)
+    return None